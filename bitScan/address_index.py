@@ -0,0 +1,232 @@
+import hashlib
+import logging
+import math
+from array import array
+
+from bitScan.serializer import Serializer
+from bitScan.utils import *
+
+INDEX_HEADER = 'host,port,firstSeen,lastSeen,peersEstimate,timestamp'
+# peers of an address which are kept exactly, 16 bit fields of one item of an array('Q')
+EXACT_PEERS = 4
+# registers of the HyperLogLog sketch of an address with more peers, one byte each
+SKETCH_REGISTERS = 256
+# marks a slot whose peers are in a sketch
+SKETCHED = (1 << 64) - 1
+
+
+def address_key(ip, port):
+    """Encode the packed ip and port of an address as one integer.
+
+    Note:
+        ipv4-mapped addresses are encoded as negative numbers from the 4 byte ipv4, so they are small and do
+        not collide with ipv6 addresses.
+
+    Args:
+        ip (bytes): The 16 byte ip.
+        port (int): Port
+
+    Returns:
+        int: The key of the address.
+    """
+    if ip[:12] == IPV4_MAPPED_PREFIX:
+        return -((int.from_bytes(ip[12:], 'big') << 16 | port) + 1)
+    return int.from_bytes(ip, 'big') << 16 | port
+
+
+def split_key(key):
+    """Reverse address_key.
+
+    Args:
+        key (int): The key of the address.
+
+    Returns:
+        (tuple): tuple containing:
+            ip (bytes): The 16 byte ip.
+            port (int): Port
+    """
+    if key < 0:
+        key = -key - 1
+        return IPV4_MAPPED_PREFIX + (key >> 16).to_bytes(4, 'big'), key & 0xFFFF
+    return (key >> 16).to_bytes(16, 'big'), key & 0xFFFF
+
+
+def peer_hash(peer):
+    """
+    Args:
+        peer (tuple): host, port of a peer.
+
+    Returns:
+        (tuple): tuple containing:
+            register (int): The register of the peer in the sketches.
+            rank (int): The value the peer sets the register to at least, 1 plus the leading zeros of the rest
+                of the hash.
+    """
+    value = int.from_bytes(hashlib.blake2b(f'{peer[0]},{peer[1]}'.encode(), digest_size=8).digest(), 'big')
+    rest = value & ((1 << 56) - 1)
+    return value >> 56, 57 - rest.bit_length()
+
+
+def estimate_sketch(registers):
+    """Estimate the number of peers of a HyperLogLog sketch.
+
+    Args:
+        registers (bytes): The SKETCH_REGISTERS registers of the sketch.
+
+    Returns:
+        int: Estimated number of different peers, by linear counting of the empty registers while they are
+            accurate.
+    """
+    m = len(registers)
+    estimate = 0.7213 / (1 + 1.079 / m) * m * m / sum(2.0 ** -value for value in registers)
+    empty = registers.count(0)
+    if estimate <= 2.5 * m and empty:
+        estimate = m * math.log(m / empty)
+    return round(estimate)
+
+
+class AddressIndex(object):
+    """Index of all addresses received during a scan from all connections.
+
+    Note:
+        Every address gets a slot. The values of a slot are stored in arrays instead of an object per address,
+        so an address costs its key and the dictionary entry (about 200 bytes together) and 28 bytes in the
+        arrays.
+
+        The first EXACT_PEERS peers of an address are kept exactly, as their peer id + 1 in the 16 bit fields
+        of peer_words, so their number is exact. The fifth peer moves the address to a HyperLogLog sketch of
+        SKETCH_REGISTERS registers, about 340 bytes more, and the number of peers becomes an estimate with a
+        standard error of about 6.5% (1.04 / sqrt(SKETCH_REGISTERS)) and no upper limit. Peers with an id
+        above 0xFFFE go into the sketch at once. The memory of an address therefore never grows with the
+        number of peers which sent it, the column of the summary is called peersEstimate.
+
+    Attributes:
+        slots (dict): Slot for every address key, see address_key.
+        first_seen (array): The time we received the address for the first time.
+        last_seen (array): The time we received the address for the last time.
+        peer_words (array): The exact peers of the address, or SKETCHED.
+        timestamps (array): The last timestamp of the address in an addr message.
+        sketches (dict): Offset in registers of the sketch of every slot with SKETCHED.
+        registers (bytearray): The registers of all sketches.
+        peer_ids (dict): Id for every peer (host, port).
+        peer_hashes (list): (register, rank) of every peer id, see peer_hash.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.first_seen = array('d')
+        self.last_seen = array('d')
+        self.peer_words = array('Q')
+        self.timestamps = array('I')
+        self.sketches = {}
+        self.registers = bytearray()
+        self.peer_ids = {}
+        self.peer_hashes = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def observe(self, peer, current_time, records):
+        """Add received addresses to the index.
+
+        Args:
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+
+        Returns:
+            list: Positions of the addresses in records which are new or have a new timestamp.
+        """
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self.peer_ids[peer] = len(self.peer_hashes)
+            self.peer_hashes.append(peer_hash(peer))
+        # 0 marks an empty field, so peers whose tag does not fit go into the sketch
+        tag = peer_id + 1 if peer_id < 0xFFFF else 0
+        changed = []
+
+        for idx, timestamp in enumerate(records.timestamps):
+            key = address_key(records.ips[16 * idx:16 * idx + 16], records.ports[idx])
+            slot = self.slots.get(key)
+            if slot is None:
+                slot = self.slots[key] = len(self.first_seen)
+                self.first_seen.append(current_time)
+                self.last_seen.append(current_time)
+                self.peer_words.append(0)
+                self.timestamps.append(timestamp)
+                self.add_peer(slot, peer_id, tag)
+                changed.append(idx)
+                continue
+
+            self.last_seen[slot] = current_time
+            self.add_peer(slot, peer_id, tag)
+            if self.timestamps[slot] != timestamp:
+                self.timestamps[slot] = timestamp
+                changed.append(idx)
+
+        return changed
+
+    def add_peer(self, slot, peer_id, tag):
+        """
+        Args:
+            slot (int): Slot of the address.
+            peer_id (int): Id of the peer which sent it.
+            tag (int): peer_id + 1, or 0 if it does not fit into a field of peer_words.
+        """
+        word = self.peer_words[slot]
+        if word != SKETCHED:
+            for shift in range(0, 16 * EXACT_PEERS, 16):
+                field = word >> shift & 0xFFFF
+                if field == tag and tag:
+                    return
+                if not field:
+                    if tag:
+                        self.peer_words[slot] = word | tag << shift
+                        return
+                    break
+            # the peers do not fit, they move into a new sketch
+            offset = self.sketches[slot] = len(self.registers)
+            self.registers.extend(bytes(SKETCH_REGISTERS))
+            self.peer_words[slot] = SKETCHED
+            for shift in range(0, 16 * EXACT_PEERS, 16):
+                field = word >> shift & 0xFFFF
+                if field:
+                    self.add_to_sketch(offset, field - 1)
+        else:
+            offset = self.sketches[slot]
+        self.add_to_sketch(offset, peer_id)
+
+    def add_to_sketch(self, offset, peer_id):
+        register, rank = self.peer_hashes[peer_id]
+        if self.registers[offset + register] < rank:
+            self.registers[offset + register] = rank
+
+    def count_peers(self, slot):
+        """
+        Args:
+            slot (int): Slot of the address.
+
+        Returns:
+            int: Number of peers which sent the address, an estimate above EXACT_PEERS peers.
+        """
+        word = self.peer_words[slot]
+        if word != SKETCHED:
+            return sum(1 for shift in range(0, 16 * EXACT_PEERS, 16) if word >> shift & 0xFFFF)
+        offset = self.sketches[slot]
+        return estimate_sketch(self.registers[offset:offset + SKETCH_REGISTERS])
+
+    def write_summary(self, file_location):
+        """Write one line per address with the values of the index.
+
+        Args:
+            file_location (str): The path to the file we want to write.
+        """
+        logging.info('INDEX Write summary.')
+
+        serializer = Serializer()
+        with open(file_location, 'w') as f:
+            f.write(INDEX_HEADER + '\n')
+            for key, slot in self.slots.items():
+                ip, port = split_key(key)
+                f.write(f'{serializer.format_host(ip)},{port},{self.first_seen[slot]},{self.last_seen[slot]},'
+                        f'{self.count_peers(slot)},{self.timestamps[slot]}\n')
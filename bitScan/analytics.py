@@ -0,0 +1,266 @@
+import argparse
+import logging
+import math
+import os
+import statistics
+import tempfile
+import zlib
+
+from bitScan.binary_output import iter_records, read_peers
+from bitScan.serializer import render_host
+from bitScan.utils import *
+
+"""Propagation analytics over the output files of a scan, for files larger than the memory.
+
+Every received address is a report of an address by a peer. The reports are hash partitioned by address into
+temporary files, so every address is in exactly one partition, and the partitions are aggregated one by one.
+The number of partitions is chosen so that one partition fits into --memory-mb.
+
+Example:
+    python analytics.py ../input_output/output_addr.csv --memory-mb 256
+    python analytics.py ../input_output/output_addr.bin --peers ../input_output/output_peers.csv
+"""
+
+ADDRESSES_HEADER = 'host,port,firstSeen,firstPeerHost,firstPeerPort,peers,reports,spreadDelay,medianDelay'
+PEERS_HEADER = 'host,port,reports,addresses,firstReports,meanDelay'
+# bytes in memory per byte of a partition file during the aggregation, rounded up from CPython 3.11
+MEMORY_PER_BYTE = 6
+# bytes of every partition file buffer
+PARTITION_BUFFER = 1 << 16
+# partition files open at the same time, far below the usual limit of 1024 open files
+MAX_OPEN_PARTITIONS = 256
+
+
+def iter_reports(file_location, peers_location=OUTPUT_PEERS):
+    """Read the reports of an output file, csv or binary.
+
+    Args:
+        file_location (str): The path to the output file, binary if it ends with .bin.
+        peers_location (str): The path to the peer dictionary of a binary output file.
+
+    Yields:
+        (tuple): tuple containing:
+            address (str): host,port of the reported address.
+            peer (tuple): host, port of the peer which reported it.
+            receive_time (str): The time we received the report.
+    """
+    if file_location.endswith('.bin'):
+        peers = read_peers(peers_location)
+        for chunk in iter_records(file_location):
+            for ip, port, services, timestamp, receive_time, peer_id in chunk:
+                # NumPy strips trailing zero bytes of the ip
+                host = render_host(bytes(ip).ljust(16, b'\x00'))
+                yield f'{host},{int(port)}', peers[int(peer_id)], repr(float(receive_time))
+        return
+
+    with open(file_location, 'r') as f:
+        # header
+        next(f, None)
+        for line in f:
+            connected_host, connected_port, host, port, _, receive_time = line.rstrip('\n').split(',')
+            yield f'{host},{port}', (connected_host, connected_port), receive_time
+
+
+def partition_count(total_bytes, memory_mb):
+    """
+    Args:
+        total_bytes (int): Size of the input files.
+        memory_mb (float): Memory cap in MiB.
+
+    Returns:
+        int: Number of partitions, so that the aggregation of one partition stays below the memory cap.
+    """
+    memory = memory_mb * (1 << 20)
+    return max(1, math.ceil(total_bytes * MEMORY_PER_BYTE / memory))
+
+
+def partition_reports(reports, directory, partitions):
+    """Write every report into the partition of its address.
+
+    Note:
+        At most MAX_OPEN_PARTITIONS files are open at the same time. With more partitions the reports are
+        split into MAX_OPEN_PARTITIONS files first and every file is split again, see split_partition.
+
+    Args:
+        reports (iterable): (address, peer, receive time), see iter_reports.
+        directory (str): Directory of the partition files.
+        partitions (int): Number of partitions.
+
+    Returns:
+        (tuple): tuple containing:
+            paths (list): The path of every partition file.
+            peer_reports (dict): Number of reports of every peer.
+    """
+    peer_reports = {}
+
+    def lines():
+        for address, peer, receive_time in reports:
+            peer_reports[peer] = peer_reports.get(peer, 0) + 1
+            yield address, f'{address},{peer[0]},{peer[1]},{receive_time}\n'
+
+    paths = split_partition(lines(), os.path.join(directory, 'partition'), partitions)
+    return paths, peer_reports
+
+
+def split_partition(lines, prefix, partitions, divisor=1):
+    """Write lines into partition files by the hash of their address.
+
+    Note:
+        The partition of an address is its crc32 divided by divisor modulo the number of files, so every
+        split uses other bits of the hash than the splits before it.
+
+    Args:
+        lines (iterable): (address, line) of every report.
+        prefix (str): The path of the partition files without the number of the partition.
+        partitions (int): Number of partitions.
+        divisor (int): Product of the number of files of the splits before.
+
+    Returns:
+        list: The path of every partition file.
+    """
+    fanout = min(partitions, MAX_OPEN_PARTITIONS)
+    paths = [f'{prefix}_{idx}.csv' for idx in range(fanout)]
+    files = [open(path, 'w', buffering=PARTITION_BUFFER) for path in paths]
+    try:
+        for address, line in lines:
+            files[zlib.crc32(address.encode()) // divisor % fanout].write(line)
+    finally:
+        for f in files:
+            f.close()
+
+    if fanout == partitions:
+        return paths
+
+    split_paths = []
+    for path in paths:
+        split_paths += split_partition(iter_partition(path), path[:-len('.csv')], math.ceil(partitions / fanout),
+                                       divisor * fanout)
+        os.remove(path)
+    return split_paths
+
+
+def iter_partition(file_location):
+    """
+    Args:
+        file_location (str): The path to a partition file.
+
+    Yields:
+        (tuple): tuple containing:
+            address (str): host,port of the reported address.
+            line (str): The line of the report.
+    """
+    with open(file_location, 'r') as f:
+        for line in f:
+            yield line[:line.index(',', line.index(',') + 1)], line
+
+
+def aggregate_partition(file_location):
+    """
+    Args:
+        file_location (str): The path to a partition file.
+
+    Returns:
+        dict: For every address of the partition the number of reports and the first receive time per peer.
+    """
+    addresses = {}
+    with open(file_location, 'r') as f:
+        for line in f:
+            host, port, peer_host, peer_port, receive_time = line.rstrip('\n').split(',')
+            address = addresses.get((host, port))
+            if address is None:
+                address = addresses[(host, port)] = [0, {}]
+            address[0] += 1
+            peer = (peer_host, peer_port)
+            receive_time = float(receive_time)
+            first = address[1].get(peer)
+            if first is None or receive_time < first:
+                address[1][peer] = receive_time
+    return addresses
+
+
+def analyse(file_locations, addresses_location=OUTPUT_ANALYTICS_ADDRESSES, peers_location=OUTPUT_ANALYTICS_PEERS,
+            memory_mb=512, partitions=None, peer_dictionary=OUTPUT_PEERS, tmp_dir=None):
+    """Write the summary per address and per peer.
+
+    Note:
+        The lines of the addresses are in the order of the partitions, not sorted.
+
+        The spread delay of an address is the time from its first report to the first report of the last peer
+        which reported it, the median delay is the median over all peers. The delay of a peer is the time from
+        the first report of an address to the first report of this peer.
+
+    Args:
+        file_locations (list): The output files of the scan, csv or binary.
+        addresses_location (str): The path to the summary per address.
+        peers_location (str): The path to the summary per peer.
+        memory_mb (float): Memory cap in MiB.
+        partitions (int): Number of partitions. Default chosen from memory_mb and the size of the input.
+        peer_dictionary (str): The path to the peer dictionary of binary output files.
+        tmp_dir (str): Directory for the partition files. Default the directory of the summary per address.
+
+    Returns:
+        int: Number of different addresses.
+    """
+    logging.info('ANALYTICS Analyse %s.', file_locations)
+
+    if partitions is None:
+        total_bytes = sum(os.path.getsize(path) for path in file_locations)
+        partitions = partition_count(total_bytes, memory_mb)
+    reports = (report for path in file_locations for report in iter_reports(path, peer_dictionary))
+
+    # addresses, first reports, sum of delays
+    peer_stats = {}
+    count = 0
+    with tempfile.TemporaryDirectory(dir=tmp_dir or os.path.dirname(addresses_location) or '.') as directory:
+        paths, peer_reports = partition_reports(reports, directory, partitions)
+        logging.info('ANALYTICS %s partitions written.', len(paths))
+
+        with open(addresses_location, 'w') as out:
+            out.write(ADDRESSES_HEADER + '\n')
+            for path in paths:
+                lines = []
+                for (host, port), (reports_count, firsts) in aggregate_partition(path).items():
+                    first_peer = min(firsts, key=firsts.get)
+                    first_seen = firsts[first_peer]
+                    delays = []
+                    for peer, receive_time in firsts.items():
+                        delay = receive_time - first_seen
+                        delays.append(delay)
+                        stats = peer_stats.get(peer)
+                        if stats is None:
+                            stats = peer_stats[peer] = [0, 0, 0.0]
+                        stats[0] += 1
+                        stats[2] += delay
+                    peer_stats[first_peer][1] += 1
+                    lines.append(f'{host},{port},{first_seen},{first_peer[0]},{first_peer[1]},{len(firsts)},'
+                                 f'{reports_count},{max(delays)},{statistics.median(delays)}\n')
+                out.write(''.join(lines))
+                count += len(lines)
+                os.remove(path)
+
+    with open(peers_location, 'w') as out:
+        out.write(PEERS_HEADER + '\n')
+        for (peer_host, peer_port), (addresses, first_reports, delay_sum) in peer_stats.items():
+            out.write(f'{peer_host},{peer_port},{peer_reports[(peer_host, peer_port)]},{addresses},{first_reports},'
+                      f'{delay_sum / addresses}\n')
+
+    logging.info('ANALYTICS %s addresses from %s peers.', count, len(peer_stats))
+    return count
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Summarize the addresses and peers of the output files of a scan.')
+    parser.add_argument('inputs', nargs='*', default=[OUTPUT_ADDR],
+                        help='csv or binary (.bin) output files, default ' + OUTPUT_ADDR)
+    parser.add_argument('--memory-mb', type=float, default=512, help='Memory cap of the aggregation in MiB')
+    parser.add_argument('--partitions', type=int, help='Number of partitions, default chosen from --memory-mb')
+    parser.add_argument('--peers', default=OUTPUT_PEERS, help='peer dictionary of binary output files')
+    parser.add_argument('--addresses-output', default=OUTPUT_ANALYTICS_ADDRESSES,
+                        help='Summary per address: ' + ADDRESSES_HEADER)
+    parser.add_argument('--peers-output', default=OUTPUT_ANALYTICS_PEERS, help='Summary per peer: ' + PEERS_HEADER)
+    parser.add_argument('--tmp-dir', help='Directory for the partition files')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    analyse(args.inputs, args.addresses_output, args.peers_output, args.memory_mb, args.partitions, args.peers,
+            args.tmp_dir)
@@ -0,0 +1,315 @@
+import asyncio
+import itertools
+import logging
+import time
+
+from bitScan.connection import *
+from bitScan.timers import TimerWheel
+
+
+class AsyncConnection(Connection):
+    """Handles the connection to a bitcoin node with asyncio streams.
+
+    Note:
+        Same lifecycle as Connection (open, handshake, communicate, close), but every step which waits
+        for the network is a coroutine. Serializing and deserializing is inherited from Connection.
+
+    Args:
+        to_addr ((str, int)): Address of the bitcoin node we connect to in the form (ip, port).
+
+    Attributes:
+        reader (StreamReader): Incoming data of the connection.
+        writer (StreamWriter): Outgoing data of the connection.
+    """
+
+    def __init__(self, to_addr):
+        super().__init__(to_addr)
+        self.reader = None
+        self.writer = None
+
+    async def open(self, timeout, retry=None, attempts=None):
+        """Create connection to a bitcoin node.
+
+        Note:
+            Same retrying as Connection.open, but the delays do not block other connections.
+
+        Args:
+            timeout (int): The time when we want to shutdown in seconds.
+            retry (RetryPolicy): Timeout per attempt, delays and number of attempts. Default RetryPolicy().
+            attempts (int): Maximum number of attempts of this call, default retry.max_attempts.
+        """
+        logging.info('CONN Open connection.')
+
+        retry = retry or RetryPolicy()
+        attempts = attempts or retry.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.reader, self.writer = await asyncio.wait_for(asyncio.open_connection(*self.to_addr),
+                                                                  retry.attempt_timeout(timeout))
+                return
+            except (asyncio.TimeoutError, OSError) as err:
+                logging.error("Creating connection to %s,%s failed: %s", self.to_addr[0], self.to_addr[1], err)
+                if attempt >= attempts or retry.exhausted(attempt, timeout):
+                    raise ConnectionError
+                await asyncio.sleep(retry.delay(attempt))
+
+    def close(self):
+        logging.info("Close connection if active.")
+        CAPTURE.close_connection(self)
+        if self.writer:
+            self.writer.close()
+
+    def send_message(self, msg):
+        """Queue an already serialized message on the stream.
+
+        Args:
+            msg (bytes): The message created with Serializer.create_message.
+        """
+        self.writer.write(msg)
+
+    async def handshake(self, timeout, inbound=False):
+        """Send our version message and receive version/verack from a bitcoin node.
+
+        Note:
+            Same state machine as Connection.handshake.
+
+        Args:
+            timeout (int): The time when we want to shutdown in seconds.
+            inbound (bool): Indicates if the node connected to us, it sends its version first, see
+                Handshake.accept.
+
+        Returns:
+            dict: The version payload of the node, see Serializer.deserialize_version_payload.
+        """
+        logging.info("CONN Make handshake.")
+
+        handshake = Handshake(self.serializer)
+        if inbound:
+            handshake.accept(self.to_addr, self.from_addr)
+        else:
+            self.send_message(handshake.start(self.to_addr, self.from_addr))
+        deadline = handshake.deadline(timeout)
+
+        try:
+            while not handshake.done:
+                await self.writer.drain()
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionError("Handshake timed out.")
+                data = await asyncio.wait_for(self.reader.read(SOCKET_BUFFER), remaining)
+                if not data:
+                    raise ConnectionError("Node closed the connection during the handshake.")
+                self.process_handshake(data, handshake)
+            await self.writer.drain()
+        except asyncio.TimeoutError:
+            raise ConnectionError("Handshake timed out.")
+        except HandshakeContentError as err:
+            raise ConnectionError(err)
+
+        return self.finish_handshake(handshake)
+
+    def end_session(self):
+        """Make communicate return, closing the stream wakes up the read.
+        """
+        super().end_session()
+        if self.writer:
+            self.writer.close()
+
+    async def communicate(self, timeout, content_addr_msg, writer, interval_getaddr=-1, interval_addr=-1,
+                          policy=None, wheel=None):
+        """Send getaddr and addr messages in a time interval and listen permanently for incoming addr messages.
+
+        Note:
+            Same behaviour as Connection.communicate. All connections share one OutputWriter and one TimerWheel,
+            because they run in the same thread. The read has no timeout, the timers of the session close the
+            stream when it is over.
+
+        Args:
+            timeout (int): The Time when we have to shutdown.
+            content_addr_msg (AddrTemplate): The addr messages we send.
+            writer (OutputWriter): Writes the received addresses to the output files.
+            interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+            interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+            policy (SessionPolicy): Decides when the session ends, see SessionPolicy. Default SessionPolicy(),
+                which ends it at timeout.
+            wheel (TimerWheel): Fires the timers of all connections, driven by TimerWheel.run. Default a wheel
+                of this connection.
+
+        Returns:
+            (tuple): tuple containing:
+                addr_count (int): Number of received addresses from voluntary addr messages.
+                getaddr_count (int): Number of received addresses from responses to getaddr messages.
+        """
+        logging.info("CONN Start communication.")
+
+        counts = {'addr': 0, 'getaddr': 0}
+        session = (policy or SessionPolicy()).start(time.time(), timeout)
+        driver = None
+        if wheel is None:
+            wheel = TimerWheel()
+            driver = asyncio.ensure_future(wheel.run())
+
+        # messages which arrived together with the verack are already in the framer
+        current_time = time.time()
+        self.deliver(writer, session, counts, current_time, *self.process_data(b'', current_time))
+        self.start_timers(wheel, session, content_addr_msg, writer, interval_getaddr, interval_addr)
+
+        try:
+            while not self.session_over:
+                try:
+                    await self.writer.drain()
+                    start = PROFILER.start()
+                    data = await self.reader.read(SOCKET_BUFFER)
+                    current_time = time.time()
+                    PROFILER.stop('recv', start)
+                    if not data:
+                        if self.session_over:
+                            break
+                        raise PingError
+
+                    addr_records, getaddr_records = self.process_data(data, current_time)
+                    # save message to file
+                    start = PROFILER.start()
+                    self.deliver(writer, session, counts, current_time, addr_records, getaddr_records)
+                    PROFILER.stop('write', start)
+                except PingError as err:
+                    logging.error(
+                        "PingError with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1], err))
+                    break
+                except OSError as err:
+                    # drain fails if the session ended while it waited
+                    if not self.session_over:
+                        logging.error("Error occurred in connection with bitcoin node {},{}: {}".format(
+                            self.to_addr[0], self.to_addr[1], err))
+                    break
+        finally:
+            self.stop_timers()
+            if driver is not None:
+                driver.cancel()
+
+        return counts['addr'], counts['getaddr']
+
+
+async def scan_node(address, content_addr_msg, writer, semaphore, minutes, interval_getaddr=-1, interval_addr=-1,
+                    retry=None, policy=None, wheel=None):
+    """Open, handshake and communicate with one bitcoin node.
+
+    Note:
+        The time frame per node starts when the semaphore is acquired, so waiting for a free slot does
+        not reduce the time we listen to the node.
+
+        Every attempt to connect acquires the semaphore on its own. A node whose connection failed waits for
+        the next attempt without a slot (parked), so the slots go to the reachable nodes.
+
+        Any error of the node is logged and not raised, so it does not end the scan of the other nodes.
+
+    Args:
+        address (list): host,port
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        writer (OutputWriter): Writes the received addresses to the output files.
+        semaphore (Semaphore): Limits the number of open connections.
+        minutes (float): Time frame per node in minutes.
+        interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+        interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        retry (RetryPolicy): Timeout per attempt, delays and number of attempts. Default RetryPolicy().
+        policy (SessionPolicy): Decides when the session with the node ends.
+        wheel (TimerWheel): Fires the timers of all connections, see AsyncConnection.communicate.
+
+    Returns:
+        (tuple): tuple containing:
+            host (str): Host of the bitcoin node.
+            port (int): Port of the bitcoin node.
+            duration_of_connection (float): duration of connection
+            handshake_latency (float): Seconds the handshake took. None if there was no handshake.
+    """
+    retry = retry or RetryPolicy()
+    conn = AsyncConnection((address[0], int(address[1])))
+    duration_of_connection = 0
+    attempt = 0
+
+    while True:
+        attempt += 1
+        async with semaphore:
+            try:
+                timeout = calculate_timeout(minutes)
+                start = PROFILER.start()
+                await conn.open(timeout, retry, attempts=1)
+                PROFILER.stop('connect', start)
+            except ConnectionError:
+                if attempt >= retry.max_attempts:
+                    logging.error("Giving up on bitcoin node %s,%s after %s attempts.", address[0], address[1],
+                                  attempt)
+                    return conn.to_addr[0], conn.to_addr[1], duration_of_connection, None
+            else:
+                try:
+                    start = PROFILER.start()
+                    await conn.handshake(timeout)
+                    PROFILER.stop('handshake', start)
+                    beginning_time = time.time()
+                    await conn.communicate(timeout, content_addr_msg, writer, interval_getaddr, interval_addr, policy,
+                                           wheel)
+                    duration_of_connection = time.time() - beginning_time
+                except (ConnectionError, OSError) as err:
+                    logging.error("Error occurred in connection with bitcoin node %s,%s: %s", address[0], address[1],
+                                  err)
+                except Exception:
+                    # the node counts as failed, the other connections of the event loop go on
+                    logging.exception("Unexpected error in connection with bitcoin node %s,%s", address[0],
+                                      address[1])
+
+                conn.close()
+
+                return conn.to_addr[0], conn.to_addr[1], duration_of_connection, conn.handshake_latency
+
+        # parked
+        await asyncio.sleep(retry.delay(attempt))
+
+
+async def run_scan(addresses, content_addr_msg, writer, concurrency, minutes, interval_getaddr=-1, interval_addr=-1,
+                   retry=None, on_result=None, policy=None):
+    """Scan all bitcoin nodes concurrently in one event loop.
+
+    Note:
+        The nodes are taken from addresses while the scan goes on, at most twice concurrency at a time, so
+        parked nodes do not keep the slots empty and addresses may be a lazy iterator over a huge file.
+
+    Args:
+        addresses (iterable): The nodes we connect to. Every element is a list host,port.
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        writer (OutputWriter): Writes the received addresses to the output files.
+        concurrency (int): Maximum number of connections open at the same time.
+        minutes (float): Time frame per node in minutes.
+        interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+        interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        retry (RetryPolicy): Timeout per attempt to connect, delays and number of attempts.
+        on_result (callable): Called with the host, the port, the duration of the connection and the
+            handshake latency of every node as soon as it is done, e.g. DurationWriter.write.
+        policy (SessionPolicy): Decides when the session with a node ends.
+
+    Returns:
+        int: Number of scanned nodes.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    wheel = TimerWheel()
+    driver = asyncio.ensure_future(wheel.run())
+    targets = iter(addresses)
+    tasks = set()
+    count = 0
+
+    try:
+        while True:
+            for address in itertools.islice(targets, 2 * concurrency - len(tasks)):
+                tasks.add(asyncio.ensure_future(scan_node(address, content_addr_msg, writer, semaphore, minutes,
+                                                          interval_getaddr, interval_addr, retry, policy, wheel)))
+            if not tasks:
+                return count
+
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                count += 1
+                if on_result is not None:
+                    on_result(task.result())
+    finally:
+        driver.cancel()
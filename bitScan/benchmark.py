@@ -0,0 +1,310 @@
+import argparse
+import asyncio
+import logging
+import os
+import random
+import resource
+import struct
+import sys
+import tempfile
+import time
+
+from bitScan.binary_output import RECORD
+from bitScan.framer import MessageFramer
+from bitScan.serializer import ADDR_ENTRY_LEN, MAX_ADDR_ENTRIES, Serializer
+from bitScan.writer import OUTPUT_FILES, OUTPUT_FILES_BINARY
+from bitScan.utils import *
+
+"""Load benchmark of the scanner against simulated bitcoin nodes on localhost.
+
+Every simulated node listens on its own port of 127.0.0.1 and speaks the subset of the protocol the scanner
+uses: version/verack, ping/pong, getaddr and addr. main.py runs unchanged in a temporary directory with a
+getaddr.csv of the simulated nodes, so the whole pipeline including the output files is measured.
+
+Example:
+    python benchmark.py --peers 500 --seconds 10 --engine asyncio
+Arguments which are not known to the benchmark are passed to main.py.
+"""
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+BENCHMARK_HEADER = 'peers,seconds,elapsed,peersPerSecond,recordsSent,recordsWritten,recordsPerSecond,' \
+                   'bytesPerSecond,peakRssKiB,arguments'
+USER_AGENT = b'\x10/Satoshi:0.21.0/'
+
+
+def version_payload(serializer, to_addr):
+    """
+    Args:
+        serializer (Serializer): Serializer of the simulated nodes.
+        to_addr (tuple): host, port of the scanner.
+
+    Returns:
+        bytes: The payload of the version message of a simulated node.
+    """
+    return struct.pack('<iQq26s26sQ', serializer.protocol_version, 1, int(time.time()),
+                       serializer.serialize_network_address_version(to_addr),
+                       serializer.serialize_network_address_version(('127.0.0.1', 8333)),
+                       random.getrandbits(64)) + USER_AGENT + struct.pack('<i?', 0, True)
+
+
+def address_pool(size, seed=0):
+    """Create the addresses the simulated nodes send.
+
+    Args:
+        size (int): Number of different addresses.
+        seed (int): Seed of the random ips.
+
+    Returns:
+        bytes: size network addresses in the format of an addr message.
+    """
+    rng = random.Random(seed)
+    timestamp = int(time.time())
+    entry = struct.Struct('<IQ12s4s')
+    return b''.join(entry.pack(timestamp, 1, IPV4_MAPPED_PREFIX, rng.getrandbits(32).to_bytes(4, 'big')) +
+                    struct.pack('>H', 8333) for _ in range(size))
+
+
+class SimulatedNodes(object):
+    """Bitcoin nodes on localhost for the benchmark.
+
+    Note:
+        Every node sends addr messages with addr_size addresses so that it sends addr_rate addresses per
+        second, and answers getaddr with getaddr_size addresses in messages of at most 1000 addresses. The
+        addresses are taken from one shared pool at a random offset per message.
+
+    Args:
+        port (int): Port of the first node, the other nodes use the following ports.
+        peers (int): Number of nodes.
+        addr_rate (float): Addresses per second every node sends without being asked. 0 disables addr messages.
+        addr_size (int): Addresses per addr message.
+        getaddr_size (int): Addresses in the response to a getaddr message.
+        latency (float): Seconds before every response of a node.
+        pool_size (int): Number of different addresses.
+
+    Attributes:
+        bytes_sent (int): Number of bytes sent to the scanner.
+        records_sent (int): Number of addresses sent to the scanner.
+    """
+
+    def __init__(self, port, peers, addr_rate=10, addr_size=10, getaddr_size=1000, latency=0, pool_size=100000):
+        self.port = port
+        self.peers = peers
+        self.addr_rate = addr_rate
+        self.addr_size = addr_size
+        self.getaddr_size = getaddr_size
+        self.latency = latency
+        self.serializer = Serializer()
+        self.pool = address_pool(pool_size)
+        self.pool_size = pool_size
+        self.servers = []
+        self.bytes_sent = 0
+        self.records_sent = 0
+
+    async def start(self):
+        for i in range(self.peers):
+            self.servers.append(await asyncio.start_server(self.handle, '127.0.0.1', self.port + i))
+
+    async def stop(self):
+        for server in self.servers:
+            server.close()
+            await server.wait_closed()
+
+    def addr_message(self, count):
+        """
+        Args:
+            count (int): Number of addresses, at most 1000.
+
+        Returns:
+            bytes: An addr message.
+        """
+        offset = random.randrange(self.pool_size - count + 1) * ADDR_ENTRY_LEN
+        payload = self.serializer.serialize_int(count) + self.pool[offset:offset + count * ADDR_ENTRY_LEN]
+        self.records_sent += count
+        return self.serializer.create_message('addr', payload)
+
+    def send(self, writer, data):
+        self.bytes_sent += len(data)
+        writer.write(data)
+
+    async def handle(self, reader, writer):
+        """Serve one connection of the scanner until it closes the connection.
+        """
+        framer = MessageFramer(self.serializer)
+        sender = None
+        try:
+            while True:
+                data = await reader.read(SOCKET_BUFFER)
+                if not data:
+                    break
+                framer.feed(data)
+                for header, payload in framer.messages():
+                    if self.latency:
+                        await asyncio.sleep(self.latency)
+                    command = header['command']
+                    if command == 'version':
+                        self.send(writer, self.serializer.create_message(
+                            'version', version_payload(self.serializer, writer.get_extra_info('peername')[:2])))
+                        self.send(writer, self.serializer.constant_message('verack'))
+                        if self.addr_rate and sender is None:
+                            sender = asyncio.ensure_future(self.send_addr(writer))
+                    elif command == 'ping':
+                        self.send(writer, self.serializer.create_message('pong', bytes(payload)))
+                    elif command == 'getaddr':
+                        for count in chunks(self.getaddr_size, MAX_ADDR_ENTRIES):
+                            self.send(writer, self.addr_message(count))
+                await writer.drain()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            if sender is not None:
+                sender.cancel()
+            writer.close()
+
+    async def send_addr(self, writer):
+        """Send addr messages with addr_size addresses at addr_rate addresses per second.
+        """
+        interval = self.addr_size / self.addr_rate
+        # the nodes should not send at the same moment
+        await asyncio.sleep(random.uniform(0, interval))
+        while True:
+            self.send(writer, self.addr_message(self.addr_size))
+            await writer.drain()
+            await asyncio.sleep(interval)
+
+
+def chunks(total, size):
+    """
+    Args:
+        total (int): Number of items.
+        size (int): Maximum number of items per chunk.
+
+    Returns:
+        list: The size of every chunk.
+    """
+    return [min(size, total - start) for start in range(0, total, size)]
+
+
+def count_written_records(directory):
+    """
+    Args:
+        directory (str): The working directory of main.py.
+
+    Returns:
+        int: Number of addresses in the output files, csv or binary.
+    """
+    count = 0
+    for path in OUTPUT_FILES.values():
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            with open(path, 'rb') as f:
+                # minus the header
+                count += max(sum(1 for _ in f) - 1, 0)
+    for path in OUTPUT_FILES_BINARY.values():
+        path = os.path.join(directory, path)
+        if os.path.exists(path):
+            count += os.path.getsize(path) // RECORD.size
+    return count
+
+
+def peak_rss_of_children():
+    """
+    Returns:
+        float: The peak resident set size of the largest finished child process in KiB.
+    """
+    peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    # macOS reports bytes, Linux KiB
+    if sys.platform == 'darwin':
+        return peak / 1024
+    return peak
+
+
+def raise_open_files_limit():
+    """Every simulated node needs a listening socket and both ends of its connection need a file descriptor.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft != hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def run_benchmark(nodes, seconds, scan_arguments):
+    """Run main.py against the simulated nodes.
+
+    Args:
+        nodes (SimulatedNodes): The simulated nodes, not started yet.
+        seconds (float): Time frame per node in seconds.
+        scan_arguments (list): Additional arguments of main.py.
+
+    Returns:
+        dict: The measured values, the keys are the columns of BENCHMARK_HEADER.
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        cwd = os.path.join(directory, 'bitScan')
+        for name in ('bitScan', 'input_output', 'logs'):
+            os.mkdir(os.path.join(directory, name))
+        write_to_file(os.path.join(cwd, ADDRESSES_GETADDR),
+                      ''.join(f'127.0.0.1,{nodes.port + i}\n' for i in range(nodes.peers)), 'host,port')
+        write_to_file(os.path.join(cwd, CONTENT_ADDR_SEND), '', 'timestamp,service,host,port')
+
+        await nodes.start()
+        try:
+            env = dict(os.environ)
+            env['PYTHONPATH'] = os.pathsep.join([os.path.dirname(os.path.dirname(MAIN)), env.get('PYTHONPATH', '')])
+            beginning_time = time.time()
+            process = await asyncio.create_subprocess_exec(sys.executable, MAIN, '--minutes', str(seconds / 60),
+                                                           *scan_arguments, cwd=cwd, env=env)
+            await process.wait()
+            elapsed = time.time() - beginning_time
+        finally:
+            await nodes.stop()
+
+        if process.returncode != 0:
+            raise RuntimeError(f'main.py exited with {process.returncode}')
+
+        records_written = count_written_records(cwd)
+
+    return {'peers': nodes.peers, 'seconds': seconds, 'elapsed': round(elapsed, 3),
+            'peersPerSecond': round(nodes.peers / elapsed, 3), 'recordsSent': nodes.records_sent,
+            'recordsWritten': records_written, 'recordsPerSecond': round(records_written / elapsed, 1),
+            'bytesPerSecond': round(nodes.bytes_sent / elapsed, 1), 'peakRssKiB': peak_rss_of_children(),
+            'arguments': ' '.join(scan_arguments)}
+
+
+def parse_arguments():
+    """
+    Returns:
+        (tuple): tuple containing:
+            Namespace: The arguments of the benchmark.
+            list: The arguments for main.py.
+    """
+    parser = argparse.ArgumentParser(description='Benchmark main.py against simulated bitcoin nodes on localhost. '
+                                                 'Unknown arguments are passed to main.py.')
+    parser.add_argument('--peers', type=int, default=200, help='Number of simulated nodes')
+    parser.add_argument('--port', type=int, default=20000, help='Port of the first simulated node')
+    parser.add_argument('--seconds', type=float, default=10, help='Time frame per node in seconds')
+    parser.add_argument('--addr-rate', type=float, default=10,
+                        help='Addresses per second every node sends without being asked')
+    parser.add_argument('--addr-size', type=int, default=10,
+                        help='Addresses per addr message, more than 10 are counted as response to getaddr')
+    parser.add_argument('--getaddr-size', type=int, default=1000, help='Addresses in the response to getaddr')
+    parser.add_argument('--latency', type=float, default=0, help='Seconds before every response of a node')
+    parser.add_argument('--pool-size', type=int, default=100000, help='Number of different addresses')
+    parser.add_argument('--report', help='csv file the result is appended to')
+    return parser.parse_known_args()
+
+
+if __name__ == "__main__":
+    args, scan_arguments = parse_arguments()
+    logging.basicConfig(level=logging.ERROR)
+
+    raise_open_files_limit()
+    nodes = SimulatedNodes(args.port, args.peers, args.addr_rate, args.addr_size, args.getaddr_size, args.latency,
+                           args.pool_size)
+    result = asyncio.run(run_benchmark(nodes, args.seconds, scan_arguments))
+
+    for key, value in result.items():
+        print(f'{key}: {value}')
+
+    if args.report:
+        if not os.path.exists(args.report):
+            write_to_file(args.report, '', BENCHMARK_HEADER)
+        append_to_file(args.report, ','.join(str(result[key]) for key in BENCHMARK_HEADER.split(',')) + '\n')
@@ -0,0 +1,187 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from bitScan.serializer import Serializer
+from bitScan.utils import *
+
+"""Binary output format for received addresses.
+
+Every address is a fixed-width record (little-endian, no padding):
+    ip (16 bytes), port (2 bytes), services (8 bytes), timestamp (4 bytes), receive time (8 bytes float),
+    peer id (4 bytes)
+The peer id refers to the bitcoin node we received the address from. The peers are written to OUTPUT_PEERS.
+"""
+
+RECORD = struct.Struct('<16sHQIdI')
+RECORD_DTYPE = [('ip', 'S16'), ('port', '<u2'), ('services', '<u8'), ('timestamp', '<u4'),
+                ('receive_time', '<f8'), ('peer_id', '<u4')]
+PEERS_HEADER = 'peer_id,host,port'
+
+
+class BinaryOutput(object):
+    """Packs records from Serializer.deserialize_addr_records into the binary output format.
+
+    Args:
+        peers_file (file): Open text file for the peer dictionary.
+
+    Attributes:
+        peer_ids (dict): Peer id for every (host, port) we received addresses from.
+    """
+
+    def __init__(self, peers_file):
+        self.peers_file = peers_file
+        self.peer_ids = {}
+
+    def peer_id(self, peer):
+        """Return the id of a peer and add it to the peer dictionary if it is new.
+
+        Args:
+            peer (tuple): host, port
+
+        Returns:
+            int: The peer id.
+        """
+        peer_id = self.peer_ids.get(peer)
+        if peer_id is None:
+            peer_id = self.peer_ids[peer] = len(self.peer_ids)
+            self.peers_file.write(f'{peer_id},{peer[0]},{peer[1]}\n')
+            self.peers_file.flush()
+
+        return peer_id
+
+    def pack(self, peer, current_time, records):
+        """
+        Note:
+            Like the decoding in AddrBatch.from_entries, every field is copied with extended slices instead of
+            packing the records one by one.
+
+        Args:
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+
+        Returns:
+            bytearray: The packed records.
+        """
+        count = len(records)
+        constants = struct.pack('<dI', current_time, self.peer_id(peer))
+        fields = [(records.ips, 16), (little_endian(records.ports), 2), (little_endian(records.services), 8),
+                  (little_endian(records.timestamps), 4)]
+
+        data = bytearray(RECORD.size * count)
+        offset = 0
+        for values, size in fields:
+            for k in range(size):
+                data[offset + k::RECORD.size] = values[k::size]
+            offset += size
+        for k, value in enumerate(constants):
+            data[offset + k::RECORD.size] = bytes((value,)) * count
+
+        return data
+
+
+def little_endian(values):
+    """
+    Args:
+        values (array): Integer column of an AddrBatch.
+
+    Returns:
+        bytes: The values in little-endian byte order.
+    """
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+
+    return values.tobytes()
+
+
+def read_peers(peers_location):
+    """
+    Args:
+        peers_location (str): The path to the peer dictionary.
+
+    Returns:
+        dict: host, port for every peer id.
+    """
+    return {int(row[0]): (row[1], row[2]) for row in read_file_csv(peers_location)}
+
+
+def iter_records(file_location, chunk_records=1 << 16):
+    """Read a binary output file in chunks.
+
+    Note:
+        If NumPy is installed, the file is memory-mapped and every chunk is a structured array with the fields
+        of RECORD_DTYPE. Otherwise every chunk is a list of tuples in the order of RECORD.
+
+    Args:
+        file_location (str): The path to the binary output file.
+        chunk_records (int): Number of records per chunk.
+
+    Yields:
+        A chunk of records.
+    """
+    size = os.path.getsize(file_location)
+    count = size // RECORD.size
+    if count == 0:
+        return
+
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+
+    if numpy is not None:
+        records = numpy.memmap(file_location, dtype=numpy.dtype(RECORD_DTYPE), mode='r', shape=(count,))
+        for start in range(0, count, chunk_records):
+            yield records[start:start + chunk_records]
+        return
+
+    with open(file_location, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        view = memoryview(data)
+        try:
+            for start in range(0, count, chunk_records):
+                end = min(start + chunk_records, count)
+                yield list(RECORD.iter_unpack(view[start * RECORD.size:end * RECORD.size]))
+        finally:
+            view.release()
+
+
+def convert_to_csv(file_location, peers_location, csv_location):
+    """Convert a binary output file to the csv layout of the output files.
+
+    Args:
+        file_location (str): The path to the binary output file.
+        peers_location (str): The path to the peer dictionary.
+        csv_location (str): The path to the csv file which is created.
+    """
+    logging.info('BIN Convert binary output to csv.')
+
+    serializer = Serializer()
+    peers = read_peers(peers_location)
+
+    with open(csv_location, 'w') as f:
+        f.write(OUTPUT_HEADER + '\n')
+        for chunk in iter_records(file_location):
+            lines = []
+            for ip, port, services, timestamp, receive_time, peer_id in chunk:
+                connected_host, connected_port = peers[int(peer_id)]
+                # NumPy strips trailing zero bytes of the ip
+                host = serializer.format_host(bytes(ip).ljust(16, b'\x00'))
+                lines.append(f'{connected_host},{connected_port},{host},{int(port)},{int(timestamp)},'
+                             f'{float(receive_time)}\n')
+            f.write(''.join(lines))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Convert a binary output file to csv.')
+    parser.add_argument('binary', help='binary output file, e.g. ' + OUTPUT_ADDR_BINARY)
+    parser.add_argument('csv', help='csv file which is created')
+    parser.add_argument('--peers', default=OUTPUT_PEERS, help='peer dictionary of the scan')
+    args = parser.parse_args()
+
+    convert_to_csv(args.binary, args.peers, args.csv)
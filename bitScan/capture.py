@@ -0,0 +1,128 @@
+import itertools
+import logging
+import os
+import struct
+import time
+
+from bitScan.utils import *
+
+"""Capture of the raw data the bitcoin nodes send us.
+
+A capture file starts with CAPTURE_MAGIC and is followed by chunks. Every chunk is a CHUNK header (little-endian,
+no padding) and length bytes of data:
+    kind (1 byte), connection id (8 bytes), receive time (8 bytes float), length (4 bytes)
+The kinds are:
+    OPEN   the data is 'host,port' of the node, written before the first data of a connection
+    DATA   the data as it was received from the socket
+    CLOSE  no data, the connection was closed
+The connection id contains the process id, so the chunks of several processes can be replayed together.
+The chunks are appended in the order they were received, replay.py feeds them through the decoding again.
+"""
+
+CAPTURE_MAGIC = b'BSCAP1\n'
+CHUNK = struct.Struct('<BQdI')
+OPEN, DATA, CLOSE = 0, 1, 2
+
+
+class CaptureFile(object):
+    """Appends the received data of all connections of a process to a capture file.
+
+    Note:
+        Disabled by default, every call returns immediately until open is called. The chunks are written
+        with the buffer of the file, which is flushed when a connection is closed.
+
+    Attributes:
+        file (file): The open capture file. None if capturing is disabled.
+        ids (iterator): Source of the connection ids of this process.
+    """
+
+    def __init__(self):
+        self.file = None
+        self.ids = None
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def open(self, file_location):
+        """Start capturing. An existing file is continued.
+
+        Args:
+            file_location (str): The path to the capture file.
+        """
+        logging.info('CAPTURE Open %s.', file_location)
+
+        new = not os.path.exists(file_location) or os.path.getsize(file_location) == 0
+        self.file = open(file_location, 'ab')
+        if new:
+            self.file.write(CAPTURE_MAGIC)
+        self.ids = itertools.count(os.getpid() << 32)
+
+    def record(self, conn, data, current_time=None):
+        """
+        Args:
+            conn (Connection): The connection which received the data.
+            data (bytes): The received data.
+            current_time (float): The receive time the connection uses for the data, so a replay writes the
+                same output. Default now.
+        """
+        if self.file is None or not data:
+            return
+
+        now = time.time() if current_time is None else current_time
+        if conn.capture_id is None:
+            conn.capture_id = next(self.ids)
+            peer = f'{conn.to_addr[0]},{conn.to_addr[1]}'.encode()
+            self.file.write(CHUNK.pack(OPEN, conn.capture_id, now, len(peer)) + peer)
+        self.file.write(CHUNK.pack(DATA, conn.capture_id, now, len(data)))
+        self.file.write(data)
+
+    def close_connection(self, conn):
+        """
+        Args:
+            conn (Connection): The connection which is closed.
+        """
+        if self.file is None or conn.capture_id is None:
+            return
+
+        self.file.write(CHUNK.pack(CLOSE, conn.capture_id, time.time(), 0))
+        self.file.flush()
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+CAPTURE = CaptureFile()
+
+
+def read_capture(file_location):
+    """Read the chunks of a capture file.
+
+    Note:
+        A chunk which was cut off because the scanner was killed ends the file.
+
+    Args:
+        file_location (str): The path to the capture file.
+
+    Yields:
+        (tuple): tuple containing:
+            receive_time (float): The time the data was received.
+            kind (int): OPEN, DATA or CLOSE.
+            connection_id (int): The connection the data belongs to.
+            data (bytes): The data of the chunk.
+    """
+    with open(file_location, 'rb') as f:
+        if f.read(len(CAPTURE_MAGIC)) != CAPTURE_MAGIC:
+            raise ValueError(f'{file_location} is not a capture file.')
+        while True:
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            kind, connection_id, receive_time, length = CHUNK.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                logging.error('CAPTURE %s ends with an incomplete chunk.', file_location)
+                return
+            yield receive_time, kind, connection_id, data
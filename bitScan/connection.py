@@ -1,13 +1,16 @@
-import re
+import selectors
 import socket
 import logging
 import time
 
-from io import BytesIO
-from binascii import hexlify
-from multiprocessing import Lock
-
-from bitScan.serializer import Serializer
+from bitScan.capture import CAPTURE
+from bitScan.serializer import Serializer, AddrBatch
+from bitScan.framer import MessageFramer
+from bitScan.handshake import Handshake
+from bitScan.profiling import PROFILER
+from bitScan.retry import RetryPolicy
+from bitScan.session import SessionPolicy
+from bitScan.timers import TimerWheel
 from bitScan.utils import *
 
 
@@ -25,77 +28,136 @@ class Connection(object):
             host (str): Host
             port (int): Port
         serializer (obj): Serializer object for this connection.
+        framer (MessageFramer): Splits the received data into messages.
         socket (obj): Socket for communication with a bitcoin node.
         handshake_done (bool): Indicates if the handshake with the bitcoin node was successful.
+        handshake_latency (float): Seconds the handshake took. None until it is done.
+        capture_id (int): Id of the connection in the capture file, see CaptureFile. None until data is captured.
+        timers (list): The periodic timers of the session, see start_timers.
+        session_timer (Timer): The next check of the end of the session.
+        session_over (bool): Indicates if communicate has to return.
     """
 
     def __init__(self, to_addr):
-        logging.info(f'CONN Create connection to {to_addr[0]},{to_addr[1]}.')
+        logging.info('CONN Create connection to %s,%s.', to_addr[0], to_addr[1])
 
         self.to_addr = to_addr
         self.from_addr = ('0.0.0.0', 0)
         self.serializer = Serializer()
+        self.framer = MessageFramer(self.serializer)
         self.socket = None
         self.handshake_done = False
+        self.handshake_latency = None
+        self.capture_id = None
+        self.timers = []
+        self.session_timer = None
+        self.session_over = False
 
-    def open(self, timeout):
+    def open(self, timeout, retry=None, attempts=None):
         """Create connection to a bitcoin node.
 
         Note:
             The address of the bitcoin node is taken from to_addr. The active connection is accessible
             through self.socket.
 
-            If creating of a connection fails, try it again.
+            If creating of a connection fails, try it again after the delay of retry until the attempts are
+            used up or time is over.
 
         Args:
             timeout (int): The time when we want to shutdown in seconds.
+            retry (RetryPolicy): Timeout per attempt, delays and number of attempts. Default RetryPolicy().
+            attempts (int): Maximum number of attempts of this call, default retry.max_attempts. 1 leaves the
+                retrying to the caller, see ParkingLot.
         """
         logging.info('CONN Open connection.')
 
-        try:
-            self.socket = socket.create_connection(self.to_addr)
-            self.socket.settimeout(20)
-        except (socket.timeout, socket.error):
-            logging.error(f"Creating connection to {self.to_addr[0]}, {self.to_addr[1]} failed. Try again.")
-            if time.time() < timeout:
-                self.open(timeout)
-            else:
-                raise ConnectionError
+        retry = retry or RetryPolicy()
+        attempts = attempts or retry.max_attempts
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                self.socket = socket.create_connection(self.to_addr, retry.attempt_timeout(timeout))
+                self.socket.settimeout(20)
+                return
+            except (socket.timeout, socket.error) as err:
+                logging.error("Creating connection to %s,%s failed: %s", self.to_addr[0], self.to_addr[1], err)
+                if attempt >= attempts or retry.exhausted(attempt, timeout):
+                    raise ConnectionError
+                time.sleep(retry.delay(attempt))
 
     def close(self):
         logging.info("Close connection if active.")
+        CAPTURE.close_connection(self)
         if self.socket:
             self.socket.close()
 
     def handshake(self, timeout):
-        """Send and then receive version/verrack message from a bitcoin node.
+        """Send our version message and receive version/verack from a bitcoin node.
 
         Note:
-            To send a message it must be first serialized.
-            When receiving a message it must be deserialized to be readable.
-            Try until time is over.
+            Other messages the node sends before the handshake is done are accepted, see Handshake.
+            Messages after the verack stay in the framer for communicate.
 
         Args:
             timeout (int): The time when we want to shutdown in seconds.
 
         Returns:
-            list: The response of the handshake in a readable format.
+            dict: The version payload of the node, see Serializer.deserialize_version_payload.
         """
         logging.info("CONN Make handshake.")
 
-        payload_version = self.serializer.serialize_version_payload(self.to_addr, self.from_addr)
-        msg = self.serializer.create_message('version', payload_version)
-        self.socket.sendall(msg)
+        handshake = Handshake(self.serializer)
+        self.send_message(handshake.start(self.to_addr, self.from_addr))
+        deadline = handshake.deadline(timeout)
 
-        # <<< [header version 24 bytes][version 102 bytes] [verack 24 bytes]
         try:
-            return self.get_version_verack(timeout, length=150, commands=['version', 'verack'])
+            while not handshake.done:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise ConnectionError("Handshake timed out.")
+                self.socket.settimeout(remaining)
+                data = self.socket.recv(SOCKET_BUFFER)
+                if not data:
+                    raise ConnectionError("Node closed the connection during the handshake.")
+                self.process_handshake(data, handshake)
+        except socket.timeout:
+            raise ConnectionError("Handshake timed out.")
         except HandshakeContentError as err:
-            logging.error(err)
-            if time.time() < timeout:
-                self.handshake(timeout)
-            else:
-                raise ConnectionError
+            raise ConnectionError(err)
+        finally:
+            self.socket.settimeout(20)
+
+        return self.finish_handshake(handshake)
+
+    def process_handshake(self, data, handshake):
+        """Hand the complete messages in the received data to the handshake and send its replies.
+
+        Args:
+            data (bytes): The received data.
+            handshake (Handshake): The state of the handshake.
+        """
+        CAPTURE.record(self, data)
+        self.framer.feed(data)
+        for header, payload in self.framer.messages():
+            for reply in handshake.receive(header, payload):
+                self.send_message(reply)
+            if handshake.done:
+                break
+
+    def finish_handshake(self, handshake):
+        """
+        Args:
+            handshake (Handshake): The completed handshake.
+
+        Returns:
+            dict: The version payload of the node.
+        """
+        self.handshake_done = True
+        self.handshake_latency = handshake.latency
+        logging.info('CONN Handshake with %s,%s done in %.3f seconds, other messages: %s', self.to_addr[0],
+                     self.to_addr[1], handshake.latency, handshake.other_messages)
+        return handshake.version
 
     def send_getaddr(self):
         """Send getaddr message.
@@ -107,260 +169,246 @@ class Connection(object):
 
         # getaddr
         logging.info("Send getaddr.")
-        msg = self.serializer.create_message('getaddr', b'')
+        msg = self.serializer.constant_message('getaddr')
+        self.send_message(msg)
+
+    def send_message(self, msg):
+        """Send an already serialized message.
+
+        Note:
+            All outgoing messages go through here, so subclasses only have to replace this method to
+            change the transport.
+
+        Args:
+            msg (bytes): The message created with Serializer.create_message.
+        """
         self.socket.sendall(msg)
 
-    def get_version_verack(self, timeout, length=0, commands=None):
-        """Receive data from a bitcoin node.
+    def communicate(self, timeout, content_addr_msg, writer, interval_getaddr=-1, interval_addr=-1,
+                    policy=None):
+        """Send getaddr and addr messages in a time interval and listen permanently for incoming addr messages.
 
         Note:
-            Is only used for version/verack.
-            More than one message can be received. When receiving a verack message there is no payload,
-            therefore only the header has to be deserialized.
-            If a version message is received, send a verack message immediately.
-            Because it is possible, that we receive more than the messages we want to handle further, we
-            filter the response in the end.
+            Pings, getaddr and addr messages and the end of the session are timers of a TimerWheel, see
+            start_timers. A selector waits for data at most until the next tick of the wheel, so received data
+            is processed at once and the timers fire on time even if the node sends nothing. The sends of the
+            timers keep the timeout of the socket.
+            Incomplete messages stay in the framer until the rest is received.
+            Hands the messages to the writer after every received data.
+            Stops when the session is over or the node closed the connection.
 
         Args:
-            length (int): Number of how many bytes we want to read.
-            commands (list): List of the type of the message(s) we want to receive.
-            timeout (int): The time when we want to shutdown in seconds.
+            timeout (int): The Time when we have to shutdown.
+            content_addr_msg (AddrTemplate): The addr messages we send.
+            writer (OutputWriter|QueueWriter|CallbackWriter): Gets the received addresses, see deliver.
+            interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+            interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+            policy (SessionPolicy): Decides when the session ends, see SessionPolicy. Default SessionPolicy(),
+                which ends it at timeout.
 
         Returns:
-            A readable format of all message we got. [msg1, msg2, ...]
-            msg = {<headerValues>, <payload>}
+            (tuple): tuple containing:
+                addr_count (int): Number of received addresses from voluntary addr messages.
+                getaddr_count (int): Number of received addresses from responses to getaddr messages.
         """
-        logging.info("CONN Receive data from a bitcoin node.")
-
-        data, current_time = self.recv_version_verack(timeout, length)
-        length = len(data)
-        data = BytesIO(data)
-        msgs = []
-
-        # read until buffer is empty
-        while length > 0:
-            msg = self.serializer.deserialize_header(data.read(HEADER_LEN))
-
-            if (length - HEADER_LEN) < msg['length']:
-                raise HandshakeContentError(
-                    "Payload is to short. Got {} of {} bytes".format(length, HEADER_LEN + msg['length']))
-
-            if MAGIC_NUMBER_COMPARE != msg['magic_number']:
-                raise HandshakeContentError(
-                    "Wrong magic value. Is {}, should be ".format(msg['magic_number'], MAGIC_NUMBER_COMPARE))
-
-            payload = data.read(msg['length'])
-            computed_checksum = sha256_util(sha256_util(payload))[:4]
-            if computed_checksum != msg['checksum']:
-                raise HandshakeContentError(
-                    "Invalid checksum. {} != {}".format(hexlify(computed_checksum), hexlify(msg['checksum'])))
-
-            if msg['command'] == 'version':
-                msg.update({'payload': self.serializer.deserialize_version_payload(payload)})
-                self.socket.sendall(self.serializer.create_message('verack', b''))
-            else:
-                unused_chunk = payload
+        logging.info("CONN Start communication.")
+
+        counts = {'addr': 0, 'getaddr': 0}
+        session = (policy or SessionPolicy()).start(time.time(), timeout)
+        wheel = TimerWheel()
 
-            msgs.append(msg)
-            length -= (HEADER_LEN + msg['length'])
+        # messages which arrived together with the verack are already in the framer
+        current_time = time.time()
+        self.deliver(writer, session, counts, current_time, *self.process_data(b'', current_time))
+        self.start_timers(wheel, session, content_addr_msg, writer, interval_getaddr, interval_addr)
 
-        # filter response
-        if len(msgs) > 0 and commands:
-            msgs[:] = [m for m in msgs if m.get('command') in commands]
+        selector = selectors.DefaultSelector()
+        selector.register(self.socket, selectors.EVENT_READ)
+        try:
+            while not self.session_over:
+                try:
+                    if not selector.select(wheel.until_next_tick()):
+                        # the next tick of the timers is due
+                        wheel.advance()
+                        continue
+                    start = PROFILER.start()
+                    data = self.socket.recv(SOCKET_BUFFER)
+                    current_time = time.time()
+                    PROFILER.stop('recv', start)
+                    if not data:
+                        raise PingError
+
+                    addr_records, getaddr_records = self.process_data(data, current_time)
+                    # save message to file
+                    start = PROFILER.start()
+                    self.deliver(writer, session, counts, current_time, addr_records, getaddr_records)
+                    PROFILER.stop('write', start)
+                except PingError as err:
+                    logging.error(
+                        "PingError with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1], err))
+                    break
+                wheel.advance()
+        finally:
+            selector.close()
+            self.stop_timers()
+
+        return counts['addr'], counts['getaddr']
+
+    def start_timers(self, wheel, session, content_addr_msg, writer, interval_getaddr=-1, interval_addr=-1):
+        """Send the first getaddr and addr messages and schedule the next ones, the pings and the end of the session.
+
+        Args:
+            wheel (TimerWheel): Fires the timers of the connection.
+            session (Session): State of the session, see SessionPolicy.
+            content_addr_msg (AddrTemplate): The addr messages we send.
+            writer (OutputWriter|QueueWriter|CallbackWriter): Gets notified about the sent addr messages.
+            interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+            interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        """
+        self.session_over = False
+        self.timers = [wheel.every(PING_INTERVAL, self.keepalive)]
+        if interval_getaddr != -1:
+            self.send_getaddr()
+            self.timers.append(wheel.every(60 * interval_getaddr, self.send_getaddr))
+        if interval_addr != -1:
+            self.inject(content_addr_msg, writer)
+            self.timers.append(wheel.every(60 * interval_addr, self.inject, content_addr_msg, writer))
+        self.schedule_session_check(wheel, session)
+
+    def schedule_session_check(self, wheel, session):
+        """
+        Args:
+            wheel (TimerWheel): Fires the timers of the connection.
+            session (Session): State of the session, see SessionPolicy.
+        """
+        now = time.time()
+        self.session_timer = wheel.schedule(session.next_check(now) - now, self.check_session, wheel, session)
 
-        # log output
-        received = []
-        received[:] = [x.get('command') for x in msgs]
-        logging.info('Received messages: {}'.format(msgs))
+    def check_session(self, wheel, session):
+        """End the session if it is over, else check again when it may be over.
 
-        if received == ['verack', 'version'] or received == ['version', 'verack']:
-            self.handshake_done = True
+        Args:
+            wheel (TimerWheel): Fires the timers of the connection.
+            session (Session): State of the session, see SessionPolicy.
+        """
+        if session.expired(time.time()):
+            self.end_session()
         else:
-            raise HandshakeContentError("Not received version or verack message.")
+            self.schedule_session_check(wheel, session)
 
-        return msgs
+    def stop_timers(self):
+        for timer in self.timers:
+            timer.cancel()
+        if self.session_timer is not None:
+            self.session_timer.cancel()
 
-    def recv_version_verack(self, timeout, length=0):
-        """Receive length data from a socket.
+    def end_session(self):
+        """Make communicate return after the current data.
+        """
+        self.session_over = True
 
-        Note: Only used for version/verack. If no message is received start handshake again.
+    def keepalive(self):
+        """Send a ping, end the session if the connection is broken.
+        """
+        try:
+            self.send_ping()
+        except PingError as err:
+            logging.error("PingError with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1], err))
+            self.end_session()
 
-        Args:
-            timeout (int): The time when we want to shutdown in seconds.
-            length (int): number of how many bytes we want to read
+    def inject(self, template, writer):
+        """Send our addr messages.
 
-        Returns:
-            The receive data in bytes and the current time when receiving the data
+        Args:
+            template (AddrTemplate): The addr messages we send.
+            writer (OutputWriter|QueueWriter|CallbackWriter): Gets notified about the sent addresses.
         """
-        logging.info("CONN Receive length data from a socket.")
-
-        current_time = -1
-        if length > 0:
-            data = b''
-            # receive until length for wanted message is reached
-            while length > 0:
-                chunk = self.socket.recv(SOCKET_BUFFER)
-
-                if not chunk:
-                    time.sleep(1)
-                    chunk = self.socket.recv(SOCKET_BUFFER)
-                    if not chunk:
-                        self.handshake(timeout)
-
-                data += chunk
-                length -= len(chunk)
-        else:
-            current_time = time.time()
-            data = self.socket.recv(SOCKET_BUFFER)
+        self.send_addr(template)
+        if len(template):
+            writer.injected(self.to_addr, time.time())
 
-            if not data:
-                time.sleep(1)
-                data = self.socket.recv(SOCKET_BUFFER)
-                if not data:
-                    self.handshake(timeout)
+    def deliver(self, writer, session, counts, current_time, addr_records, getaddr_records):
+        """Hand the addresses of one received data to the writer.
 
-        return data, current_time
+        Note:
+            Only the number of addresses is kept, so the memory of a session does not grow with its length.
 
-    def communicate(self, timeout, content_addr_msg, lock, interval_getaddr=-1, interval_addr=-1):
-        """Send getaddr and addr messages in a time interval and listen permanently for incoming addr messages.
+        Args:
+            writer (OutputWriter|QueueWriter|CallbackWriter): Gets the received addresses.
+            session (Session): State of the session, see SessionPolicy.
+            counts (dict): Number of received addresses for every kind of data, updated here.
+            current_time (float): The time when the data was received.
+            addr_records (AddrBatch): The received addresses from voluntary addr messages.
+            getaddr_records (AddrBatch): The received addresses from responses to getaddr messages.
+        """
+        for kind, records in (('addr', addr_records), ('getaddr', getaddr_records)):
+            writer.write(kind, self.to_addr, current_time, records)
+            session.observe(current_time, records)
+            counts[kind] += len(records)
+
+    def process_data(self, data, current_time):
+        """Deserialize all addr messages which are complete after receiving data.
 
         Note:
-            If something went wrong during receiving or reading the data then continue with next while round.
-            Writes messages regularly to file.
-            Stops when time is over or connection is not alive anymore because there is no response to ping message.
+            If an addr message can not be deserialized, only this message is skipped.
 
         Args:
-            timeout (int): The Time when we have to shutdown.
-            content_addr_msg (list): The content of the addr message.
-            lock (Lock): Lock for concurrent writing of the files
-            interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
-            interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+            data (bytes): The received data.
+            current_time (float): The time when the data was received.
 
         Returns:
             (tuple): tuple containing:
-                unpacked_addr_msgs (str): The received addresses from voluntary addr messages in a readable format.
-                unpacked_getaddr_msgs (str): The received addresses from responses to getaddr messages in a readable format.
+                addr_records (AddrBatch): The received addresses from voluntary addr messages.
+                getaddr_records (AddrBatch): The received addresses from responses to getaddr messages.
         """
-        logging.info("CONN Start communication.")
-
-        data_buffer = b''
-        unpacked_addr_msgs = ''
-        unpacked_getaddr_msgs = ''
-        time_begin = time.time()
-        last_sent_getaddr = -1
-        last_sent_addr = -1
-        current_time = -1
-
-        while time.time() < timeout:
-            try:
-                current_time = time.time()
-                self.send_ping()
-                data = self.socket.recv(8192)
-                if not data:
-                    raise PingError
-
-                data_buffer += data
-
-                # get minutes
-                now = time.gmtime()[4]
-                # send getaddr message
-                if interval_getaddr != -1 and now != last_sent_getaddr and (
-                        now - time.gmtime(time_begin)[4]) % interval_getaddr == 0:
-                    last_sent_getaddr = now
-                    self.send_getaddr()
-                # send addr message
-                if interval_addr != -1 and now != last_sent_addr and (
-                        now - time.gmtime(time_begin)[4]) % interval_addr == 0:
-                    last_sent_addr = now
-                    self.send_addr(update_timestamps(content_addr_msg))
-
-                data_split = data_buffer.split(MAGIC_NUMBER_COMPARE)
-                write_direct_addr = ''
-                write_direct_getaddr = ''
-                for idx, msg in enumerate(data_split):
-                    if idx != (len(data_split) - 1):
-                        # whole message can be read
-                        if re.compile(b'^addr').match(msg):
-                            response, is_getaddr_response = self.get_deserialized_addr_message(msg, current_time)
-                            if is_getaddr_response:
-                                unpacked_getaddr_msgs += response
-                                write_direct_getaddr += response
-                            else:
-                                unpacked_addr_msgs += response
-                                write_direct_addr += response
-                    else:
-                        # last index; message may be continued
-                        data_buffer = msg
-
-                # save message to file
-                lock.acquire()
-                try:
-                    append_to_file(OUTPUT_ADDR, write_direct_addr)
-                    append_to_file(OUTPUT_GETADDR, write_direct_getaddr)
-                finally:
-                    lock.release()
-            except PingError as err:
-                logging.error(
-                    "PingError with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1], err))
-                break
-            except (MessageContentError, socket.timeout) as err:
-                # start next communication round
-                data_buffer = b''
-                logging.error(
-                    "Error occurred in connection with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1],
-                                                                                      err))
+        CAPTURE.record(self, data, current_time)
+        self.framer.feed(data)
+        addr_records = AddrBatch()
+        getaddr_records = AddrBatch()
+        for header, payload in self.framer.messages():
+            if header['command'] != 'addr':
                 continue
-
-        # deserialize last message received if addr
-        if re.compile(b'^addr').match(data_buffer):
+            start = PROFILER.start()
             try:
-                response, is_getaddr_response = self.get_deserialized_addr_message(data_buffer, current_time)
-                if is_getaddr_response:
-                    unpacked_getaddr_msgs += response
-                else:
-                    unpacked_addr_msgs += response
+                records, is_getaddr_response = self.get_deserialized_addr_message(payload)
             except MessageContentError as err:
                 logging.error(
                     "Error occurred in connection with bitcoin node {},{}: {}".format(self.to_addr[0], self.to_addr[1],
-                                                                                     err))
-                return unpacked_addr_msgs, unpacked_getaddr_msgs
+                                                                                      err))
+                continue
+            finally:
+                PROFILER.stop('decode', start)
+            if is_getaddr_response:
+                getaddr_records.extend(records)
+            else:
+                addr_records.extend(records)
 
-        return unpacked_addr_msgs, unpacked_getaddr_msgs
+        return addr_records, getaddr_records
 
-    def get_deserialized_addr_message(self, msg, current_time):
+    def get_deserialized_addr_message(self, payload):
         """Calls all functions to deserialize an addr message
 
-        Note:
-            the parameter msg contains NO magic number.
-
         Args:
-            msg (bytes): the content of the message.
-            current_time (float): The time when the message was received.
+            payload (memoryview): the payload of the message.
 
         Returns:
-            addr messages in a readable format
+            (tuple): tuple containing:
+                records (AddrBatch): The addresses of the message.
+                is_getaddr_response (bool): Indicates if the message is a response to a getaddr message.
         """
         logging.info("CONN Get deserialized addr message.")
 
-        if msg != b'':
-            msg = BytesIO(msg)
-            header = self.serializer.deserialize_header(MAGIC_NUMBER_COMPARE + msg.read(HEADER_LEN - 4))
-            payload_addr = msg.read(header['length'])
-            return self.serializer.deserialize_addr_payload(payload_addr, current_time, self.to_addr[0],
-                                                            str(self.to_addr[1]))
+        return self.serializer.deserialize_addr_records(payload)
 
-        return ''
-
-    def send_addr(self, addresses):
-        """Send addr message.
+    def send_addr(self, template):
+        """Send addr messages with the current time as timestamp of the addresses.
 
         Args:
-            addresses (list): The content of the addr message.
+            template (AddrTemplate): The addr messages we send.
         """
         logging.info("CONN Send addr.")
-        payload_addr = self.serializer.serialize_addr_payload(addresses)
-        msg = self.serializer.create_message('addr', payload_addr)
-        self.socket.sendall(msg)
+        for msg in template.get_messages():
+            self.send_message(msg)
 
     def send_ping(self):
         """Send ping message.
@@ -369,9 +417,8 @@ class Connection(object):
 
         payload_ping = self.serializer.serialize_ping_payload()
         try:
-            msg = self.serializer.create_message('ping', payload_ping)
-            self.socket.sendall(msg)
-            time.sleep(2)
+            msg = self.serializer.constant_message('ping', payload_ping)
+            self.send_message(msg)
         except (socket.timeout, socket.error):
             raise PingError
 
@@ -0,0 +1,220 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import socket
+
+from bitScan.address_index import address_key
+from bitScan.async_connection import scan_node
+from bitScan.serializer import Serializer
+from bitScan.timers import TimerWheel
+from bitScan.utils import *
+
+
+def pack_host(host):
+    """Pack a host from an input file like a network address in an addr message.
+
+    Args:
+        host (str): ipv4 or ipv6 host.
+
+    Returns:
+        bytes: The 16 byte ip. None if the host is not an ipv4 or ipv6 address.
+    """
+    try:
+        if '.' in host:
+            return IPV4_MAPPED_PREFIX + socket.inet_aton(host)
+        return socket.inet_pton(socket.AF_INET6, host)
+    except OSError:
+        return None
+
+
+def subnet(ip):
+    """
+    Args:
+        ip (bytes): The 16 byte ip.
+
+    Returns:
+        bytes: The /16 of an ipv4 address, the /32 of an ipv6 address.
+    """
+    if ip[:12] == IPV4_MAPPED_PREFIX:
+        return ip[12:14]
+    return ip[:4]
+
+
+class Frontier(object):
+    """The bitcoin nodes which were not contacted yet during a crawl.
+
+    Note:
+        Nodes with a lower depth are contacted first, within the same depth nodes with a newer timestamp in the
+        addr message, because they are more likely to be reachable. An address is only added once, onion
+        addresses are skipped because we can not connect to them directly.
+
+    Args:
+        max_depth (int): Addresses received from a node with this depth are not added anymore. The nodes in
+            getaddr.csv have depth 0.
+        max_peers (int): Maximum number of nodes which are contacted.
+        max_per_subnet (int): Maximum number of nodes which are added per /16 (ipv4) or /32 (ipv6).
+
+    Attributes:
+        heap (list): (depth, -timestamp, sequence number, host, port) for every node not contacted yet.
+        visited (set): address_key of every node which was added.
+        subnets (dict): Number of added nodes per subnet.
+        scheduled (int): Number of nodes which were handed out by pop.
+    """
+
+    def __init__(self, max_depth=2, max_peers=10000, max_per_subnet=16):
+        self.max_depth = max_depth
+        self.max_peers = max_peers
+        self.max_per_subnet = max_per_subnet
+        self.serializer = Serializer()
+        self.heap = []
+        self.visited = set()
+        self.subnets = {}
+        self.scheduled = 0
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def add(self, ip, port, depth, timestamp=0):
+        """Add a node if it was not added before and the limits allow it.
+
+        Args:
+            ip (bytes): The 16 byte ip.
+            port (int): Port
+            depth (int): Number of crawl steps from the nodes in getaddr.csv.
+            timestamp (int): Timestamp of the address in the addr message.
+
+        Returns:
+            bool: Indicates if the node was added.
+        """
+        if depth > self.max_depth or ip[:6] == ONION_PREFIX:
+            return False
+
+        key = address_key(ip, port)
+        if key in self.visited:
+            return False
+
+        net = subnet(ip)
+        if self.subnets.get(net, 0) >= self.max_per_subnet:
+            return False
+
+        self.visited.add(key)
+        self.subnets[net] = self.subnets.get(net, 0) + 1
+        heapq.heappush(self.heap, (depth, -timestamp, next(self.sequence), self.serializer.format_host(ip), port))
+        return True
+
+    def add_records(self, records, depth):
+        """
+        Args:
+            records (AddrBatch): Addresses received from a node.
+            depth (int): Depth of the received addresses.
+        """
+        if depth > self.max_depth:
+            return
+
+        for idx, (timestamp, port) in enumerate(zip(records.timestamps, records.ports)):
+            self.add(records.ip(idx), port, depth, timestamp)
+
+    def pop(self):
+        """
+        Returns:
+            (tuple): host, port, depth of the next node. None if there is no node or max_peers is reached.
+        """
+        if not self.heap or self.scheduled >= self.max_peers:
+            return None
+
+        self.scheduled += 1
+        depth, _, _, host, port = heapq.heappop(self.heap)
+        return host, port, depth
+
+
+class FrontierWriter(object):
+    """Adds the addresses a node sends to the frontier before they are written.
+
+    Args:
+        writer (OutputWriter): Writes the received addresses to the output files.
+        frontier (Frontier): The frontier of the crawl.
+        depth (int): Depth of the addresses we receive, which is the depth of the node plus one.
+    """
+
+    def __init__(self, writer, frontier, depth):
+        self.writer = writer
+        self.frontier = frontier
+        self.depth = depth
+
+    def write(self, kind, peer, current_time, records):
+        """
+        Args:
+            kind (str): The kind of data, 'addr' or 'getaddr'.
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if records:
+            self.frontier.add_records(records, self.depth)
+        self.writer.write(kind, peer, current_time, records)
+
+    def injected(self, peer, current_time):
+        self.writer.injected(peer, current_time)
+
+
+async def run_crawl(addresses, content_addr_msg, writer, frontier, concurrency, minutes, interval_getaddr=1,
+                    interval_addr=-1, retry=None, on_result=None, policy=None):
+    """Scan the nodes in addresses and then the nodes they tell us about until the frontier is empty.
+
+    Args:
+        addresses (iterable): The nodes we start with. Every element is a list host,port.
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        writer (OutputWriter): Writes the received addresses to the output files.
+        frontier (Frontier): Decides which nodes are contacted.
+        concurrency (int): Maximum number of connections open at the same time.
+        minutes (float): Time frame per node in minutes.
+        interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+        interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        retry (RetryPolicy): Timeout per attempt to connect, delays and number of attempts.
+        on_result (callable): Called with the host, the port, the duration of the connection and the
+            handshake latency of every contacted node as soon as it is done, e.g. DurationWriter.write.
+        policy (SessionPolicy): Decides when the session with a node ends.
+
+    Returns:
+        int: Number of contacted nodes.
+    """
+    for address in addresses:
+        ip = pack_host(address[0])
+        if ip is None:
+            logging.error(f"Host is in the wrong format. Must be ipv4 or ipv6 but is {address[0]}")
+            continue
+        frontier.add(ip, int(address[1]), 0)
+
+    semaphore = asyncio.Semaphore(concurrency)
+    wheel = TimerWheel()
+    driver = asyncio.ensure_future(wheel.run())
+    tasks = set()
+    count = 0
+
+    try:
+        while True:
+            while len(tasks) < concurrency:
+                target = frontier.pop()
+                if target is None:
+                    break
+                host, port, depth = target
+                tasks.add(asyncio.ensure_future(scan_node([host, port], content_addr_msg,
+                                                          FrontierWriter(writer, frontier, depth + 1), semaphore,
+                                                          minutes, interval_getaddr, interval_addr, retry, policy,
+                                                          wheel)))
+
+            if not tasks:
+                break
+
+            done, tasks = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                count += 1
+                if on_result is not None:
+                    on_result(task.result())
+            logging.info('CRAWL %s nodes done, %s open, %s in frontier.', count, len(tasks), len(frontier))
+    finally:
+        driver.cancel()
+
+    return count
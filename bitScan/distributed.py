@@ -0,0 +1,276 @@
+import asyncio
+import base64
+import collections
+import json
+import logging
+import time
+
+from bitScan.async_connection import scan_node
+from bitScan.serializer import AddrBatch
+from bitScan.timers import TimerWheel
+from bitScan.utils import *
+
+"""Distributed scan: one coordinator hands out the nodes of getaddr.csv to workers on other machines.
+
+Coordinator and workers talk over TCP, every message is one line of JSON. The worker asks for nodes, the
+coordinator answers every request:
+    worker:      {"type": "request", "count": 100}
+    coordinator: {"type": "batch", "targets": [["1.2.3.4", 8333], ...]}   nodes to scan
+                 {"type": "wait"}                                        nothing free now, ask again later
+                 {"type": "done"}                                        the scan is finished
+While it scans, the worker sends without waiting for an answer:
+    {"type": "records", "kind": "addr", "peer": [host, port], "time": 1606475361.5, "count": 3,
+     "entries": "<base64 of the addr entries>"}
+    {"type": "injected", "peer": [host, port], "time": 1606475361.5}      we sent the addresses of send_addr.csv
+    {"type": "result", "result": [host, port, duration, handshake latency]}
+    {"type": "heartbeat"}                                                 sent when nothing else was sent for
+                                                                          HEARTBEAT_INTERVAL seconds
+The records of a node are always sent before its result. A side which receives nothing for PEER_TIMEOUT seconds
+considers the other side gone: the coordinator hands out the unfinished nodes of the worker again, the worker
+stops.
+"""
+
+STREAM_LIMIT = 2 * MAX_PAYLOAD_LEN
+# seconds without any message after which a worker sends a heartbeat
+HEARTBEAT_INTERVAL = 10
+# seconds without any message after which the other side is considered gone, e.g. its host died
+PEER_TIMEOUT = 6 * HEARTBEAT_INTERVAL
+
+
+def encode_message(message):
+    return (json.dumps(message, separators=(',', ':')) + '\n').encode()
+
+
+class RemoteWriter(object):
+    """Sends the received addresses of a worker to the coordinator.
+
+    Note:
+        Every call is sent as a message line, the addresses as base64 of their addr entries. The
+        coordinator passes it to its OutputWriter. There is no finish, run_worker sends the result of
+        every node itself.
+
+    Args:
+        writer (StreamWriter): The connection to the coordinator.
+
+    Attributes:
+        last_sent (float): Monotonic time of the last message, see heartbeat.
+    """
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.last_sent = time.monotonic()
+
+    def write(self, kind, peer, current_time, records):
+        """
+        Args:
+            kind (str): The kind of data, 'addr' or 'getaddr'.
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if records:
+            self.send({'type': 'records', 'kind': kind, 'peer': peer, 'time': current_time, 'count': len(records),
+                       'entries': base64.b64encode(records.to_entries()).decode()})
+
+    def injected(self, peer, current_time):
+        self.send({'type': 'injected', 'peer': peer, 'time': current_time})
+
+    def heartbeat(self):
+        """Tell the coordinator we are alive if we sent nothing for HEARTBEAT_INTERVAL seconds.
+        """
+        if time.monotonic() - self.last_sent >= HEARTBEAT_INTERVAL:
+            self.send({'type': 'heartbeat'})
+
+    def send(self, message):
+        self.writer.write(encode_message(message))
+        self.last_sent = time.monotonic()
+
+
+class Coordinator(object):
+    """Hands out the nodes to the workers and writes everything they send.
+
+    Note:
+        The nodes a worker got and did not finish are handed out again when its connection breaks or it sent
+        nothing for PEER_TIMEOUT seconds. Their addresses received until then stay in the output files.
+
+    Args:
+        addresses (iterable): The nodes we connect to. Every element is a list host,port.
+        output_writer (OutputWriter): Writes the received addresses to the output files.
+        on_result (callable): Called with the host, the port, the duration of the connection and the handshake
+            latency of every node after its addresses were written, e.g. DurationWriter.write.
+
+    Attributes:
+        returned (deque): Nodes of broken workers, they are handed out first.
+        assigned (dict): The unfinished nodes of every connected worker.
+        finished (asyncio.Event): Set when all nodes are finished.
+    """
+
+    def __init__(self, addresses, output_writer, on_result):
+        self.addresses = iter(addresses)
+        self.output_writer = output_writer
+        self.on_result = on_result
+        self.returned = collections.deque()
+        self.assigned = {}
+        self.exhausted = False
+        self.finished = asyncio.Event()
+
+    def next_targets(self, count):
+        """
+        Args:
+            count (int): Maximum number of nodes.
+
+        Returns:
+            list: The next nodes as [host, port].
+        """
+        targets = []
+        while self.returned and len(targets) < count:
+            targets.append(self.returned.popleft())
+        while not self.exhausted and len(targets) < count:
+            address = next(self.addresses, None)
+            if address is None:
+                self.exhausted = True
+            else:
+                targets.append([address[0], int(address[1])])
+        return targets
+
+    def check_finished(self):
+        if self.exhausted and not self.returned and not any(self.assigned.values()):
+            self.finished.set()
+
+    async def handle(self, reader, writer):
+        """Serve one worker until its connection breaks.
+        """
+        worker = writer.get_extra_info('peername')
+        assigned = self.assigned[worker] = set()
+        logging.info('COORD Worker %s connected.', worker)
+
+        try:
+            while True:
+                try:
+                    line = await asyncio.wait_for(reader.readline(), PEER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logging.error('Worker %s sent nothing for %s seconds.', worker, PEER_TIMEOUT)
+                    break
+                if not line:
+                    break
+                message = json.loads(line)
+
+                if message['type'] == 'records':
+                    records = AddrBatch.from_entries(base64.b64decode(message['entries']), message['count'])
+                    self.output_writer.write(message['kind'], tuple(message['peer']), message['time'], records)
+                elif message['type'] == 'injected':
+                    self.output_writer.injected(tuple(message['peer']), message['time'])
+                elif message['type'] == 'result':
+                    host, port, duration_of_connection, handshake_latency = message['result']
+                    assigned.discard((host, port))
+                    self.output_writer.finish((host, port), duration_of_connection, handshake_latency)
+                    self.on_result((host, port, duration_of_connection, handshake_latency))
+                    self.check_finished()
+                elif message['type'] == 'request':
+                    targets = self.next_targets(message['count'])
+                    assigned.update((host, port) for host, port in targets)
+                    # the last results may have come in before the targets ran out
+                    self.check_finished()
+                    if targets:
+                        writer.write(encode_message({'type': 'batch', 'targets': targets}))
+                    elif self.finished.is_set():
+                        writer.write(encode_message({'type': 'done'}))
+                    else:
+                        writer.write(encode_message({'type': 'wait'}))
+                    await writer.drain()
+        except (OSError, ValueError, KeyError) as err:
+            logging.error('Connection to worker %s broken: %s', worker, err)
+        finally:
+            del self.assigned[worker]
+            if assigned:
+                logging.error('Worker %s left %s unfinished nodes, they are handed out again.', worker,
+                              len(assigned))
+                self.returned.extend([host, port] for host, port in assigned)
+            writer.close()
+            self.check_finished()
+
+    async def run(self, host, port):
+        """Serve workers until all nodes are finished.
+
+        Args:
+            host (str): The address the coordinator listens on.
+            port (int): The port the coordinator listens on.
+        """
+        server = await asyncio.start_server(self.handle, host, port, limit=STREAM_LIMIT)
+        logging.info('COORD Listening on %s,%s.', host, port)
+        async with server:
+            self.check_finished()
+            await self.finished.wait()
+            # the workers ask once more, get 'done' and disconnect
+            for _ in range(100):
+                if not self.assigned:
+                    break
+                await asyncio.sleep(0.1)
+
+
+async def run_worker(host, port, content_addr_msg, concurrency, minutes, interval_getaddr=-1, interval_addr=-1,
+                     retry=None, batch_size=100, policy=None):
+    """Scan the nodes the coordinator hands out until the coordinator says the scan is done.
+
+    Args:
+        host (str): Host of the coordinator.
+        port (int): Port of the coordinator.
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        concurrency (int): Maximum number of connections open at the same time.
+        minutes (float): Time frame per node in minutes.
+        interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+        interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        retry (RetryPolicy): Timeout per attempt to connect, delays and number of attempts.
+        batch_size (int): Maximum number of nodes requested at once.
+        policy (SessionPolicy): Decides when the session with a node ends.
+
+    Returns:
+        int: Number of scanned nodes.
+    """
+    reader, writer = await asyncio.open_connection(host, port, limit=STREAM_LIMIT)
+    remote_writer = RemoteWriter(writer)
+    semaphore = asyncio.Semaphore(concurrency)
+    wheel = TimerWheel()
+    driver = asyncio.ensure_future(wheel.run())
+    tasks = set()
+    count = 0
+
+    async def scan(target):
+        result = await scan_node(target, content_addr_msg, remote_writer, semaphore, minutes, interval_getaddr,
+                                 interval_addr, retry, policy, wheel)
+        remote_writer.send({'type': 'result', 'result': result})
+
+    try:
+        while True:
+            if len(tasks) < concurrency:
+                remote_writer.send({'type': 'request', 'count': min(batch_size, concurrency - len(tasks))})
+                await writer.drain()
+                try:
+                    line = await asyncio.wait_for(reader.readline(), PEER_TIMEOUT)
+                except asyncio.TimeoutError:
+                    raise ConnectionError(f'Coordinator sent nothing for {PEER_TIMEOUT} seconds.')
+                if not line:
+                    raise ConnectionError('Coordinator closed the connection.')
+                message = json.loads(line)
+                if message['type'] == 'done':
+                    break
+                if message['type'] == 'batch':
+                    tasks.update(asyncio.ensure_future(scan(target)) for target in message['targets'])
+                    continue
+
+            if tasks:
+                done, tasks = await asyncio.wait(tasks, timeout=1, return_when=asyncio.FIRST_COMPLETED)
+                count += len(done)
+                for task in done:
+                    task.result()
+            else:
+                await asyncio.sleep(1)
+            remote_writer.heartbeat()
+            await writer.drain()
+    finally:
+        for task in tasks:
+            task.cancel()
+        driver.cancel()
+        writer.close()
+
+    return count
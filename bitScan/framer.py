@@ -0,0 +1,143 @@
+import logging
+
+from binascii import hexlify
+
+from bitScan.profiling import PROFILER
+from bitScan.utils import *
+
+
+class MessageFramer(object):
+    """Splits the received byte stream of a connection into complete messages.
+
+    Note:
+        Received data is appended to one reusable buffer. A message is only handed out when its header and
+        exactly `length` payload bytes are in the buffer and the checksum matches. The payload is a
+        memoryview into the buffer, so it is not copied, but it is only valid until the next message is
+        requested.
+
+        If the magic number, the length or the checksum is wrong, the stream is searched for the next magic
+        number after the broken header. The following messages are therefore not lost.
+
+    Args:
+        serializer (Serializer): Serializer of the connection, used to read the header.
+
+    Attributes:
+        buffer (bytearray): Received data which was not handed out yet.
+        offset (int): Position of the first byte in the buffer which was not handed out yet.
+        errors (int): Number of times the stream had to be resynchronized.
+    """
+
+    def __init__(self, serializer):
+        self.serializer = serializer
+        self.buffer = bytearray()
+        self.offset = 0
+        self.errors = 0
+
+    def feed(self, data):
+        """Append received data to the buffer.
+
+        Note:
+            Handed out data is removed here. This is only done when nothing is left in the buffer or more
+            than half of it was already handed out, so a long message which arrives in many chunks is not
+            moved every time.
+
+        Args:
+            data (bytes): The received data.
+        """
+        if self.offset == len(self.buffer):
+            self.buffer.clear()
+            self.offset = 0
+        elif self.offset > len(self.buffer) // 2:
+            del self.buffer[:self.offset]
+            self.offset = 0
+
+        self.buffer += data
+
+    def messages(self):
+        """Hand out all complete messages in the buffer.
+
+        Note:
+            The generator must be consumed before feed is called again.
+
+        Yields:
+            (tuple): tuple containing:
+                header (dict): The deserialized header, see Serializer.deserialize_header.
+                payload (memoryview): The payload of the message.
+        """
+        view = memoryview(self.buffer)
+        try:
+            while True:
+                start = PROFILER.start()
+                end = self.next_message(view)
+                PROFILER.stop('frame', start)
+                if end == -1:
+                    return
+
+                header = self.serializer.deserialize_header(view[self.offset:self.offset + HEADER_LEN])
+                payload = view[self.offset + HEADER_LEN:end]
+                self.offset = end
+                try:
+                    yield header, payload
+                finally:
+                    payload.release()
+        finally:
+            view.release()
+
+    def next_message(self, view):
+        """Find the next complete and valid message in the buffer.
+
+        Note:
+            Moves self.offset to the beginning of the message.
+
+        Args:
+            view (memoryview): View of the whole buffer.
+
+        Returns:
+            int: The position after the end of the message or -1 if there is no complete message.
+        """
+        while True:
+            if view[self.offset:self.offset + 4] != MAGIC_NUMBER_COMPARE:
+                self.resync(self.offset)
+                if view[self.offset:self.offset + 4] != MAGIC_NUMBER_COMPARE:
+                    return -1
+
+            if len(view) - self.offset < HEADER_LEN:
+                return -1
+
+            length = unpack_util('<I', view[self.offset + 16:self.offset + 20])
+            if length > MAX_PAYLOAD_LEN:
+                logging.error(f"Payload length {length} too large. Resynchronize.")
+                self.resync(self.offset + 1)
+                continue
+
+            end = self.offset + HEADER_LEN + length
+            if len(view) < end:
+                return -1
+
+            checksum = view[self.offset + 20:self.offset + HEADER_LEN]
+            computed_checksum = sha256_util(sha256_util(view[self.offset + HEADER_LEN:end]))[:4]
+            if computed_checksum != checksum:
+                logging.error("Invalid checksum. {} != {}. Resynchronize.".format(hexlify(computed_checksum),
+                                                                                 hexlify(checksum)))
+                self.resync(self.offset + 1)
+                continue
+
+            return end
+
+    def resync(self, start):
+        """Move self.offset to the next magic number at or after start.
+
+        Note:
+            If there is no magic number, only the last bytes are kept because they may be the beginning of
+            a magic number which is continued with the next received data.
+
+        Args:
+            start (int): Position where the search begins.
+        """
+        position = self.buffer.find(MAGIC_NUMBER_COMPARE, start)
+        if position == -1:
+            position = max(start, len(self.buffer) - len(MAGIC_NUMBER_COMPARE) + 1)
+
+        if position != self.offset:
+            self.errors += 1
+        self.offset = position
@@ -0,0 +1,133 @@
+import logging
+import struct
+import time
+
+from bitScan.utils import *
+
+# messages a node may send between version and verack, they announce features and need no answer
+ANNOUNCEMENTS = ('sendheaders', 'wtxidrelay', 'sendaddrv2', 'feefilter', 'sendcmpct')
+
+
+class Handshake(object):
+    """State machine of the version handshake with a bitcoin node.
+
+    Note:
+        Does no I/O, so Connection and AsyncConnection share it. The connection feeds every message from its
+        MessageFramer into receive and sends the returned messages. The handshake is done when the version
+        and the verack message of the node were received, in any order and with any other messages in
+        between.
+
+        For a node which connected to us (accept) the node sends its version first, ours is sent in reply
+        together with the verack, so the verack of the node can only come after its version.
+
+    Args:
+        serializer (Serializer): Serializer of the connection.
+        handshake_timeout (float): Maximum seconds the handshake may take.
+
+    Attributes:
+        state (str): 'new', 'accepting', 'version_sent' or 'done'.
+        addresses (tuple): host, port of the node and of us, for our version message in reply (accept).
+        version (dict): The deserialized version payload of the node. None until it is received.
+        verack_received (bool): Indicates if the verack message of the node was received.
+        other_messages (dict): Number of every other message received during the handshake.
+        started (float): The time the version message was sent, or the connection was accepted.
+        latency (float): Seconds from sending our version message to completing the handshake.
+    """
+
+    def __init__(self, serializer, handshake_timeout=20):
+        self.serializer = serializer
+        self.handshake_timeout = handshake_timeout
+        self.state = 'new'
+        self.addresses = None
+        self.version = None
+        self.verack_received = False
+        self.other_messages = {}
+        self.started = None
+        self.latency = None
+
+    @property
+    def done(self):
+        return self.state == 'done'
+
+    def start(self, to_addr, from_addr):
+        """
+        Args:
+            to_addr (tuple): host, port of the bitcoin node.
+            from_addr (tuple): host, port of us.
+
+        Returns:
+            bytes: Our version message.
+        """
+        self.state = 'version_sent'
+        self.started = time.time()
+        payload_version = self.serializer.serialize_version_payload(to_addr, from_addr)
+        return self.serializer.create_message('version', payload_version)
+
+    def accept(self, to_addr, from_addr):
+        """Wait for the version message of a node which connected to us.
+
+        Args:
+            to_addr (tuple): host, port of the bitcoin node.
+            from_addr (tuple): host, port of us.
+        """
+        self.state = 'accepting'
+        self.started = time.time()
+        self.addresses = (to_addr, from_addr)
+
+    def deadline(self, timeout):
+        """
+        Args:
+            timeout (int): The time when we want to shutdown in seconds.
+
+        Returns:
+            float: The time when the handshake has failed.
+        """
+        return min(timeout, self.started + self.handshake_timeout)
+
+    def receive(self, header, payload):
+        """Handle one message of the node.
+
+        Args:
+            header (dict): The deserialized header, see Serializer.deserialize_header.
+            payload (memoryview): The payload of the message.
+
+        Returns:
+            list: The messages we have to send in reply.
+        """
+        command = header['command']
+        if self.state not in ('accepting', 'version_sent'):
+            raise HandshakeContentError(f"Received {command} in state {self.state}.")
+
+        replies = []
+        if command == 'version' and self.state == 'accepting':
+            # reply with our version before the verack, as the node expects it
+            replies.append(self.serializer.create_message(
+                'version', self.serializer.serialize_version_payload(*self.addresses)))
+            self.state = 'version_sent'
+        if command == 'version':
+            if self.version is not None:
+                raise HandshakeContentError("Received a second version message.")
+            try:
+                self.version = self.serializer.deserialize_version_payload(payload)
+            except (MessageContentError, UnicodeDecodeError, struct.error) as err:
+                # a malformed version message fails this node only, not the scan
+                raise HandshakeContentError(f"Invalid version message: {err}")
+            replies.append(self.serializer.constant_message('verack'))
+        elif command == 'verack':
+            if self.state == 'accepting':
+                raise HandshakeContentError("Received verack before our version message.")
+            self.verack_received = True
+        elif command == 'ping':
+            replies.append(self.serializer.create_message('pong', bytes(payload)))
+        elif command == 'reject':
+            raise HandshakeContentError("Node rejected our version message.")
+        else:
+            if command not in ANNOUNCEMENTS:
+                logging.info('HANDSHAKE Unexpected %s before verack.', command)
+            self.other_messages[command] = self.other_messages.get(command, 0) + 1
+
+        if self.version is not None and self.verack_received:
+            self.state = 'done'
+            self.latency = time.time() - self.started
+
+        return replies
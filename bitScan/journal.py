@@ -0,0 +1,190 @@
+import logging
+import os
+import shutil
+
+from bitScan.binary_output import RECORD, read_peers
+from bitScan.utils import *
+
+JOURNAL_HEADER = 'host,port,duration,handshake,addrEnd,getaddrEnd,addrClean,getaddrClean'
+KINDS = ('addr', 'getaddr')
+
+
+class ScanJournal(object):
+    """Journal of the finished nodes of a scan, written by OutputWriter.
+
+    Note:
+        A line is written for every finished node after the batch which contains its last addresses was
+        written. The line contains the end of the output files at that moment (end) and the beginning of the
+        first address of any node which was not finished at that moment (clean). Before clean there are only
+        addresses of finished nodes, between clean and end there may be addresses of unfinished nodes.
+
+    Args:
+        file_location (str): The path to the journal. Created with JOURNAL_HEADER if it does not exist.
+    """
+
+    def __init__(self, file_location=OUTPUT_JOURNAL):
+        if not os.path.exists(file_location):
+            write_to_file(file_location, '', JOURNAL_HEADER)
+        self.file = open(file_location, 'a')
+
+    def write(self, finished, ends, cleans):
+        """
+        Args:
+            finished (list): (peer, duration of the connection, handshake latency) for every finished node.
+            ends (dict): End of the output file for every kind of data.
+            cleans (dict): Clean offset of the output file for every kind of data.
+        """
+        offsets = f"{ends['addr']},{ends['getaddr']},{cleans['addr']},{cleans['getaddr']}"
+        lines = []
+        for peer, duration, handshake_latency in finished:
+            handshake_latency = '' if handshake_latency is None else handshake_latency
+            lines.append(f'{peer[0]},{peer[1]},{duration},{handshake_latency},{offsets}\n')
+        self.file.write(''.join(lines))
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+def read_journal(file_location=OUTPUT_JOURNAL):
+    """Read the complete lines of a journal.
+
+    Note:
+        A line which was cut off by a crash is removed from the file.
+
+    Args:
+        file_location (str): The path to the journal.
+
+    Returns:
+        list: host, port, duration, handshake latency and the offsets of every line, see JOURNAL_HEADER.
+    """
+    if not os.path.exists(file_location):
+        return []
+
+    with open(file_location, 'r+') as f:
+        lines = f.read().split('\n')
+        # everything after the last line break is incomplete
+        complete = '\n'.join(lines[:-1]) + '\n'
+        if lines[-1]:
+            f.seek(0)
+            f.truncate()
+            f.write(complete)
+
+    rows = []
+    for line in lines[1:-1]:
+        host, port, duration, handshake_latency, *offsets = line.split(',')
+        rows.append((host, int(port), duration, handshake_latency, [int(offset) for offset in offsets]))
+    return rows
+
+
+def resume_outputs(output_format='csv'):
+    """Prepare the output files of an interrupted scan, so it can be continued.
+
+    Note:
+        The output files are cut at the end of the last journal line and the addresses of unfinished nodes
+        between its clean and end offset are removed, because these nodes are scanned again. The duration
+        file is written again from the journal.
+
+    Args:
+        output_format (str): 'csv' or 'binary'.
+
+    Returns:
+        set: (host, port) of every finished node. None if there is no journal, the scan has to start from the
+            beginning.
+    """
+    logging.info('JOURNAL Resume scan.')
+
+    if not os.path.exists(OUTPUT_JOURNAL):
+        logging.error('There is no journal to resume from, start a new scan.')
+        return None
+
+    rows = read_journal()
+    finished = {(host, port) for host, port, _, _, _ in rows}
+    paths = OUTPUT_FILES_BINARY if output_format == 'binary' else OUTPUT_FILES
+    offsets = rows[-1][4] if rows else [0, 0, 0, 0]
+
+    if output_format == 'binary':
+        peers = {peer_id: (host, int(port)) for peer_id, (host, port) in read_peers(OUTPUT_PEERS).items()}
+        keep = {peer_id for peer_id, peer in peers.items() if peer in finished}
+        filter_region = lambda data: filter_binary(data, keep)
+    else:
+        filter_region = lambda data: filter_csv(data, finished)
+
+    for idx, kind in enumerate(KINDS):
+        end, clean = offsets[idx], offsets[idx + len(KINDS)]
+        if output_format == 'csv':
+            # the header is not part of the offsets of an empty journal
+            end, clean = max(end, len(OUTPUT_HEADER) + 1), max(clean, len(OUTPUT_HEADER) + 1)
+        truncate_and_filter(paths[kind], end, clean, filter_region)
+
+    write_to_file(OUTPUT_DURATION, ''.join(f'{host},{duration},{handshake_latency}\n'
+                                           for host, _, duration, handshake_latency, _ in rows), DURATION_HEADER)
+    logging.info('JOURNAL %s nodes are finished.', len(finished))
+
+    return finished
+
+
+def truncate_and_filter(file_location, end, clean, filter_region, chunk_size=1 << 24):
+    """Cut a file at end and filter the data between clean and end.
+
+    Note:
+        The region is filtered in chunks into a temporary file, so it does not have to fit into memory.
+
+    Args:
+        file_location (str): The path to the output file.
+        end (int): The file is cut here.
+        clean (int): The data between clean and end is filtered.
+        filter_region (callable): Gets a chunk and returns the data which is kept and the incomplete rest at
+            the end of the chunk.
+        chunk_size (int): Number of bytes which are filtered at once.
+    """
+    with open(file_location, 'r+b') as f, open(file_location + '.resume', 'w+b') as kept:
+        f.truncate(end)
+        f.seek(clean)
+        rest = b''
+        for position in range(clean, end, chunk_size):
+            data, rest = filter_region(rest + f.read(min(chunk_size, end - position)))
+            kept.write(data)
+
+        f.truncate(clean)
+        f.seek(clean)
+        kept.seek(0)
+        shutil.copyfileobj(kept, f)
+    os.remove(file_location + '.resume')
+
+
+def filter_csv(data, finished):
+    """
+    Args:
+        data (bytes): Lines of a csv output file, the last one may be incomplete.
+        finished (set): (host, port) of every finished node.
+
+    Returns:
+        (tuple): tuple containing:
+            bytes: The lines which were received from finished nodes.
+            bytes: The incomplete last line.
+    """
+    lines = data.split(b'\n')
+    kept = []
+    for line in lines[:-1]:
+        host, port, _ = line.split(b',', 2)
+        if (host.decode(), int(port)) in finished:
+            kept.append(line + b'\n')
+    return b''.join(kept), lines[-1]
+
+
+def filter_binary(data, keep):
+    """
+    Args:
+        data (bytes): Records of a binary output file, the last one may be incomplete.
+        keep (set): Peer ids of the finished nodes.
+
+    Returns:
+        (tuple): tuple containing:
+            bytes: The records which were received from finished nodes.
+            bytes: The incomplete last record.
+    """
+    complete = len(data) - len(data) % RECORD.size
+    kept = b''.join(data[start:start + RECORD.size] for start in range(0, complete, RECORD.size)
+                    if int.from_bytes(data[start + RECORD.size - 4:start + RECORD.size], 'little') in keep)
+    return kept, data[complete:]
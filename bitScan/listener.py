@@ -0,0 +1,168 @@
+import asyncio
+import ipaddress
+import logging
+import time
+
+from bitScan.async_connection import AsyncConnection
+from bitScan.profiling import PROFILER
+from bitScan.timers import TimerWheel
+from bitScan.utils import *
+
+
+def normalize_host(host):
+    """
+    Args:
+        host (str): Host of a peer as reported by the socket.
+
+    Returns:
+        str: The ipv4 host of an ipv4-mapped ipv6 host, which a dual-stack socket reports for ipv4 peers, else
+            host.
+    """
+    mapped = getattr(ipaddress.ip_address(host), 'ipv4_mapped', None)
+    return host if mapped is None else str(mapped)
+
+
+class Listener(object):
+    """Accepts connections of bitcoin nodes and listens to them like to the nodes we connect to.
+
+    Note:
+        An accepted node sends its version first, we answer as responder (Handshake.accept). After the
+        handshake it goes through the same AsyncConnection.communicate as the nodes of the scan, so its
+        addresses are decoded and written the same way. A connection beyond max_connections, or beyond
+        max_per_host from the same host, is closed at once. The session with an inbound node ends like every
+        session, after the time frame or by the policy, or when the listener stops.
+
+    Args:
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        writer (OutputWriter): Writes the received addresses to the output files.
+        minutes (float): Time frame per node in minutes.
+        max_connections (int): Maximum number of inbound connections open at the same time.
+        max_per_host (int): Maximum number of inbound connections from one host open at the same time.
+        interval_getaddr (int): Interval in minutes when we send getaddr messages. -1 implies we never want to send.
+        interval_addr (int): Interval in minutes when we send addr messages. -1 implies we never want to send.
+        policy (SessionPolicy): Decides when the session with a node ends.
+        on_result (callable): Called with the host, the port, the duration of the connection and the
+            handshake latency of every inbound node when it is done, e.g. DurationWriter.write.
+
+    Attributes:
+        connections (set): The open inbound connections.
+        per_host (dict): Number of open inbound connections of every host.
+        accepted (int): Number of accepted connections.
+        rejected (int): Number of connections which were closed because of the limits.
+        wheel (TimerWheel): Fires the timers of the inbound connections.
+    """
+
+    def __init__(self, content_addr_msg, writer, minutes, max_connections=125, max_per_host=1, interval_getaddr=-1,
+                 interval_addr=-1, policy=None, on_result=None):
+        self.content_addr_msg = content_addr_msg
+        self.writer = writer
+        self.minutes = minutes
+        self.max_connections = max_connections
+        self.max_per_host = max_per_host
+        self.interval_getaddr = interval_getaddr
+        self.interval_addr = interval_addr
+        self.policy = policy
+        self.on_result = on_result
+        self.connections = set()
+        self.per_host = {}
+        self.tasks = set()
+        self.accepted = 0
+        self.rejected = 0
+        self.wheel = TimerWheel()
+        self.server = None
+        self.driver = None
+
+    async def start(self, host, port):
+        """Start accepting connections.
+
+        Args:
+            host (str): The address we listen on.
+            port (int): The port we listen on.
+        """
+        self.driver = asyncio.ensure_future(self.wheel.run())
+        self.server = await asyncio.start_server(self.handle, host, port)
+        logging.info('LISTEN Listening on %s,%s.', host, port)
+
+    async def stop(self):
+        """Stop accepting connections, end the open sessions and wait until their nodes are done.
+        """
+        self.server.close()
+        for conn in list(self.connections):
+            conn.end_session()
+        if self.tasks:
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.driver.cancel()
+        logging.info('LISTEN Stopped, %s connections accepted, %s rejected.', self.accepted, self.rejected)
+
+    async def handle(self, reader, writer):
+        """Handshake and communicate with one inbound node.
+        """
+        host, port = writer.get_extra_info('peername')[:2]
+        host = normalize_host(host)
+        if len(self.connections) >= self.max_connections or self.per_host.get(host, 0) >= self.max_per_host:
+            logging.info('LISTEN Reject %s,%s.', host, port)
+            self.rejected += 1
+            writer.close()
+            return
+
+        conn = AsyncConnection((host, port))
+        conn.reader, conn.writer = reader, writer
+        self.accepted += 1
+        self.connections.add(conn)
+        self.per_host[host] = self.per_host.get(host, 0) + 1
+        self.tasks.add(asyncio.current_task())
+        duration_of_connection = 0
+
+        try:
+            timeout = calculate_timeout(self.minutes)
+            start = PROFILER.start()
+            await conn.handshake(timeout, inbound=True)
+            PROFILER.stop('handshake', start)
+            beginning_time = time.time()
+            await conn.communicate(timeout, self.content_addr_msg, self.writer, self.interval_getaddr,
+                                   self.interval_addr, self.policy, self.wheel)
+            duration_of_connection = time.time() - beginning_time
+        except (ConnectionError, OSError) as err:
+            logging.error("Error occurred in connection with inbound bitcoin node %s,%s: %s", host, port, err)
+        except Exception:
+            # like scan_node, the node counts as failed and its result is written
+            logging.exception("Unexpected error in connection with inbound bitcoin node %s,%s", host, port)
+        finally:
+            conn.close()
+            self.connections.discard(conn)
+            self.per_host[host] -= 1
+            if not self.per_host[host]:
+                del self.per_host[host]
+            self.tasks.discard(asyncio.current_task())
+
+        if self.on_result is not None:
+            self.on_result((host, port, duration_of_connection, conn.handshake_latency))
+
+
+async def listen_during(listener, host, port, scan=None, minutes=None):
+    """Accept inbound nodes while a scan runs.
+
+    Args:
+        listener (Listener): Handles the inbound nodes.
+        host (str): The address we listen on.
+        port (int): The port we listen on.
+        scan (coroutine): The scan, e.g. run_scan. None listens without a scan.
+        minutes (float): Listen at least this many minutes, also after the scan is done. None listens as long
+            as the scan runs, or until we are interrupted if there is no scan.
+
+    Returns:
+        The return value of scan.
+    """
+    beginning_time = time.time()
+    await listener.start(host, port)
+    try:
+        result = None
+        if scan is not None:
+            result = await scan
+        if minutes is not None:
+            await asyncio.sleep(max(0.0, beginning_time + 60 * minutes - time.time()))
+        elif scan is None:
+            await asyncio.Event().wait()
+        return result
+    finally:
+        await listener.stop()
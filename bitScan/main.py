@@ -1,7 +1,26 @@
 from bitScan.connection import *
+from bitScan.capture import CAPTURE
+from bitScan.serializer import AddrTemplate
+from bitScan.async_connection import run_scan
+from bitScan.address_index import AddressIndex
+from bitScan.crawler import Frontier, run_crawl
+from bitScan.distributed import Coordinator, run_worker
+from bitScan.journal import resume_outputs
+from bitScan.listener import Listener, listen_during
+from bitScan.profiling import PROFILER
+from bitScan.propagation import PropagationTracker
+from bitScan.retry import ParkingLot, RetryPolicy
+from bitScan.session import SessionPolicy
+from bitScan.shards import run_sharded
+from bitScan.targets import iter_targets
+from bitScan.writer import DurationWriter, OutputWriter, QueueWriter, create_output_files, run_writer
+import argparse
+import asyncio
 import logging
 import time
 import multiprocessing
+import os
+import threading
 
 
 def main(address):
@@ -12,68 +31,437 @@ def main(address):
         address (list): host,port
     Returns:
         (tuple): tuple containing:
-            received_addr (str): The received addresses from voluntary addr messages.
-            received_getaddr (str): The received addresses from responses to getaddr messages.
-            duration_of_connection (float): duration of connection
+            host (str): Host of the bitcoin node.
+            port (int): Port of the bitcoin node.
+            duration_of_connection (float): duration of connection. None if the connection could not be opened,
+                the node is then parked by scan_with_pool.
+            handshake_latency (float): Seconds the handshake took. None if there was no handshake.
     """
     conn = Connection((address[0], int(address[1])))
-    received_addr = ''
-    received_getaddr = ''
     duration_of_connection = 0
 
+    timeout = calculate_timeout(minutes)
     try:
-        # TODO you can set time frame PER NODE here (in minutes)
-        timeout = calculate_timeout(3)
-        conn.open(timeout)
+        start = PROFILER.start()
+        # only one attempt, the worker connects to other nodes until this one may be tried again
+        conn.open(timeout, retry, attempts=1)
+        PROFILER.stop('connect', start)
+    except ConnectionError:
+        writer.write_profile()
+        return conn.to_addr[0], conn.to_addr[1], None, None
+
+    try:
+        start = PROFILER.start()
         conn.handshake(timeout)
+        PROFILER.stop('handshake', start)
         beginning_time = time.time()
-        # TODO you can set interval for sending addr/getaddr messages here
-        a, b = conn.communicate(timeout, content_addr_msg, lock, -1, -1)
+        addr_count, getaddr_count = conn.communicate(timeout, content_addr_msg, writer, interval_getaddr,
+                                                     interval_addr, session_policy)
         end_time = time.time()
 
         duration_of_connection = end_time - beginning_time
-
-        received_addr += a
-        received_getaddr += b
+        logging.info('MAIN Received %s addresses in addr and %s in getaddr responses from %s,%s.', addr_count,
+                     getaddr_count, address[0], address[1])
     # these errors only occur when no connection was made in the first place
     except (ConnectionError, socket.error) as err:
         logging.error("Error occurred in connection with bitcoin node {},{}: {}".format(address[0], address[1], err))
 
     conn.close()
+    writer.write_profile()
+
+    writer.finish(conn.to_addr, duration_of_connection, conn.handshake_latency)
+
+    return conn.to_addr[0], conn.to_addr[1], duration_of_connection, conn.handshake_latency
+
+
+def init_worker(output_queue, profile=False, time_frame=3, retry_policy=None, policy=None, capture=None,
+                intervals=(-1, -1)):
+    """Runs once in every worker process of the pool.
+
+    Args:
+        output_queue (Queue): Queue to the writer process.
+        profile (bool): Indicates if the stages of every connection are measured.
+        time_frame (float): Time frame per node in minutes.
+        retry_policy (RetryPolicy): Timeout per attempt to connect.
+        policy (SessionPolicy): Decides when the session with a node ends.
+        capture (str): If given, the received data is captured to this path with the process id appended.
+        intervals (tuple): Interval in minutes when we send getaddr and addr messages, -1 implies never.
+    """
+    global writer, minutes, retry, session_policy, interval_getaddr, interval_addr
+    writer = QueueWriter(output_queue)
+    minutes = time_frame
+    retry = retry_policy or RetryPolicy()
+    session_policy = policy
+    interval_getaddr, interval_addr = intervals
+    PROFILER.enabled = profile
+    if capture:
+        CAPTURE.open(f'{capture}.{os.getpid()}')
+
+
+def finish_node(result):
+    """Write the journal line and the duration of a node of the asyncio engine.
+
+    Note:
+        All data of the node was already written to output_writer.
+
+    Args:
+        result (tuple): host, port, duration of the connection, handshake latency.
+    """
+    output_writer.finish(result[:2], result[2], result[3])
+    durations.write(result)
+
+
+def scan_target(target):
+    """Task of the pool.
+
+    Note:
+        If this was the last attempt to connect to the node, the node is finished here, after all its data
+        was put into the queue.
+
+    Args:
+        target (tuple): host,port and the number of failed attempts to connect so far.
+
+    Returns:
+        (tuple): target and the return value of main.
+    """
+    host, port, duration_of_connection, handshake_latency = main(target[0])
+    if duration_of_connection is None and target[1] + 1 >= retry.max_attempts:
+        writer.finish((host, port), 0, None)
+    return target, (host, port, duration_of_connection, handshake_latency)
+
+
+class TargetFeed(object):
+    """Lazy input of Pool.imap_unordered.
+
+    Note:
+        The pool reads its input in its own thread as fast as it can. The feed only hands out a node when
+        less than window nodes are in progress, so the target list is read while the scan goes on. Parked
+        nodes are handed out again when they are due. The feed ends when all targets are read and no node
+        is in progress or parked.
+
+    Args:
+        addresses (iterable): The nodes we connect to. Every element is a list host,port.
+        parking_lot (ParkingLot): Nodes whose connection failed.
+        window (int): Maximum number of nodes in progress.
 
-    return address[0], duration_of_connection
+    Attributes:
+        in_progress (int): Number of nodes handed out and not finished yet.
+    """
+
+    def __init__(self, addresses, parking_lot, window):
+        self.addresses = iter(addresses)
+        self.parking_lot = parking_lot
+        self.window = window
+        self.in_progress = 0
+        self.ready = []
+        self.exhausted = False
+        self.condition = threading.Condition()
+
+    def __iter__(self):
+        while True:
+            with self.condition:
+                target = self.wait_for_target()
+            if target is None:
+                return
+            yield target
+
+    def wait_for_target(self):
+        """
+        Returns:
+            tuple: The next target, see scan_target. None if the feed ends.
+        """
+        while True:
+            if self.in_progress < self.window:
+                if not self.ready:
+                    self.ready = self.parking_lot.pop_ready()
+                target = None
+                if self.ready:
+                    target = self.ready.pop(0)
+                elif not self.exhausted:
+                    address = next(self.addresses, None)
+                    if address is None:
+                        self.exhausted = True
+                    else:
+                        target = (address, 0)
+                if target is not None:
+                    self.in_progress += 1
+                    return target
+
+            if self.exhausted and not self.in_progress and not self.parking_lot and not self.ready:
+                return None
+            self.condition.wait(self.parking_lot.wait_time())
+
+    def finish(self, target, connected):
+        """
+        Args:
+            target (tuple): A target which was handed out.
+            connected (bool): Indicates if the connection to the node could be opened.
+
+        Returns:
+            bool: Indicates if the node was parked.
+        """
+        with self.condition:
+            self.in_progress -= 1
+            parked = not connected and self.parking_lot.park(target[0], target[1] + 1)
+            self.condition.notify()
+        return parked
+
+
+def scan_with_pool(pool, processes, addresses, retry_policy, on_result):
+    """Scan all bitcoin nodes with the worker processes of pool.
+
+    Note:
+        The results are handed to on_result in the order the nodes finished. Nodes whose connection failed
+        are parked and given to the workers again after the delay of retry_policy.
+
+    Args:
+        pool (Pool): Worker processes initialized with init_worker.
+        processes (int): Number of worker processes.
+        addresses (iterable): The nodes we connect to. Every element is a list host,port.
+        retry_policy (RetryPolicy): Delays and number of attempts.
+        on_result (callable): Called with the host, the port, the duration of the connection and the
+            handshake latency of every node as soon as it is done, e.g. DurationWriter.write.
+
+    Returns:
+        int: Number of scanned nodes.
+    """
+    feed = TargetFeed(addresses, ParkingLot(retry_policy), 2 * processes)
+    count = 0
 
+    for target, (host, port, duration_of_connection, handshake_latency) in pool.imap_unordered(scan_target, feed):
+        if feed.finish(target, duration_of_connection is not None):
+            continue
+        if duration_of_connection is None:
+            logging.error("Giving up on bitcoin node %s,%s after %s attempts.", target[0][0], target[0][1],
+                          target[1] + 1)
+            duration_of_connection = 0
+        count += 1
+        on_result((host, port, duration_of_connection, handshake_latency))
 
-def write_durations_of_connections_to_file(durations_of_connections):
+    return count
+
+
+def with_listener(scan, args, content_addr_msg, intervals, policy):
+    """
+    Args:
+        scan (coroutine): The scan, e.g. run_scan.
+        args (Namespace): The command line arguments.
+        content_addr_msg (AddrTemplate): The addr messages we send.
+        intervals (tuple): Interval in minutes when we send getaddr and addr messages, -1 implies never.
+        policy (SessionPolicy): Decides when the session with a node ends.
+
+    Returns:
+        coroutine: The scan, together with a Listener for inbound nodes if --listen is given.
+    """
+    if not args.listen:
+        return scan
+    listener = Listener(content_addr_msg, output_writer, args.minutes, args.listen_max_connections,
+                        args.listen_max_per_host, *intervals, policy=policy, on_result=finish_node)
+    host, port = args.listen.rsplit(':', 1)
+    return listen_during(listener, host, int(port), scan, args.listen_minutes)
+
+
+def session_policy_from(args):
     """
     Args:
-        durations_of_connections (list): List of the node address and the duration of the connection
+        args (Namespace): The command line arguments.
+
+    Returns:
+        SessionPolicy: Decides when the session with a node ends.
     """
-    write_to_file(OUTPUT_DURATION, '', 'Node,Duration in seconds')
+    return SessionPolicy(args.min_yield, args.yield_window, args.idle_timeout, args.max_minutes)
 
-    data = ''
-    for node_info in durations_of_connections:
-        data += f'{node_info[0]},{node_info[1]}\n'
 
-    append_to_file(OUTPUT_DURATION, data)
+def parse_arguments():
+    """
+    Returns:
+        Namespace: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Scan the bitcoin network for addr messages.')
+    parser.add_argument('--engine', choices=['pool', 'asyncio', 'sharded'], default='pool',
+                        help='pool: one blocking connection per process, asyncio: many connections per process, '
+                             'sharded: --shards processes with many connections each')
+    parser.add_argument('--targets', default=ADDRESSES_GETADDR,
+                        help='The nodes we connect to, getaddr.csv or a file compiled with targets.py')
+    parser.add_argument('--minutes', type=float, default=3,
+                        help='Time frame per node in minutes')
+    parser.add_argument('--connect-timeout', type=float, default=10,
+                        help='Maximum seconds one attempt to connect to a node may take')
+    parser.add_argument('--max-attempts', type=int, default=5,
+                        help='Attempts to connect to a node, with exponentially growing delays in between')
+    parser.add_argument('--interval-getaddr', type=int,
+                        help='Send getaddr every this many minutes, default never (crawl: every minute)')
+    parser.add_argument('--interval-addr', type=int, default=-1,
+                        help='Send the addresses of send_addr.csv every this many minutes, default never')
+    parser.add_argument('--track-propagation', action='store_true',
+                        help='Measure when and from which node the addresses of send_addr.csv come back, written '
+                             'to output_propagation.csv and output_propagation_summary.csv (needs --interval-addr)')
+    parser.add_argument('--min-yield', type=float, default=0,
+                        help='End the session with a node when it sent fewer new addresses per minute during the '
+                             'last --yield-window seconds, and extend it up to --max-minutes while it sends more. '
+                             '0 listens for --minutes to every node')
+    parser.add_argument('--yield-window', type=float, default=60,
+                        help='Seconds over which the new addresses of a node are counted')
+    parser.add_argument('--idle-timeout', type=float,
+                        help='End the session with a node which sent no addresses for this many seconds')
+    parser.add_argument('--max-minutes', type=float,
+                        help='Maximum length of a session extended by --min-yield in minutes')
+    parser.add_argument('--concurrency', type=int, default=1000,
+                        help='Maximum number of open connections for the asyncio engine, divided among the shards '
+                             'for the sharded engine')
+    parser.add_argument('--shards', type=int, default=os.cpu_count() or 1,
+                        help='Sharded engine: number of processes, default the number of CPUs')
+    parser.add_argument('--output-format', choices=['csv', 'binary'], default='csv',
+                        help='binary writes fixed-width records, see binary_output.py')
+    parser.add_argument('--deduplicate', action='store_true',
+                        help='Only write addresses which are new or have a new timestamp, the index of all '
+                             'addresses is written to output_index.csv')
+    parser.add_argument('--crawl', action='store_true',
+                        help='Also connect to the addresses the nodes send us (uses the asyncio engine)')
+    parser.add_argument('--max-depth', type=int, default=2,
+                        help='Crawl: maximum number of steps from the nodes in getaddr.csv')
+    parser.add_argument('--max-peers', type=int, default=10000,
+                        help='Crawl: maximum number of nodes we connect to')
+    parser.add_argument('--max-per-subnet', type=int, default=16,
+                        help='Crawl: maximum number of nodes per /16 (ipv4) or /32 (ipv6)')
+    parser.add_argument('--coordinator', metavar='HOST:PORT',
+                        help='Hand out the nodes to workers which connect to HOST:PORT and write their results')
+    parser.add_argument('--worker', metavar='HOST:PORT',
+                        help='Scan the nodes the coordinator at HOST:PORT hands out (uses the asyncio engine)')
+    parser.add_argument('--batch-size', type=int, default=100,
+                        help='Worker: maximum number of nodes requested from the coordinator at once')
+    parser.add_argument('--listen', metavar='HOST:PORT',
+                        help='Also accept connections of nodes on HOST:PORT and listen to them like to the scanned '
+                             'nodes (asyncio engine and crawl)')
+    parser.add_argument('--listen-minutes', type=float,
+                        help='Listen at least this many minutes, also after the scan is done. Default as long as '
+                             'the scan runs')
+    parser.add_argument('--listen-max-connections', type=int, default=125,
+                        help='Maximum number of inbound connections open at the same time')
+    parser.add_argument('--listen-max-per-host', type=int, default=1,
+                        help='Maximum number of inbound connections from one host open at the same time')
+    parser.add_argument('--resume', action='store_true',
+                        help='Continue an interrupted scan: skip the nodes in scan_journal.csv and append to the '
+                             'output files')
+    parser.add_argument('--capture', metavar='PATH',
+                        help='Append the raw data received from every node to a capture file for replay.py, the '
+                             'pool engine writes one file per process (PATH.<pid>)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Measure the time of every stage (connect, handshake, recv, frame, decode, write) and '
+                             'write the report to output_profile.csv')
+    return parser.parse_args()
 
 
 if __name__ == "__main__":
+    args = parse_arguments()
+    if args.resume and args.crawl:
+        raise SystemExit('--resume can not continue a crawl, the frontier is not saved.')
+    if args.engine == 'sharded' and not (args.crawl or args.coordinator or args.worker) and (
+            args.resume or args.deduplicate or args.track_propagation):
+        raise SystemExit('--resume, --deduplicate and --track-propagation need one writer for all nodes, they '
+                         'can not be used with the sharded engine.')
+    if args.listen and (args.worker or args.coordinator or not (args.crawl or args.engine == 'asyncio')):
+        raise SystemExit('--listen needs the asyncio engine or --crawl.')
+    if args.track_propagation and args.interval_addr == -1:
+        raise SystemExit('--track-propagation needs --interval-addr, otherwise no addresses are sent.')
+    interval_getaddr = -1 if args.interval_getaddr is None else args.interval_getaddr
     logging.basicConfig(level=logging.ERROR, filename=LOG_MAIN)
-    lock = multiprocessing.Lock()
 
-    # create output files
-    log_header = 'connectedToHost,connectedToPort,host,port,timestamp,currentTime'
-    write_to_file(OUTPUT_ADDR, '', log_header)
-    write_to_file(OUTPUT_GETADDR, '', log_header)
+    if args.worker:
+        # the coordinator writes all output files
+        if args.capture:
+            CAPTURE.open(args.capture)
+        host, port = args.worker.rsplit(':', 1)
+        asyncio.run(run_worker(host, int(port), AddrTemplate(Serializer(), read_file_csv(CONTENT_ADDR_SEND)),
+                               args.concurrency, args.minutes, interval_getaddr, args.interval_addr,
+                               retry=RetryPolicy(args.connect_timeout, max_attempts=args.max_attempts),
+                               batch_size=args.batch_size, policy=session_policy_from(args)))
+        raise SystemExit(0)
+
+    finished = resume_outputs(args.output_format) if args.resume else None
+    resumed = finished is not None
+    if not resumed:
+        # create output files
+        create_output_files(args.output_format)
+        finished = set()
+
+    thread_arguments = (address for address in iter_targets(args.targets)
+                        if (address[0], int(address[1])) not in finished)
+    content_addr_msg = AddrTemplate(Serializer(), read_file_csv(CONTENT_ADDR_SEND))
 
-    thread_arguments = read_file_csv(ADDRESSES_GETADDR)
-    content_addr_msg = read_file_csv(CONTENT_ADDR_SEND)
+    PROFILER.enabled = args.profile
+    if args.capture and (args.engine == 'asyncio' or args.crawl):
+        CAPTURE.open(args.capture)
+    retry_policy = RetryPolicy(args.connect_timeout, max_attempts=args.max_attempts)
+    session_policy = session_policy_from(args)
+    tracker = PropagationTracker.from_rows(read_file_csv(CONTENT_ADDR_SEND)) if args.track_propagation else None
+    durations = DurationWriter(resume=resumed)
 
-    # number of threads = number of available CPUs in the system
-    p = multiprocessing.Pool()
-    durations_of_connections = p.map(main, thread_arguments)
-    p.close()
+    if args.crawl:
+        output_writer = OutputWriter(args.output_format, index=AddressIndex() if args.deduplicate else None,
+                                     tracker=tracker)
+        frontier = Frontier(args.max_depth, args.max_peers, args.max_per_subnet)
+        try:
+            crawl_intervals = (1 if args.interval_getaddr is None else args.interval_getaddr, args.interval_addr)
+            asyncio.run(with_listener(run_crawl(thread_arguments, content_addr_msg, output_writer, frontier,
+                                                args.concurrency, args.minutes, *crawl_intervals, retry=retry_policy,
+                                                on_result=finish_node, policy=session_policy),
+                                      args, content_addr_msg, crawl_intervals, session_policy))
+        finally:
+            output_writer.close()
+            durations.close()
+            CAPTURE.close()
+            if args.profile:
+                PROFILER.write_report(OUTPUT_PROFILE)
+    elif args.coordinator:
+        output_writer = OutputWriter(args.output_format, index=AddressIndex() if args.deduplicate else None,
+                                     tracker=tracker)
+        host, port = args.coordinator.rsplit(':', 1)
+        try:
+            asyncio.run(Coordinator(thread_arguments, output_writer, durations.write).run(host, int(port)))
+        finally:
+            output_writer.close()
+            durations.close()
+    elif args.engine == 'sharded':
+        # the durations are merged from the shards
+        durations.close()
+        run_sharded(args.shards, args.output_format, args.concurrency, args.minutes,
+                    (interval_getaddr, args.interval_addr), retry_policy, session_policy, args.profile, args.capture,
+                    args.targets)
+    elif args.engine == 'asyncio':
+        output_writer = OutputWriter(args.output_format, index=AddressIndex() if args.deduplicate else None,
+                                     tracker=tracker)
+        try:
+            asyncio.run(with_listener(run_scan(thread_arguments, content_addr_msg, output_writer, args.concurrency,
+                                               args.minutes, interval_getaddr, args.interval_addr, retry=retry_policy,
+                                               on_result=finish_node, policy=session_policy),
+                                      args, content_addr_msg, (interval_getaddr, args.interval_addr), session_policy))
+        finally:
+            output_writer.close()
+            durations.close()
+            CAPTURE.close()
+            if args.profile:
+                PROFILER.write_report(OUTPUT_PROFILE)
+    else:
+        # one process writes all output files
+        output_queue = multiprocessing.Queue()
+        writer_process = multiprocessing.Process(target=run_writer, args=(output_queue, args.output_format,
+                                                                               args.deduplicate, args.profile),
+                                                 kwargs={'tracker': tracker})
+        writer_process.start()
 
-    write_durations_of_connections_to_file(durations_of_connections)
+        # number of processes = number of available CPUs in the system
+        processes = os.cpu_count() or 1
+        p = multiprocessing.Pool(processes, initializer=init_worker,
+                                 initargs=(output_queue, args.profile, args.minutes, retry_policy, session_policy,
+                                           args.capture, (interval_getaddr, args.interval_addr)))
+        try:
+            scan_with_pool(p, processes, thread_arguments, retry_policy, durations.write)
+        finally:
+            durations.close()
+        p.close()
+        p.join()
 
+        # the workers are stopped, therefore all their data is in the queue
+        output_queue.put(None)
+        writer_process.join()
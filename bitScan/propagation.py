@@ -0,0 +1,160 @@
+import bisect
+import logging
+import time
+
+from bitScan.address_index import address_key
+from bitScan.crawler import pack_host
+from bitScan.serializer import render_host
+from bitScan.utils import *
+
+PROPAGATION_HEADER = 'host,port,firstReturn,latency,firstPeerHost,firstPeerPort,peers'
+PROPAGATION_SUMMARY_HEADER = 'time,injected,returned,peerReturns,firstP50,firstP90,firstMax,allP50,allP90'
+
+
+def quantile(values, q):
+    """
+    Args:
+        values (list): Sorted values.
+        q (float): Quantile between 0 and 1.
+
+    Returns:
+        float: The value of the quantile (nearest rank). None if there are no values.
+    """
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+class PropagationTracker(object):
+    """Measures how fast the addresses of send_addr.csv come back from the network.
+
+    Note:
+        Every received address is looked up in a dictionary of the injected addresses, after a check of the
+        port against the set of injected ports, so most addresses cost one set lookup. The latency of a return
+        is the time from our first addr message with the injected addresses to the first time a peer sends
+        the address. Addresses received before our first addr message are ignored.
+
+    Args:
+        addresses (list): (ip, port) of every injected address, the ip as 16 bytes.
+
+    Attributes:
+        slots (dict): Slot for every address key of an injected address, see address_key.
+        ports (set): The ports of the injected addresses.
+        injected_at (float): The time of our first addr message. None until it is sent.
+        first_returns (list): (time, host, port of the peer) of the first return of every slot. None if the
+            address did not come back yet.
+        peers (list): The peers which sent the address back, for every slot.
+        first_latencies (list): Latency of the first return of every returned address, sorted.
+        latencies (list): Latency of the first return of an address from every peer, sorted.
+        changed (bool): Indicates if there were returns since the last summary line.
+    """
+
+    def __init__(self, addresses):
+        self.addresses = []
+        self.slots = {}
+        for ip, port in addresses:
+            key = address_key(ip, port)
+            if key not in self.slots:
+                self.slots[key] = len(self.addresses)
+                self.addresses.append((ip, port))
+        self.ports = {port for _, port in self.addresses}
+        self.injected_at = None
+        self.first_returns = [None] * len(self.addresses)
+        self.peers = [set() for _ in self.addresses]
+        self.first_latencies = []
+        self.latencies = []
+        self.changed = False
+
+    @classmethod
+    def from_rows(cls, rows):
+        """
+        Args:
+            rows (list): The rows of send_addr.csv: timestamp, services, host, port.
+
+        Returns:
+            PropagationTracker: Tracker of the ipv4 and ipv6 addresses of the rows.
+        """
+        addresses = []
+        for row in rows:
+            ip = pack_host(row[2])
+            if ip is None:
+                logging.error('PROPAGATION Can not track %s.', row[2])
+                continue
+            addresses.append((ip, int(row[3])))
+        return cls(addresses)
+
+    def __len__(self):
+        return len(self.addresses)
+
+    def injected(self, peer, current_time):
+        """
+        Args:
+            peer (tuple): host, port of the bitcoin node we sent the addresses to.
+            current_time (float): The time we sent the addr message.
+        """
+        if self.injected_at is None:
+            logging.info('PROPAGATION Injected %s addresses into %s,%s.', len(self), peer[0], peer[1])
+            self.injected_at = current_time
+
+    def observe(self, peer, current_time, records):
+        """Look up received addresses.
+
+        Args:
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if self.injected_at is None:
+            return
+
+        ports, slots, ips = self.ports, self.slots, records.ips
+        for idx, port in enumerate(records.ports):
+            if port not in ports:
+                continue
+            slot = slots.get(address_key(ips[16 * idx:16 * idx + 16], port))
+            if slot is None or peer in self.peers[slot]:
+                continue
+
+            latency = current_time - self.injected_at
+            self.peers[slot].add(peer)
+            # returns arrive in the order of their latency, so insort mostly appends
+            bisect.insort(self.latencies, latency)
+            if self.first_returns[slot] is None:
+                self.first_returns[slot] = (current_time, peer[0], peer[1])
+                bisect.insort(self.first_latencies, latency)
+            self.changed = True
+
+    def summary(self, now=None):
+        """
+        Args:
+            now (float): The time of the summary. Default the current time.
+
+        Returns:
+            str: One line of PROPAGATION_SUMMARY_HEADER.
+        """
+        now = time.time() if now is None else now
+        first_latencies = self.first_latencies
+        latencies = self.latencies
+        values = [now, len(self), len(first_latencies), len(latencies), quantile(first_latencies, 0.5),
+                  quantile(first_latencies, 0.9), first_latencies[-1] if first_latencies else None,
+                  quantile(latencies, 0.5), quantile(latencies, 0.9)]
+        self.changed = False
+        return ','.join('' if value is None else str(value) for value in values) + '\n'
+
+    def write_table(self, file_location):
+        """Write one line per injected address.
+
+        Args:
+            file_location (str): The path to the file we want to write.
+        """
+        logging.info('PROPAGATION Write table.')
+
+        lines = []
+        for (ip, port), first_return, peers in zip(self.addresses, self.first_returns, self.peers):
+            if first_return is None:
+                lines.append(f'{render_host(ip)},{port},,,,,0\n')
+            else:
+                return_time, peer_host, peer_port = first_return
+                lines.append(f'{render_host(ip)},{port},{return_time},{return_time - self.injected_at},'
+                             f'{peer_host},{peer_port},{len(peers)}\n')
+        write_to_file(file_location, ''.join(lines), PROPAGATION_HEADER)
@@ -0,0 +1,164 @@
+import argparse
+import heapq
+import logging
+import time
+
+from bitScan.capture import CLOSE, DATA, OPEN, read_capture
+from bitScan.connection import Connection
+from bitScan.profiling import PROFILER
+from bitScan.writer import CallbackWriter, OutputWriter, create_output_files
+from bitScan.utils import *
+
+"""Replay of capture files without the bitcoin network, see capture.py.
+
+The captured data of every connection goes through MessageFramer and the decoding of Connection.process_data
+again and the addresses are written to the output files with their original receive times, so a replay of the
+same capture always produces the same files. Without --timing original the data is replayed as fast as
+possible, which measures the decoding on its own.
+
+Example:
+    python replay.py ../input_output/capture.bin --output-format csv
+    python replay.py ../input_output/capture.bin.* --timing original
+"""
+
+
+class Replay(object):
+    """Feeds captured chunks into connections without sockets.
+
+    Args:
+        writer (OutputWriter|CallbackWriter): Gets the decoded addresses.
+        timing (str): 'max' replays as fast as possible, 'original' waits between the chunks as long as the
+            nodes did.
+
+    Attributes:
+        connections (dict): The open connection and its open time for every connection id.
+        chunks (int): Number of replayed chunks.
+        bytes (int): Number of replayed bytes.
+        addresses (int): Number of decoded addresses.
+        finished (int): Number of closed connections.
+    """
+
+    def __init__(self, writer, timing='max'):
+        self.writer = writer
+        self.timing = timing
+        self.connections = {}
+        self.chunks = 0
+        self.bytes = 0
+        self.addresses = 0
+        self.finished = 0
+
+    def run(self, chunks):
+        """
+        Args:
+            chunks (iterable): (receive time, kind, connection id, data), see read_capture.
+        """
+        first_time = None
+        beginning_time = time.time()
+        for receive_time, kind, connection_id, data in chunks:
+            if self.timing == 'original':
+                if first_time is None:
+                    first_time = receive_time
+                delay = beginning_time + receive_time - first_time - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+
+            self.chunks += 1
+            if kind == OPEN:
+                host, port = data.decode().rsplit(',', 1)
+                self.connections[connection_id] = (Connection((host, int(port))), receive_time)
+            elif kind == DATA:
+                self.feed(connection_id, receive_time, data)
+            elif kind == CLOSE:
+                self.close(connection_id, receive_time)
+
+        # connections of a killed scanner were not closed
+        for connection_id in list(self.connections):
+            self.close(connection_id, self.connections[connection_id][1])
+
+    def feed(self, connection_id, receive_time, data):
+        """
+        Args:
+            connection_id (int): The connection which received the data.
+            receive_time (float): The time the data was received.
+            data (bytes): The received data.
+        """
+        if connection_id not in self.connections:
+            logging.error('REPLAY Data of unknown connection %s.', connection_id)
+            return
+
+        conn = self.connections[connection_id][0]
+        self.bytes += len(data)
+        addr_records, getaddr_records = conn.process_data(data, receive_time)
+        self.writer.write('addr', conn.to_addr, receive_time, addr_records)
+        self.writer.write('getaddr', conn.to_addr, receive_time, getaddr_records)
+        self.addresses += len(addr_records) + len(getaddr_records)
+
+    def close(self, connection_id, close_time):
+        """
+        Args:
+            connection_id (int): The closed connection.
+            close_time (float): The time the connection was closed.
+        """
+        if connection_id not in self.connections:
+            return
+
+        conn, open_time = self.connections.pop(connection_id)
+        self.writer.finish(conn.to_addr, close_time - open_time, None)
+        self.finished += 1
+
+
+def merge_captures(file_locations):
+    """
+    Args:
+        file_locations (list): Capture files, e.g. of the processes of the pool engine.
+
+    Returns:
+        iterator: The chunks of all files in the order they were received.
+    """
+    return heapq.merge(*(read_capture(path) for path in file_locations), key=lambda chunk: chunk[0])
+
+
+def parse_arguments():
+    """
+    Returns:
+        Namespace: The command line arguments.
+    """
+    parser = argparse.ArgumentParser(description='Replay capture files through the decoding of the scanner.')
+    parser.add_argument('captures', nargs='+', help='Capture files written with main.py --capture')
+    parser.add_argument('--timing', choices=['max', 'original'], default='max',
+                        help='max: as fast as possible, original: with the delays between the chunks')
+    parser.add_argument('--output-format', choices=['none', 'csv', 'binary'], default='none',
+                        help='csv and binary write the output files like main.py, none only counts')
+    parser.add_argument('--profile', action='store_true',
+                        help='Measure the time of every stage and write the report to output_profile.csv')
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_arguments()
+    logging.basicConfig(level=logging.ERROR)
+
+    PROFILER.enabled = args.profile
+    if args.output_format == 'none':
+        writer = CallbackWriter(lambda batch: None)
+    else:
+        create_output_files(args.output_format)
+        writer = OutputWriter(args.output_format)
+
+    replay = Replay(writer, args.timing)
+    beginning_time = time.time()
+    try:
+        replay.run(merge_captures(args.captures))
+    finally:
+        writer.close()
+    elapsed = time.time() - beginning_time
+
+    print(f'connections: {replay.finished}')
+    print(f'chunks: {replay.chunks}')
+    print(f'bytes: {replay.bytes}')
+    print(f'addresses: {replay.addresses}')
+    print(f'elapsed: {elapsed:.3f}')
+    print(f'bytesPerSecond: {replay.bytes / elapsed:.1f}')
+    print(f'addressesPerSecond: {replay.addresses / elapsed:.1f}')
+    if args.profile:
+        PROFILER.write_report(OUTPUT_PROFILE)
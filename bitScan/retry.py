@@ -0,0 +1,117 @@
+import heapq
+import itertools
+import random
+import time
+
+
+class RetryPolicy(object):
+    """How often and when opening a connection to a bitcoin node is tried.
+
+    Note:
+        The delay after the n-th failed attempt is base_delay * 2 ** (n - 1), at most max_delay. A random part
+        of up to half of it is dropped (jitter), so nodes which fail at the same moment are not tried again at
+        the same moment.
+
+    Args:
+        connect_timeout (float): Maximum seconds one attempt to connect may take.
+        base_delay (float): Delay in seconds after the first failed attempt.
+        max_delay (float): Maximum delay in seconds.
+        max_attempts (int): Number of attempts before we give up on a node.
+    """
+
+    def __init__(self, connect_timeout=10, base_delay=1, max_delay=60, max_attempts=5):
+        self.connect_timeout = connect_timeout
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def delay(self, attempt):
+        """
+        Args:
+            attempt (int): Number of failed attempts so far.
+
+        Returns:
+            float: Seconds to wait before the next attempt.
+        """
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        return delay - random.uniform(0, delay / 2)
+
+    def attempt_timeout(self, timeout):
+        """
+        Args:
+            timeout (int): The time when we want to shutdown in seconds.
+
+        Returns:
+            float: Maximum seconds the next attempt may take.
+        """
+        return max(min(self.connect_timeout, timeout - time.time()), 0.1)
+
+    def exhausted(self, attempt, timeout):
+        """
+        Args:
+            attempt (int): Number of failed attempts so far.
+            timeout (int): The time when we want to shutdown in seconds.
+
+        Returns:
+            bool: Indicates if we give up on the node.
+        """
+        return attempt >= self.max_attempts or time.time() + self.delay(attempt) >= timeout
+
+
+class ParkingLot(object):
+    """Nodes whose connection failed, until they may be tried again.
+
+    Note:
+        Used by the pool engine, so a worker does not sleep between the attempts of a dead node but connects
+        to the next node in the meantime.
+
+    Args:
+        retry (RetryPolicy): Decides when a node is tried again.
+
+    Attributes:
+        heap (list): (time of the next attempt, sequence number, failed attempts, node) for every parked node.
+    """
+
+    def __init__(self, retry):
+        self.retry = retry
+        self.heap = []
+        self.sequence = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def park(self, target, attempt):
+        """
+        Args:
+            target (list): host,port
+            attempt (int): Number of failed attempts so far.
+
+        Returns:
+            bool: Indicates if the node was parked. False if we give up on the node.
+        """
+        if attempt >= self.retry.max_attempts:
+            return False
+
+        heapq.heappush(self.heap, (time.time() + self.retry.delay(attempt), next(self.sequence), attempt, target))
+        return True
+
+    def wait_time(self):
+        """
+        Returns:
+            float: Seconds until the next node may be tried again. None if no node is parked.
+        """
+        if not self.heap:
+            return None
+        return max(self.heap[0][0] - time.time(), 0)
+
+    def pop_ready(self):
+        """
+        Returns:
+            list: (target, failed attempts) of every node which may be tried again now.
+        """
+        ready = []
+        now = time.time()
+        while self.heap and self.heap[0][0] <= now:
+            _, _, attempt, target = heapq.heappop(self.heap)
+            ready.append((target, attempt))
+        return ready
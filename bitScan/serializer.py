@@ -1,7 +1,10 @@
+import functools
 import logging
 import time
 import socket
 import random
+import sys
+from array import array
 from io import BytesIO
 from base64 import b32encode, b32decode
 
@@ -10,6 +13,254 @@ from bitScan.exception import *
 
 """Reference for the content of the messages: https://en.bitcoin.it/wiki/Protocol_documentation"""
 
+ADDR_ENTRY_LEN = 30  # timestamp (4 bytes), services (8 bytes), ip (16 bytes), port (2 bytes)
+VARINT_FORMATS = {0xFD: '<H', 0xFE: '<I', 0xFF: '<Q'}  # format of a variable length integer after its first byte
+MAX_ADDR_ENTRIES = 1000  # maximum number of addresses in one addr message
+MESSAGE_CACHE = {}  # messages which never change, see Serializer.constant_message
+HOST_CACHE_SIZE = 1 << 16  # number of hosts render_host keeps as text
+
+
+@functools.lru_cache(maxsize=HOST_CACHE_SIZE)
+def render_host(ip):
+    """Convert the 16 bytes of a network address to a readable host.
+
+    Note:
+        Nodes send the same addresses again and again, so the text of the last HOST_CACHE_SIZE hosts is kept.
+
+    Args:
+        ip (bytes): ipv6, ipv4-mapped ipv6 or onion address.
+
+    Returns:
+        str: ipv4, ipv6 or onion host.
+    """
+    if ip[:12] == IPV4_MAPPED_PREFIX:
+        return socket.inet_ntop(socket.AF_INET, ip[12:])
+    if ip[:6] == ONION_PREFIX:
+        return b32encode(ip[6:]).lower().decode() + ".onion"  # use .onion
+    return socket.inet_ntop(socket.AF_INET6, ip)
+
+
+class AddrBatch(object):
+    """The addresses of one or more addr messages, stored column by column.
+
+    Note:
+        The columns are filled with extended slices of the payload, so decoding costs a fixed number of
+        C-level copies per column instead of Python code per address. The columns are the packed form of the
+        received addresses which every consumer uses (writer, index, crawler, propagation), there is no
+        object per address. The hosts are only converted to text by render_host when the output is written.
+
+    Args:
+        timestamps (array): Timestamp of every address.
+        services (array): Services of every address.
+        ips (bytearray): The 16 byte ip of every address, one after the other.
+        ports (array): Port of every address.
+    """
+    __slots__ = ('timestamps', 'services', 'ips', 'ports')
+
+    def __init__(self, timestamps=None, services=None, ips=None, ports=None):
+        self.timestamps = timestamps if timestamps is not None else array('I')
+        self.services = services if services is not None else array('Q')
+        self.ips = ips if ips is not None else bytearray()
+        self.ports = ports if ports is not None else array('H')
+
+    @classmethod
+    def from_entries(cls, data, count):
+        """
+        Args:
+            data (bytes): count addr entries of ADDR_ENTRY_LEN bytes.
+            count (int): Number of addresses.
+
+        Returns:
+            AddrBatch: The decoded addresses.
+        """
+        return cls(column(data, count, ADDR_ENTRY_LEN, 0, 4, 'I'), column(data, count, ADDR_ENTRY_LEN, 4, 8, 'Q'),
+                   column(data, count, ADDR_ENTRY_LEN, 12, 16),
+                   column(data, count, ADDR_ENTRY_LEN, 28, 2, 'H', big_endian=True))
+
+    def to_entries(self):
+        """Inverse of from_entries.
+
+        Returns:
+            bytearray: The addresses as addr entries of ADDR_ENTRY_LEN bytes.
+        """
+        data = bytearray(ADDR_ENTRY_LEN * len(self))
+        fields = [(column_bytes(self.timestamps), 0, 4), (column_bytes(self.services), 4, 8), (self.ips, 12, 16),
+                  (column_bytes(self.ports, big_endian=True), 28, 2)]
+        for values, offset, size in fields:
+            for k in range(size):
+                data[offset + k::ADDR_ENTRY_LEN] = values[k::size]
+        return data
+
+    def __len__(self):
+        return len(self.ports)
+
+    def ip(self, idx):
+        """
+        Args:
+            idx (int): Position of the address.
+
+        Returns:
+            bytes: The 16 byte ip of the address.
+        """
+        return bytes(self.ips[16 * idx:16 * idx + 16])
+
+    def rows(self):
+        """
+        Yields:
+            (tuple): timestamp, services, ip, port for every address.
+        """
+        ips = bytes(self.ips)
+        for idx, (timestamp, services, port) in enumerate(zip(self.timestamps, self.services, self.ports)):
+            yield timestamp, services, ips[16 * idx:16 * idx + 16], port
+
+    def select(self, positions):
+        """
+        Args:
+            positions (list): Positions of the addresses we keep, in ascending order.
+
+        Returns:
+            AddrBatch: The addresses at the positions.
+        """
+        if len(positions) == len(self):
+            return self
+
+        ips = bytearray()
+        for idx in positions:
+            ips += self.ips[16 * idx:16 * idx + 16]
+
+        return AddrBatch(array('I', [self.timestamps[idx] for idx in positions]),
+                         array('Q', [self.services[idx] for idx in positions]), ips,
+                         array('H', [self.ports[idx] for idx in positions]))
+
+    def extend(self, other):
+        """Append the addresses of another batch.
+
+        Args:
+            other (AddrBatch): The addresses we append.
+        """
+        self.timestamps.extend(other.timestamps)
+        self.services.extend(other.services)
+        self.ips += other.ips
+        self.ports.extend(other.ports)
+
+
+def column(data, count, entry_len, offset, size, typecode=None, big_endian=False):
+    """Copy one field of fixed-width entries into a column.
+
+    Args:
+        data (bytes): The entries, one after the other.
+        count (int): Number of entries.
+        entry_len (int): Length of an entry.
+        offset (int): Position of the field in an entry.
+        size (int): Length of the field.
+        typecode (str): Typecode of the returned array. None returns the raw bytes.
+        big_endian (bool): Indicates if the field is big-endian, otherwise it is little-endian.
+
+    Returns:
+        array|bytearray: The field of every entry.
+    """
+    values = bytearray(size * count)
+    for k in range(size):
+        values[k::size] = data[offset + k::entry_len]
+
+    if typecode is None:
+        return values
+
+    values = array(typecode, values)
+    if big_endian != (sys.byteorder == 'big'):
+        values.byteswap()
+    return values
+
+
+def column_bytes(values, big_endian=False):
+    """Inverse of column for integer columns.
+
+    Args:
+        values (array): The column.
+        big_endian (bool): Indicates if the field is big-endian, otherwise it is little-endian.
+
+    Returns:
+        bytes: The values in the byte order of the field.
+    """
+    if big_endian != (sys.byteorder == 'big'):
+        values = array(values.typecode, values)
+        values.byteswap()
+    return values.tobytes()
+
+
+class AddrTemplate(object):
+    """addr messages for send_addr.csv, serialized only once.
+
+    Note:
+        The addresses are packed when the template is created and split into messages of at most
+        MAX_ADDR_ENTRIES addresses. Before sending, only the timestamps and the checksum of the messages are
+        patched in place. The patched messages are cached for the current second, so all connections send
+        the same bytes.
+
+    Args:
+        serializer (Serializer): Creates the header of the messages.
+        addr_list (list): The rows of send_addr.csv: timestamp, services, host, port.
+
+    Attributes:
+        buffers (list): One tuple per message: the message as bytearray and the number of addresses.
+        second (int): The timestamp of the cached messages.
+        messages (list): The messages with the timestamp second.
+    """
+
+    def __init__(self, serializer, addr_list):
+        logging.info('SER Create addr template.')
+
+        entries = [serializer.serialize_network_address_values_given(x) for x in addr_list]
+        entries = [x for x in entries if x]
+
+        self.buffers = []
+        for start in range(0, len(entries), MAX_ADDR_ENTRIES):
+            chunk = entries[start:start + MAX_ADDR_ENTRIES]
+            payload = serializer.serialize_int(len(chunk)) + b''.join(chunk)
+            self.buffers.append((bytearray(serializer.create_message('addr', payload)), len(chunk)))
+        self.second = None
+        self.messages = []
+
+    def __len__(self):
+        return len(self.buffers)
+
+    def get_messages(self, timestamp=None):
+        """
+        Args:
+            timestamp (int): The timestamp of all addresses. Default is the current time.
+
+        Returns:
+            list: The addr messages as bytes.
+        """
+        if timestamp is None:
+            timestamp = int(time.time())
+
+        if timestamp != self.second:
+            self.second = timestamp
+            self.messages = [self.patch(buffer, count, timestamp) for buffer, count in self.buffers]
+
+        return self.messages
+
+    def patch(self, buffer, count, timestamp):
+        """Write the timestamp into every address of a message and update the checksum.
+
+        Args:
+            buffer (bytearray): A message of the template.
+            count (int): Number of addresses in the message.
+            timestamp (int): The timestamp of all addresses.
+
+        Returns:
+            bytes: The patched message.
+        """
+        start = len(buffer) - count * ADDR_ENTRY_LEN
+        for k, value in enumerate(struct.pack('<I', timestamp)):
+            buffer[start + k::ADDR_ENTRY_LEN] = bytes((value,)) * count
+
+        with memoryview(buffer) as view:
+            buffer[20:HEADER_LEN] = sha256_util(sha256_util(view[HEADER_LEN:]))[:4]
+
+        return bytes(buffer)
+
 
 class Serializer(object):
     """Handles serialization and deserialization.
@@ -49,6 +300,26 @@ class Serializer(object):
         return struct.pack('I', self.magic_number) + str.encode(command + "\x00" * (12 - len(command))) +\
                struct.pack('<I', len(payload)) + checksum + payload
 
+    def constant_message(self, command, payload=b''):
+        """Create a message which never changes only once.
+
+        Note:
+            Used for ping, verack and getaddr. Every connection gets the same bytes.
+
+        Args:
+            command (str): The command type for the message. E.g: 'verack'.
+            payload (bytes): Content is the already packed payload of the message
+
+        Returns:
+            bytes: The message as bytes which can be sent to a bitcoin node.
+        """
+        key = (self.magic_number, command, payload)
+        msg = MESSAGE_CACHE.get(key)
+        if msg is None:
+            msg = MESSAGE_CACHE[key] = self.create_message(command, payload)
+
+        return msg
+
     def serialize_network_address_version(self, addr):
         """Serialize (pack) a network address.
 
@@ -115,11 +386,10 @@ class Serializer(object):
         """
         logging.info('SER Serialize addr payload.')
 
-        packed_addresses = b''
-        for x in addr_list:
-            packed_addresses += self.serialize_network_address_values_given(x)
+        packed_addresses = [self.serialize_network_address_values_given(x) for x in addr_list]
+        packed_addresses = [x for x in packed_addresses if x]
 
-        return self.serialize_int(len(addr_list)).encode('latin-1') + packed_addresses
+        return self.serialize_int(len(packed_addresses)) + b''.join(packed_addresses)
 
     def serialize_ping_payload(self):
         """Serialize the payload for a ping message.
@@ -141,26 +411,29 @@ class Serializer(object):
             address (list): The content of the address.
 
         Returns:
-            bytes: The packed address
+            bytes: The packed address. Empty if a field of the address is invalid.
         """
         logging.info('SER Serialize network address values given.')
 
-        ip = address[2]
-        if '.' in ip:
-            # ipv4; unused (12 bytes) + ipv4 (4 bytes) = ipv4-mapped ipv6 address
-            host = bytearray.fromhex("00000000000000000000ffff") + socket.inet_aton(ip)
-        elif ':' in ip and not ip.endswith('.onion'):
-            # ipv6; ipv6 (16 bytes)
-            host = socket.inet_pton(socket.AF_INET6, ip)
-        elif ip.endswith(".onion"):
-            # convert .onion address to its ipv6 equivalent (6 + 10 bytes)
-            host = ONION_PREFIX + b32decode(ip[:-6], True)
-        else:
-            # the address was not in the correct format, therefore return empty bytes
+        try:
+            ip = address[2]
+            if ip.endswith(".onion"):
+                # convert .onion address to its ipv6 equivalent (6 + 10 bytes)
+                host = ONION_PREFIX + b32decode(ip[:-6], True)
+            elif '.' in ip:
+                # ipv4; unused (12 bytes) + ipv4 (4 bytes) = ipv4-mapped ipv6 address
+                host = IPV4_MAPPED_PREFIX + socket.inet_aton(ip)
+            elif ':' in ip:
+                # ipv6; ipv6 (16 bytes)
+                host = socket.inet_pton(socket.AF_INET6, ip)
+            else:
+                raise ValueError(f'{ip} is no ipv4, ipv6 or onion host')
+            return struct.pack('<IQ16s', int(address[0]), int(address[1]), host) + struct.pack('>H', int(address[3]))
+        except (OSError, ValueError, IndexError, struct.error) as err:
+            # the address was not in the correct format, therefore it is dropped and empty bytes are returned
+            logging.error('SER Dropped invalid address %s: %s', address, err)
             return b''
 
-        return struct.pack('<I', int(address[0])) + struct.pack("<Q", int(address[1])) + struct.pack('>16sH', host, int(address[3]))
-
     def deserialize_header(self, data):
         """Deserialize header of a message.
 
@@ -238,17 +511,53 @@ class Serializer(object):
         """
         logging.info('SER Deserialize addr payload.')
 
-        data = BytesIO(data)
-        msg = ''
-        is_getaddr_response = False
+        records, is_getaddr_response = self.deserialize_addr_records(data)
 
-        count = self.deserialize_int(data)
-        if count > 10:
-            is_getaddr_response = True
-        for _ in range(count):
-            msg += connected_host + ',' + connected_port + ',' + self.deserialize_network_address(data, has_timestamp=True) + ',' + str(current_time) + '\n'
+        return self.format_addr_records(records, current_time, connected_host, connected_port), is_getaddr_response
 
-        return msg, is_getaddr_response
+    def deserialize_addr_records(self, data):
+        """Deserialize addr payload without converting the addresses to text.
+
+        Args:
+            data (bytes|memoryview): Payload content
+
+        Returns:
+            (tuple): tuple containing:
+                records (AddrBatch): The addresses of the message.
+                is_getaddr_response (bool): Indicates if the message is a response to a getaddr message.
+        """
+        logging.info('SER Deserialize addr records.')
+
+        count, offset = self.deserialize_int_at(data)
+        if len(data) - offset < count * ADDR_ENTRY_LEN:
+            raise MessageContentError(
+                "Payload is to short. Got {} of {} bytes".format(len(data), offset + count * ADDR_ENTRY_LEN))
+
+        # the entries are copied once: strided slices of bytes are copied in C, those of a memoryview item by
+        # item, so extracting the columns straight from the view is about 4 times slower than this copy
+        entries = bytes(memoryview(data)[offset:offset + count * ADDR_ENTRY_LEN])
+
+        return AddrBatch.from_entries(entries, count), count > 10
+
+    def format_addr_records(self, records, current_time, connected_host, connected_port):
+        """Convert records from deserialize_addr_records to the lines of the output files.
+
+        Args:
+            records (AddrBatch): The received addresses.
+            current_time (float): The time we received the addr message.
+            connected_host (str): Host for current connection
+            connected_port (str): Port for current connection
+
+        Returns:
+            str: For every address connected host, connected port, host, port, timestamp, current time.
+                After each address is a newline.
+        """
+        prefix = connected_host + ',' + connected_port + ','
+        suffix = ',' + str(current_time) + '\n'
+        render = render_host
+
+        return ''.join([prefix + render(ip) + ',' + str(port) + ',' + str(timestamp) + suffix
+                        for timestamp, services, ip, port in records.rows()])
 
     def deserialize_network_address(self, data, has_timestamp=False):
         """Deserialize network address.
@@ -272,42 +581,40 @@ class Serializer(object):
 
         services = unpack_util("<Q", data.read(8))
 
-        _ipv6 = data.read(12)
-        _ipv4 = data.read(4)
+        ip = data.read(16)
         port = unpack_util(">H", data.read(2))
-        _ipv6 += _ipv4
 
-        ipv4 = ""
-        ipv6 = ""
+        if timestamp is None:
+            return '{},{}'.format(render_host(ip), port)
+        return '{},{},{}'.format(render_host(ip), port, timestamp)
 
-        if _ipv6[:6] == ONION_PREFIX:
-            host = b32encode(_ipv6[6:]).lower() + b".onion"  # use .onion
-        else:
-            ipv6 = socket.inet_ntop(socket.AF_INET6, _ipv6)
-            ipv4 = socket.inet_ntop(socket.AF_INET, _ipv4)
-            if ipv4 in ipv6:
-                host = ipv4
-            else:
-                host = ipv6
+    def format_host(self, ip):
+        """Convert the 16 bytes of a network address to a readable host.
 
-        if has_timestamp:
-            return '{},{},{}'.format(host, port, timestamp)
-        else:
-            return '{},{}'.format(host, port)
+        Args:
+            ip (bytes): ipv6, ipv4-mapped ipv6 or onion address.
+
+        Returns:
+            str: ipv4, ipv6 or onion host, see render_host.
+        """
+        return render_host(bytes(ip))
 
     def deserialize_string(self, data):
         """Deserialize a string.
 
+        Note:
+            Invalid utf-8, e.g. in the user agent of a broken node, is replaced instead of raised.
+
         Args:
-            data (bytes): Network address content.
+            data (BytesIO): Network address content.
 
         Returns:
-            dict: Dictionary with all the content from the network address in a readable format.
+            str: The decoded string.
         """
         logging.info('SER Deserialize string.')
 
         length = self.deserialize_int(data)
-        return data.read(length).decode('utf-8')
+        return data.read(length).decode('utf-8', errors='replace')
 
     def deserialize_int(self, data):
         """
@@ -328,13 +635,41 @@ class Serializer(object):
             length = unpack_util("<Q", data.read(8))
         return length
 
+    def deserialize_int_at(self, data, offset=0):
+        """Like deserialize_int, but reads the variable length integer from a buffer without copying it.
+
+        Args:
+            data (bytes|memoryview): The buffer.
+            offset (int): Position of the integer in data.
+
+        Returns:
+            (tuple): tuple containing:
+                value (int): The integer.
+                offset (int): Position after the integer.
+        """
+        try:
+            prefix = data[offset]
+            if prefix < 0xFD:
+                return prefix, offset + 1
+            fmt = VARINT_FORMATS[prefix]
+            return struct.unpack_from(fmt, data, offset + 1)[0], offset + 1 + struct.calcsize(fmt)
+        except (IndexError, struct.error) as err:
+            raise MessageContentError(f"Error while unpacking bytes: {err}")
+
     def serialize_int(self, length):
+        """
+        Args:
+            length (int): The number we want to serialize.
+
+        Returns:
+            bytes: The number as variable length integer.
+        """
         if length < 0xFD:
-            return chr(length)
+            return struct.pack("<B", length)
         elif length <= 0xFFFF:
-            return chr(0xFD) + str(struct.pack("<H", length))
+            return b'\xFD' + struct.pack("<H", length)
         elif length <= 0xFFFFFFFF:
-            return chr(0xFE) + str(struct.pack("<I", length))
-        return chr(0xFF) + str(struct.pack("<Q", length))
+            return b'\xFE' + struct.pack("<I", length)
+        return b'\xFF' + struct.pack("<Q", length)
 
 
@@ -0,0 +1,158 @@
+import collections
+import logging
+
+from bitScan.address_index import address_key
+
+
+class SessionPolicy(object):
+    """How long we listen to a bitcoin node after the handshake.
+
+    Note:
+        The yield of a node is the number of addresses per minute it sent during the last window seconds
+        which it did not send before in the same session. Without min_yield, idle_timeout and max_minutes the
+        session ends at the timeout of the time frame, as before.
+
+        With min_yield a session ends as soon as the yield falls below it (saturated) and goes on after the
+        timeout while it stays above it, at most max_minutes after the session began. The yield is only
+        judged after the first window seconds, so the response to getaddr and the first addr messages can
+        arrive. With idle_timeout a session also ends when the node sent no addresses for that many seconds.
+
+    Args:
+        min_yield (float): New addresses per minute a node has to send to be listened to. 0 disables it.
+        window (float): Seconds over which the yield is measured.
+        idle_timeout (float): Seconds without addresses after which the session ends. None disables it.
+        max_minutes (float): Maximum length of an extended session in minutes. None disables extending.
+    """
+
+    def __init__(self, min_yield=0, window=60, idle_timeout=None, max_minutes=None):
+        self.min_yield = min_yield
+        self.window = window
+        self.idle_timeout = idle_timeout
+        self.max_minutes = max_minutes
+
+    def start(self, begin, timeout):
+        """
+        Args:
+            begin (float): The time the session begins.
+            timeout (int): The time when the time frame of the node ends in seconds.
+
+        Returns:
+            Session: The state of the new session.
+        """
+        return Session(self, begin, timeout)
+
+
+class Session(object):
+    """State of the session with one bitcoin node, see SessionPolicy.
+
+    Args:
+        policy (SessionPolicy): Decides when the session ends.
+        begin (float): The time the session begins.
+        timeout (int): The time when the time frame of the node ends in seconds.
+
+    Attributes:
+        cap (float): The session ends at this time in any case.
+        seen (set): Key of every address the node sent, only kept if the yield is measured.
+        new_addresses (int): Number of different addresses the node sent.
+        history (deque): (time, new_addresses) after every batch of addresses, back to the beginning of the
+            window.
+        last_activity (float): The time the node sent addresses for the last time.
+        reason (str): Why the session ended: 'timeout', 'saturated', 'idle' or 'cap'. None while it goes on.
+    """
+
+    def __init__(self, policy, begin, timeout):
+        self.policy = policy
+        self.begin = begin
+        self.timeout = timeout
+        self.cap = timeout
+        if policy.min_yield and policy.max_minutes:
+            self.cap = max(timeout, begin + 60 * policy.max_minutes)
+        self.seen = set()
+        self.new_addresses = 0
+        self.history = collections.deque([(begin, 0)])
+        self.last_activity = begin
+        self.reason = None
+
+    def observe(self, current_time, records):
+        """Count the new addresses of a received batch.
+
+        Args:
+            current_time (float): The time we received the addresses.
+            records (AddrBatch): The received addresses.
+        """
+        if not records:
+            return
+
+        self.last_activity = current_time
+        if not self.policy.min_yield:
+            return
+
+        ips = bytes(records.ips)
+        seen = self.seen
+        count = len(seen)
+        for idx, port in enumerate(records.ports):
+            seen.add(address_key(ips[16 * idx:16 * idx + 16], port))
+        self.new_addresses += len(seen) - count
+        self.history.append((current_time, self.new_addresses))
+
+    def current_yield(self, now):
+        """
+        Args:
+            now (float): The current time.
+
+        Returns:
+            float: New addresses per minute during the last window.
+        """
+        start = now - self.policy.window
+        # keep the last entry before the window, it is the count at the beginning of the window
+        while len(self.history) > 1 and self.history[1][0] <= start:
+            self.history.popleft()
+        return 60 * (self.new_addresses - self.history[0][1]) / self.policy.window
+
+    def next_check(self, now):
+        """
+        Note:
+            New addresses only move the end of a session later, so a timer at this time never misses it.
+
+        Args:
+            now (float): The current time.
+
+        Returns:
+            float: The earliest time the session can be over if the node sends no more addresses.
+        """
+        policy = self.policy
+        deadline = self.cap
+        if policy.idle_timeout is not None:
+            deadline = min(deadline, self.last_activity + policy.idle_timeout)
+        if policy.min_yield:
+            # the yield falls below min_yield when the count at the beginning of the window exceeds threshold
+            threshold = self.new_addresses - policy.min_yield * policy.window / 60
+            for history_time, new_addresses in self.history:
+                if new_addresses > threshold:
+                    deadline = min(deadline, max(history_time + policy.window, self.begin + policy.window))
+                    break
+        return max(now, deadline)
+
+    def expired(self, now):
+        """
+        Args:
+            now (float): The current time.
+
+        Returns:
+            bool: Indicates if the session is over, the reason is in self.reason.
+        """
+        policy = self.policy
+        if now >= self.cap:
+            self.reason = 'timeout' if self.cap == self.timeout else 'cap'
+        elif policy.idle_timeout is not None and now - self.last_activity >= policy.idle_timeout:
+            self.reason = 'idle'
+        elif policy.min_yield and now - self.begin >= policy.window:
+            if self.current_yield(now) < policy.min_yield:
+                self.reason = 'saturated'
+        elif now >= self.timeout:
+            self.reason = 'timeout'
+
+        if self.reason is not None:
+            logging.info('SESSION Ended after %.1f seconds (%s), %s different addresses.', now - self.begin,
+                         self.reason, self.new_addresses)
+        return self.reason is not None
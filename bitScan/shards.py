@@ -0,0 +1,305 @@
+import asyncio
+import heapq
+import logging
+import multiprocessing
+import os
+import queue
+import zlib
+
+from bitScan.async_connection import run_scan
+from bitScan.binary_output import PEERS_HEADER, RECORD, read_peers
+from bitScan.capture import CAPTURE
+from bitScan.journal import JOURNAL_HEADER, KINDS, ScanJournal, read_journal
+from bitScan.profiling import PROFILER
+from bitScan.serializer import AddrTemplate, Serializer
+from bitScan.targets import TargetStore, is_target_store
+from bitScan.writer import DurationWriter, OutputWriter, create_output_files
+from bitScan.utils import *
+
+"""Sharded scan: several processes with an asyncio engine each and no shared state.
+
+Every shard reads the target list on its own and scans the nodes whose hash (shard_of) belongs to it, or every
+shards-th node of a compiled target list (targets.py), so the processes do not exchange any data while the
+scan goes on. Every shard writes its own output files, named with shard_path, e.g. output_addr.shard3.csv.
+When all shards are done, merge_shards merges them into the usual output files: the addresses in the order of
+their receive time, the durations and one journal line for every node. The files of the shards are deleted
+afterwards.
+
+Example:
+    python main.py --engine sharded --shards 8 --concurrency 4000
+"""
+
+# bytes of the buffers of the merged files
+MERGE_BUFFER = 1 << 20
+
+
+def shard_of(host, port, shards):
+    """
+    Args:
+        host (str): Host of a bitcoin node.
+        port (str|int): Port of the bitcoin node.
+        shards (int): Number of shards.
+
+    Returns:
+        int: The shard which scans the node.
+    """
+    return zlib.crc32(f'{host},{port}'.encode()) % shards
+
+
+def run_shard(results, shard, shards, output_format='csv', concurrency=1000, minutes=3, intervals=(-1, -1),
+              retry=None, policy=None, profile=False, capture=None, targets_location=ADDRESSES_GETADDR):
+    """Scan the nodes of one shard with the asyncio engine.
+
+    Note:
+        Is the target of the shard processes.
+
+    Args:
+        results (Queue): Gets (shard, number of scanned nodes, profiler values) when the shard is done.
+        shard (int): Number of this shard.
+        shards (int): Number of shards.
+        output_format (str): 'csv' or 'binary'.
+        concurrency (int): Maximum number of connections of this shard open at the same time.
+        minutes (float): Time frame per node in minutes.
+        intervals (tuple): Interval in minutes when we send getaddr and addr messages, -1 implies never.
+        retry (RetryPolicy): Timeout per attempt to connect, delays and number of attempts.
+        policy (SessionPolicy): Decides when the session with a node ends.
+        profile (bool): Indicates if the stages of every connection are measured.
+        capture (str): If given, the received data is captured to this path with the process id appended.
+        targets_location (str): The path to the target list, csv or compiled, see iter_targets.
+    """
+    PROFILER.enabled = profile
+    if capture:
+        CAPTURE.open(f'{capture}.{os.getpid()}')
+    create_output_files(output_format, shard)
+    output_writer = OutputWriter(output_format, shard=shard)
+    durations = DurationWriter(shard_path(OUTPUT_DURATION, shard), progress=False)
+
+    def finish_node(result):
+        output_writer.finish(result[:2], result[2], result[3])
+        durations.write(result)
+
+    if is_target_store(targets_location):
+        # the targets of a compiled list are distinct, so every shard reads its own slice of the mapped file
+        targets = TargetStore(targets_location).iter_slice(shard, shards)
+    else:
+        targets = (address for address in iter_file_csv(targets_location)
+                   if shard_of(address[0], address[1], shards) == shard)
+    content_addr_msg = AddrTemplate(Serializer(), read_file_csv(CONTENT_ADDR_SEND))
+    count = 0
+    try:
+        count = asyncio.run(run_scan(targets, content_addr_msg, output_writer, concurrency, minutes, *intervals,
+                                     retry=retry, on_result=finish_node, policy=policy))
+    finally:
+        output_writer.close()
+        durations.close()
+        CAPTURE.close()
+        results.put((shard, count, PROFILER.pop_stats()))
+
+
+def run_sharded(shards, output_format='csv', concurrency=1000, minutes=3, intervals=(-1, -1), retry=None,
+                policy=None, profile=False, capture=None, targets_location=ADDRESSES_GETADDR):
+    """Scan all nodes of the target list with one process per shard and merge their output files.
+
+    Note:
+        The concurrency is divided among the shards. The output files of the shards are merged even if a
+        shard failed, so the data of the other shards is kept.
+
+    Args:
+        shards (int): Number of shard processes.
+        output_format (str): 'csv' or 'binary'.
+        concurrency (int): Maximum number of connections open at the same time in all shards.
+        minutes (float): Time frame per node in minutes.
+        intervals (tuple): Interval in minutes when we send getaddr and addr messages, -1 implies never.
+        retry (RetryPolicy): Timeout per attempt to connect, delays and number of attempts.
+        policy (SessionPolicy): Decides when the session with a node ends.
+        profile (bool): Indicates if the profiler values of all shards are written to OUTPUT_PROFILE.
+        capture (str): If given, every shard captures the received data to this path with its process id
+            appended.
+        targets_location (str): The path to the target list, csv or compiled, see iter_targets.
+
+    Returns:
+        int: Number of scanned nodes.
+    """
+    logging.info('SHARDS Start %s shards.', shards)
+
+    results = multiprocessing.Queue()
+    processes = [multiprocessing.Process(target=run_shard,
+                                         args=(results, shard, shards, output_format, -(-concurrency // shards),
+                                               minutes, intervals, retry, policy, profile, capture,
+                                               targets_location))
+                 for shard in range(shards)]
+    for process in processes:
+        process.start()
+
+    count = 0
+    try:
+        for process in processes:
+            process.join()
+    finally:
+        for process in processes:
+            # after an interrupt the shards still close their files
+            process.join()
+            if process.exitcode != 0:
+                logging.error('SHARDS %s exited with %s.', process.name, process.exitcode)
+        while True:
+            try:
+                shard, shard_count, stats = results.get(timeout=0.1)
+            except queue.Empty:
+                break
+            count += shard_count
+            PROFILER.merge(stats)
+        merge_shards(output_format, shards)
+        if profile:
+            PROFILER.write_report(OUTPUT_PROFILE)
+
+    return count
+
+
+def merge_shards(output_format, shards):
+    """Merge the output files of all shards into the usual output files and delete them.
+
+    Note:
+        The files of a shard are sorted by receive time, because every shard writes the addresses in the
+        order it receives them, so the merge streams through the files with heapq.merge.
+
+    Args:
+        output_format (str): 'csv' or 'binary'.
+        shards (int): Number of shards.
+    """
+    logging.info('SHARDS Merge the output files of %s shards.', shards)
+
+    shard_files = []
+    if output_format == 'binary':
+        peers_locations = [shard_path(OUTPUT_PEERS, shard) for shard in range(shards)]
+        offsets = merge_peers(peers_locations, OUTPUT_PEERS)
+        for path in OUTPUT_FILES_BINARY.values():
+            locations = [shard_path(path, shard) for shard in range(shards)]
+            merge_binary(locations, offsets, path)
+            shard_files += locations
+        shard_files += peers_locations
+        paths = OUTPUT_FILES_BINARY
+    else:
+        for path in OUTPUT_FILES.values():
+            locations = [shard_path(path, shard) for shard in range(shards)]
+            merge_csv(locations, path)
+            shard_files += locations
+        paths = OUTPUT_FILES
+
+    durations = [shard_path(OUTPUT_DURATION, shard) for shard in range(shards)]
+    concatenate_csv(durations, OUTPUT_DURATION, DURATION_HEADER)
+    shard_files += durations
+
+    # the offsets in the journals of the shards refer to their own files, every node is finished in the merged files
+    journals = [shard_path(OUTPUT_JOURNAL, shard) for shard in range(shards)]
+    ends = {kind: os.path.getsize(paths[kind]) for kind in KINDS}
+    write_to_file(OUTPUT_JOURNAL, '', JOURNAL_HEADER)
+    journal = ScanJournal(OUTPUT_JOURNAL)
+    for path in journals:
+        journal.write([((host, port), duration, handshake_latency or None)
+                       for host, port, duration, handshake_latency, _ in read_journal(path)], ends, ends)
+    journal.close()
+    shard_files += journals
+
+    for path in shard_files:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def merge_csv(file_locations, merged_location):
+    """
+    Args:
+        file_locations (list): Output files in the csv layout, every file sorted by the receive time.
+        merged_location (str): The path to the merged file, which is created.
+    """
+    files = [open(path, 'r') for path in file_locations if os.path.exists(path)]
+    try:
+        for f in files:
+            # header
+            next(f, None)
+        with open(merged_location, 'w', buffering=MERGE_BUFFER) as out:
+            out.write(OUTPUT_HEADER + '\n')
+            out.writelines(heapq.merge(*files, key=lambda line: float(line[line.rindex(',') + 1:])))
+    finally:
+        for f in files:
+            f.close()
+
+
+def merge_peers(file_locations, merged_location):
+    """Write the peer dictionaries of the shards into one.
+
+    Note:
+        Every node belongs to one shard, so the peers of the shards are different and the ids of a shard are
+        moved by the number of peers of the shards before it.
+
+    Args:
+        file_locations (list): The peer dictionary of every shard.
+        merged_location (str): The path to the merged peer dictionary, which is created.
+
+    Returns:
+        list: The offset of the peer ids of every shard.
+    """
+    offsets = []
+    lines = []
+    for path in file_locations:
+        offsets.append(len(lines))
+        peers = read_peers(path) if os.path.exists(path) else {}
+        for peer_id in sorted(peers):
+            host, port = peers[peer_id]
+            lines.append(f'{offsets[-1] + peer_id},{host},{port}\n')
+    write_to_file(merged_location, ''.join(lines), PEERS_HEADER)
+    return offsets
+
+
+def iter_shard_records(file_location, offset, chunk_records=1 << 16):
+    """
+    Args:
+        file_location (str): A binary output file of a shard.
+        offset (int): Offset of the peer ids of the shard, see merge_peers.
+        chunk_records (int): Number of records read at once.
+
+    Yields:
+        tuple: The fields of RECORD with the merged peer id.
+    """
+    if not os.path.exists(file_location):
+        return
+    with open(file_location, 'rb') as f:
+        while True:
+            data = f.read(chunk_records * RECORD.size)
+            if not data:
+                return
+            for ip, port, services, timestamp, receive_time, peer_id in RECORD.iter_unpack(
+                    data[:len(data) - len(data) % RECORD.size]):
+                yield ip, port, services, timestamp, receive_time, peer_id + offset
+
+
+def merge_binary(file_locations, offsets, merged_location):
+    """
+    Args:
+        file_locations (list): Binary output files of the shards, every file sorted by the receive time.
+        offsets (list): Offset of the peer ids of every shard, see merge_peers.
+        merged_location (str): The path to the merged file, which is created.
+    """
+    records = heapq.merge(*(iter_shard_records(path, offset) for path, offset in zip(file_locations, offsets)),
+                          key=lambda record: record[4])
+    with open(merged_location, 'wb', buffering=MERGE_BUFFER) as out:
+        for record in records:
+            out.write(RECORD.pack(*record))
+
+
+def concatenate_csv(file_locations, merged_location, header):
+    """
+    Args:
+        file_locations (list): csv files with the same header.
+        merged_location (str): The path to the file with the lines of all files, which is created.
+        header (str): The header of the files.
+    """
+    with open(merged_location, 'w') as out:
+        out.write(header + '\n')
+        for path in file_locations:
+            if not os.path.exists(path):
+                continue
+            with open(path, 'r') as f:
+                # header
+                next(f, None)
+                for line in f:
+                    out.write(line)
@@ -0,0 +1,188 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+
+from bitScan.address_index import address_key
+from bitScan.crawler import pack_host
+from bitScan.serializer import render_host
+from bitScan.utils import *
+
+"""Compiled target lists: the nodes of one or more getaddr.csv files in a packed binary file.
+
+The file starts with a HEADER (little-endian): TARGETS_MAGIC (8 bytes) and the number of targets (8 bytes).
+It is followed by one TARGET record per node: the ip as 16 bytes like in an addr message (ipv4-mapped for
+ipv4) and the port (2 bytes). Invalid rows are dropped and every node is kept once, in the order of its first
+row. TargetStore reads the file memory-mapped, so opening it costs the same for any number of targets and all
+processes which read it share the pages of the file.
+
+Example:
+    python targets.py ../input_output/getaddr.csv -o ../input_output/targets.bin
+    python main.py --targets ../input_output/targets.bin --engine sharded
+"""
+
+TARGETS_MAGIC = b'BSTGT1\n\x00'
+HEADER = struct.Struct('<8sQ')
+TARGET = struct.Struct('<16sH')
+
+
+def compile_targets(file_locations, target_location):
+    """Write the valid and distinct nodes of csv files to a compiled target file.
+
+    Note:
+        The keys of the distinct nodes are kept in memory while compiling, the rows are streamed.
+
+    Args:
+        file_locations (list): csv files with the rows host,port, like getaddr.csv.
+        target_location (str): The path to the compiled file, which is created.
+
+    Returns:
+        (tuple): tuple containing:
+            count (int): Number of written targets.
+            invalid (int): Number of rows with an invalid host or port.
+            duplicates (int): Number of rows of a node which was already written.
+    """
+    logging.info('TARGETS Compile %s.', file_locations)
+
+    seen = set()
+    invalid = 0
+    duplicates = 0
+    with open(target_location, 'wb') as out:
+        out.write(HEADER.pack(TARGETS_MAGIC, 0))
+        for path in file_locations:
+            for row in iter_file_csv(path):
+                ip = pack_host(row[0].strip()) if len(row) >= 2 else None
+                try:
+                    port = int(row[1])
+                except (IndexError, ValueError):
+                    port = 0
+                if ip is None or not 0 < port < 1 << 16:
+                    invalid += 1
+                    continue
+                key = address_key(ip, port)
+                if key in seen:
+                    duplicates += 1
+                    continue
+                seen.add(key)
+                out.write(TARGET.pack(ip, port))
+        # the count is written when all targets are, an interrupted compilation leaves an empty list
+        out.seek(0)
+        out.write(HEADER.pack(TARGETS_MAGIC, len(seen)))
+
+    if invalid:
+        logging.error('TARGETS Dropped %s invalid rows.', invalid)
+    return len(seen), invalid, duplicates
+
+
+def is_target_store(file_location):
+    """
+    Args:
+        file_location (str): The path to a target list.
+
+    Returns:
+        bool: Indicates if the file is a compiled target file, else it is a csv file.
+    """
+    with open(file_location, 'rb') as f:
+        return f.read(len(TARGETS_MAGIC)) == TARGETS_MAGIC
+
+
+class TargetStore(object):
+    """Memory-mapped reader of a compiled target file.
+
+    Note:
+        Only the pages of the targets which are read are loaded, by the operating system, and they are shared
+        by all processes which map the file. A target is converted to text when it is read.
+
+    Args:
+        file_location (str): The path to the compiled target file.
+
+    Attributes:
+        data (mmap): The mapped file.
+        count (int): Number of targets.
+    """
+
+    def __init__(self, file_location):
+        with open(file_location, 'rb') as f:
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.data)
+        if magic != TARGETS_MAGIC:
+            raise ValueError(f'{file_location} is not a compiled target file.')
+        if len(self.data) < HEADER.size + self.count * TARGET.size:
+            raise ValueError(f'{file_location} is incomplete.')
+
+    def __len__(self):
+        return self.count
+
+    def record(self, idx):
+        """
+        Args:
+            idx (int): Number of the target.
+
+        Returns:
+            (tuple): tuple containing:
+                ip (bytes): The 16 byte ip.
+                port (int): Port
+        """
+        if not 0 <= idx < self.count:
+            raise IndexError(idx)
+        return TARGET.unpack_from(self.data, HEADER.size + idx * TARGET.size)
+
+    def __getitem__(self, idx):
+        """
+        Returns:
+            list: host,port of the target, like a row of getaddr.csv.
+        """
+        ip, port = self.record(idx)
+        return [render_host(ip), port]
+
+    def __iter__(self):
+        return self.iter_slice()
+
+    def iter_slice(self, start=0, step=1):
+        """
+        Args:
+            start (int): Number of the first target.
+            step (int): Read every step-th target, e.g. the number of shards.
+
+        Yields:
+            list: host,port of the targets, like the rows of getaddr.csv.
+        """
+        data = self.data
+        for offset in range(HEADER.size + start * TARGET.size, HEADER.size + self.count * TARGET.size,
+                            step * TARGET.size):
+            ip, port = TARGET.unpack_from(data, offset)
+            yield [render_host(ip), port]
+
+    def close(self):
+        self.data.close()
+
+
+def iter_targets(file_location):
+    """Read a target list, csv or compiled.
+
+    Args:
+        file_location (str): The path to getaddr.csv or a compiled target file.
+
+    Returns:
+        iterator: host,port of every target.
+    """
+    if is_target_store(file_location):
+        return iter(TargetStore(file_location))
+    return iter_file_csv(file_location)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Compile target lists into a packed binary file for main.py '
+                                                 '--targets.')
+    parser.add_argument('inputs', nargs='*', default=[ADDRESSES_GETADDR],
+                        help='csv files with the rows host,port, default ' + ADDRESSES_GETADDR)
+    parser.add_argument('-o', '--output', default=os.path.splitext(ADDRESSES_GETADDR)[0] + '.bin',
+                        help='The compiled target file')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.ERROR)
+
+    count, invalid, duplicates = compile_targets(args.inputs, args.output)
+    print(f'targets: {count}')
+    print(f'invalid: {invalid}')
+    print(f'duplicates: {duplicates}')
@@ -0,0 +1,156 @@
+import asyncio
+import logging
+import math
+import time
+
+TIMER_TICK = 0.1
+TIMER_SLOTS = 1024
+
+
+class Timer(object):
+    """A callback which is due at a time of the monotonic clock, see TimerWheel.
+
+    Attributes:
+        deadline (float): Monotonic time when the timer is due.
+        rounds (int): Number of turns of the wheel before the timer is due.
+        interval (float): Seconds until the timer is due again after it fired. None for a single shot.
+        cancelled (bool): Indicates if the timer was cancelled, it is dropped when its slot is visited.
+    """
+
+    __slots__ = ('deadline', 'rounds', 'interval', 'callback', 'args', 'cancelled')
+
+    def __init__(self, deadline, interval, callback, args):
+        self.deadline = deadline
+        self.rounds = 0
+        self.interval = interval
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel(object):
+    """Hashed timer wheel on the monotonic clock.
+
+    Note:
+        A timer goes into the slot of the tick it is due, together with the number of turns of the wheel until
+        then. Scheduling and cancelling cost O(1) and a tick only visits the timers of its own slot, so the cost
+        per tick does not grow with the number of connections. Timers fire up to one tick late, never early.
+
+        Callbacks run in advance and must not block. An exception of a callback is logged, the other timers
+        fire anyway.
+
+    Args:
+        tick (float): Seconds per slot.
+        size (int): Number of slots.
+        clock (callable): Monotonic clock in seconds.
+
+    Attributes:
+        slots (list): The timers of every slot.
+        current (int): Number of the next tick to process since the start of the clock.
+    """
+
+    def __init__(self, tick=TIMER_TICK, size=TIMER_SLOTS, clock=time.monotonic):
+        self.tick = tick
+        self.size = size
+        self.clock = clock
+        self.slots = [[] for _ in range(size)]
+        self.current = int(clock() / tick) + 1
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def schedule(self, delay, callback, *args):
+        """Call callback(*args) once after delay seconds.
+
+        Args:
+            delay (float): Seconds until the timer is due.
+            callback (callable): Called when the timer is due.
+
+        Returns:
+            Timer: The scheduled timer, cancel it with Timer.cancel.
+        """
+        timer = Timer(self.clock() + max(0, delay), None, callback, args)
+        self.insert(timer)
+        return timer
+
+    def every(self, interval, callback, *args):
+        """Call callback(*args) every interval seconds, the first time after one interval.
+
+        Args:
+            interval (float): Seconds between two calls.
+            callback (callable): Called when the timer is due.
+
+        Returns:
+            Timer: The scheduled timer, cancelling it stops all further calls.
+        """
+        timer = Timer(self.clock() + interval, interval, callback, args)
+        self.insert(timer)
+        return timer
+
+    def insert(self, timer):
+        """
+        Args:
+            timer (Timer): Timer with its deadline set.
+        """
+        due = max(self.current, math.ceil(timer.deadline / self.tick))
+        timer.rounds = (due - self.current) // self.size
+        self.slots[due % self.size].append(timer)
+        self.count += 1
+
+    def until_next_tick(self):
+        """
+        Returns:
+            float: Seconds until the next tick has to be processed.
+        """
+        return max(0.0, self.current * self.tick - self.clock())
+
+    def advance(self, now=None):
+        """Process all ticks up to now and fire the due timers.
+
+        Args:
+            now (float): The current monotonic time. Default the clock.
+
+        Returns:
+            int: Number of fired timers.
+        """
+        now = self.clock() if now is None else now
+        last = int(now / self.tick)
+        fired = 0
+        while self.current <= last:
+            slot = self.slots[self.current % self.size]
+            due = []
+            pending = []
+            for timer in slot:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    pending.append(timer)
+                else:
+                    due.append(timer)
+            self.count -= len(slot) - len(pending)
+            self.slots[self.current % self.size] = pending
+            self.current += 1
+
+            for timer in due:
+                fired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception as err:
+                    logging.error('TIMER Callback %s failed: %s', timer.callback, err)
+                if timer.interval is not None and not timer.cancelled:
+                    # skip the calls we missed instead of firing them all at once
+                    timer.deadline = max(timer.deadline + timer.interval, now)
+                    self.insert(timer)
+        return fired
+
+    async def run(self):
+        """Advance the wheel every tick until the task is cancelled, e.g. for all connections of an event loop.
+        """
+        while True:
+            await asyncio.sleep(self.until_next_tick())
+            self.advance()
@@ -1,4 +1,5 @@
 import hashlib
+import os
 import struct
 import time
 
@@ -6,10 +7,13 @@ from bitScan.exception import *
 import csv
 import logging
 
-ONION_PREFIX = "\xFD\x87\xD8\x7E\xEB\x43"  # ipv6 prefix for .onion address
+ONION_PREFIX = b"\xFD\x87\xD8\x7E\xEB\x43"  # ipv6 prefix for .onion address
+IPV4_MAPPED_PREFIX = b'\x00' * 10 + b'\xff\xff'  # ipv6 prefix for ipv4 address
 HEADER_LEN = 24
 MIN_PROTOCOL_VERSION = 70001
 SOCKET_BUFFER = 8192
+PING_INTERVAL = 60  # seconds between two keepalive pings
+MAX_PAYLOAD_LEN = 4 * 1000 * 1000  # bitcoin core rejects larger messages
 MAGIC_NUMBER_COMPARE = b'\xf9\xbe\xb4\xd9'
 ADDRESSES_GETADDR = '../input_output/getaddr.csv'
 CONTENT_ADDR_SEND = '../input_output/send_addr.csv'
@@ -17,6 +21,20 @@ LOG_MAIN = '../logs/log_main.txt'
 OUTPUT_ADDR = '../input_output/output_addr.csv'
 OUTPUT_GETADDR = '../input_output/output_getaddr.csv'
 OUTPUT_DURATION = '../input_output/output_duration.csv'
+DURATION_HEADER = 'Node,Duration in seconds,Handshake in seconds'
+OUTPUT_ADDR_BINARY = '../input_output/output_addr.bin'
+OUTPUT_GETADDR_BINARY = '../input_output/output_getaddr.bin'
+OUTPUT_PEERS = '../input_output/output_peers.csv'
+OUTPUT_INDEX = '../input_output/output_index.csv'
+OUTPUT_PROFILE = '../input_output/output_profile.csv'
+OUTPUT_JOURNAL = '../input_output/scan_journal.csv'
+OUTPUT_PROPAGATION = '../input_output/output_propagation.csv'
+OUTPUT_PROPAGATION_SUMMARY = '../input_output/output_propagation_summary.csv'
+OUTPUT_ANALYTICS_ADDRESSES = '../input_output/analytics_addresses.csv'
+OUTPUT_ANALYTICS_PEERS = '../input_output/analytics_peers.csv'
+OUTPUT_HEADER = 'connectedToHost,connectedToPort,host,port,timestamp,currentTime'
+OUTPUT_FILES = {'addr': OUTPUT_ADDR, 'getaddr': OUTPUT_GETADDR}
+OUTPUT_FILES_BINARY = {'addr': OUTPUT_ADDR_BINARY, 'getaddr': OUTPUT_GETADDR_BINARY}
 
 
 def create_sub_version():
@@ -35,8 +53,6 @@ def create_sub_version():
 
 
 def sha256_util(data):
-    logging.info('UTIL Sha256.')
-
     return hashlib.sha256(data).digest()
 
 
@@ -50,8 +66,6 @@ def unpack_util(fmt, data):
     Returns:
         Unpacked data, which should be readable.
     """
-    logging.info('UTIL Unpack bytes.')
-
     try:
         return struct.unpack(fmt, data)[0]
     except struct.error as err:
@@ -87,16 +101,43 @@ def read_file_csv(file_location):
     Returns:
         content (list): The content we read from the file. The element in the list are lists also.
     """
+    return list(iter_file_csv(file_location))
+
+
+def iter_file_csv(file_location):
+    """Read csv file row by row.
+
+    Note: First row is the header, therefore it is skipped. The file is only read as far as the rows are
+    consumed, so long files are never loaded completely.
+
+    Args:
+        file_location (str): The path to the file we want to read
+
+    Yields:
+        list: The next row.
+    """
     logging.info('UTIL Read csv file.')
 
-    content = []
     with open(file_location, 'r') as data:
         csv_reader = csv.reader(data, delimiter=',')
         for idx, row in enumerate(csv_reader):
             if idx != 0 and row != []:
-                content.append(row)
+                yield row
+
+
+def shard_path(file_location, shard):
+    """
+    Args:
+        file_location (str): The path to an output file, e.g. OUTPUT_ADDR.
+        shard (int): Number of a shard of a sharded scan, see shards.py. None for the file itself.
 
-    return content
+    Returns:
+        str: The path to the file of the shard, e.g. output_addr.shard3.csv.
+    """
+    if shard is None:
+        return file_location
+    root, extension = os.path.splitext(file_location)
+    return f'{root}.shard{shard}{extension}'
 
 
 def calculate_timeout(time_minutes):
@@ -123,18 +164,3 @@ def append_to_file(file_location, data):
 
     with open(file_location, 'a') as f:
         f.write(data)
-
-
-def update_timestamps(arg):
-    """Update the time in the first entry of an item of the list.
-
-    Args:
-        arg (list): [[<timestamp>,...],[timestamp,...],...]
-
-    Returns:
-        The updated list.
-    """
-    for x in arg:
-        x[0] = str(time.time()).split('.')[0]
-
-    return arg
@@ -0,0 +1,405 @@
+import logging
+import os
+import queue
+import sys
+import time
+
+from bitScan.address_index import AddressIndex
+from bitScan.binary_output import BinaryOutput, PEERS_HEADER, read_peers
+from bitScan.journal import JOURNAL_HEADER, ScanJournal
+from bitScan.profiling import PROFILER
+from bitScan.propagation import PROPAGATION_SUMMARY_HEADER
+from bitScan.serializer import Serializer
+from bitScan.utils import *
+
+
+def create_output_files(output_format='csv', shard=None):
+    """Create empty output files for the received addresses and an empty journal.
+
+    Note:
+        Deletes old files.
+
+    Args:
+        output_format (str): 'csv' or 'binary'.
+        shard (int): If given, the files of this shard of a sharded scan are created, see shard_path.
+    """
+    if output_format == 'binary':
+        for path in OUTPUT_FILES_BINARY.values():
+            open(shard_path(path, shard), 'wb').close()
+        write_to_file(shard_path(OUTPUT_PEERS, shard), '', PEERS_HEADER)
+    else:
+        for path in OUTPUT_FILES.values():
+            write_to_file(shard_path(path, shard), '', OUTPUT_HEADER)
+    write_to_file(shard_path(OUTPUT_JOURNAL, shard), '', JOURNAL_HEADER)
+
+
+class OutputWriter(object):
+    """Writes the received addresses to the output files in batches.
+
+    Note:
+        The files are opened once and kept open. Data is collected in memory and written when batch_size
+        bytes are collected or flush_interval seconds have passed since the last write. close must be
+        called in the end, otherwise the last batch is lost.
+
+        Existing output files are continued. Finished nodes are written to the ScanJournal after the batch
+        with their last addresses, see finish.
+
+        The connections only call write and injected, the engines finish. QueueWriter, RemoteWriter and
+        CallbackWriter have these methods as well, so they take the place of an OutputWriter in another
+        process, on another machine or in a function without a change to the connections.
+
+    Args:
+        output_format (str): 'csv' writes the lines of OUTPUT_HEADER, 'binary' the records of binary_output.
+        batch_size (int): Number of bytes which are collected before writing.
+        flush_interval (float): Maximum time in seconds data is kept in memory.
+        index (AddressIndex): If given, only addresses which are new or have a new timestamp are written.
+            The index is written to OUTPUT_INDEX on close.
+        tracker (PropagationTracker): If given, every received address is checked against the injected
+            addresses. A summary line is appended to OUTPUT_PROPAGATION_SUMMARY with every batch which
+            contains returns and the table is written to OUTPUT_PROPAGATION on close.
+        shard (int): If given, the files of this shard of a sharded scan are written, see shard_path.
+
+    Attributes:
+        files (dict): The open output file for every kind of data.
+        batches (dict): The collected data for every kind of data.
+        batched (int): Number of bytes which are collected.
+        last_flush (float): The time of the last write.
+        serializer (Serializer): Converts the records to text.
+        binary_output (BinaryOutput): Converts the records to the binary format. None for csv.
+        journal (ScanJournal): Journal of the finished nodes.
+        ends (dict): End of every output file including the collected data.
+        open_peers (dict): For every unfinished node which sent addresses the ends before its first address.
+        finished (list): The finished nodes which are written to the journal with the next batch.
+    """
+
+    def __init__(self, output_format='csv', batch_size=1 << 20, flush_interval=5, index=None, tracker=None,
+                 shard=None):
+        logging.info('WRITER Open output files.')
+
+        self.output_format = output_format
+        self.index = index
+        self.tracker = tracker
+        self.shard = shard
+        if tracker is not None:
+            write_to_file(shard_path(OUTPUT_PROPAGATION_SUMMARY, shard), '', PROPAGATION_SUMMARY_HEADER)
+        self.serializer = Serializer()
+        self.binary_output = None
+        if output_format == 'binary':
+            paths = {kind: shard_path(path, shard) for kind, path in OUTPUT_FILES_BINARY.items()}
+            self.files = {kind: open(path, 'ab') for kind, path in paths.items()}
+            peers_location = shard_path(OUTPUT_PEERS, shard)
+            self.binary_output = BinaryOutput(open(peers_location, 'a'))
+            # peer ids of a resumed scan
+            self.binary_output.peer_ids = {(host, int(port)): peer_id
+                                           for peer_id, (host, port) in read_peers(peers_location).items()}
+        else:
+            paths = {kind: shard_path(path, shard) for kind, path in OUTPUT_FILES.items()}
+            self.files = {kind: open(path, 'a') for kind, path in paths.items()}
+        self.journal = ScanJournal(shard_path(OUTPUT_JOURNAL, shard))
+        self.ends = {kind: os.path.getsize(path) for kind, path in paths.items()}
+        self.open_peers = {}
+        self.finished = []
+        self.batches = {kind: [] for kind in self.files}
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.batched = 0
+        self.last_flush = time.time()
+
+    def write(self, kind, peer, current_time, records):
+        """Collect received addresses and write the batch if it is full or old enough.
+
+        Args:
+            kind (str): The kind of data, 'addr' or 'getaddr'.
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if records and self.tracker is not None:
+            self.tracker.observe(peer, current_time, records)
+
+        if records and self.index is not None:
+            start = PROFILER.start()
+            records = records.select(self.index.observe(peer, current_time, records))
+            PROFILER.stop('index', start)
+
+        if records:
+            start = PROFILER.start()
+            if self.binary_output:
+                data = self.binary_output.pack(peer, current_time, records)
+            else:
+                data = self.serializer.format_addr_records(records, current_time, peer[0], str(peer[1]))
+            PROFILER.stop('format', start)
+            if peer not in self.open_peers:
+                self.open_peers[peer] = dict(self.ends)
+            self.batches[kind].append(data)
+            self.batched += len(data)
+            self.ends[kind] += len(data)
+
+        self.flush_if_due()
+
+    def injected(self, peer, current_time):
+        """
+        Args:
+            peer (tuple): host, port of the bitcoin node we sent the addresses of send_addr.csv to.
+            current_time (float): The time we sent the addr message.
+        """
+        if self.tracker is not None:
+            self.tracker.injected(peer, current_time)
+
+    def finish(self, peer, duration_of_connection, handshake_latency):
+        """Mark a node as finished.
+
+        Note:
+            Must be called after the last write of the node. The node is written to the journal with the
+            next batch.
+
+        Args:
+            peer (tuple): host, port of the bitcoin node.
+            duration_of_connection (float): duration of connection
+            handshake_latency (float): Seconds the handshake took. None if there was no handshake.
+        """
+        self.open_peers.pop(peer, None)
+        self.finished.append((peer, duration_of_connection, handshake_latency))
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Write the batch if it is full or old enough.
+        """
+        if self.batched >= self.batch_size or time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Write all collected data to the files.
+        """
+        start = PROFILER.start()
+        empty = b'' if self.binary_output else ''
+        for kind, batch in self.batches.items():
+            if batch:
+                self.files[kind].write(empty.join(batch))
+                self.files[kind].flush()
+                batch.clear()
+        if self.finished:
+            cleans = {kind: min((ends[kind] for ends in self.open_peers.values()), default=self.ends[kind])
+                      for kind in self.ends}
+            self.journal.write(self.finished, self.ends, cleans)
+            self.finished.clear()
+        if self.tracker is not None and self.tracker.changed:
+            append_to_file(shard_path(OUTPUT_PROPAGATION_SUMMARY, self.shard), self.tracker.summary())
+        PROFILER.stop('flush', start)
+
+        self.batched = 0
+        self.last_flush = time.time()
+
+    def close(self):
+        """Write the last batch and close the files.
+        """
+        logging.info('WRITER Close output files.')
+
+        self.flush()
+        for f in self.files.values():
+            f.close()
+        if self.binary_output:
+            self.binary_output.peers_file.close()
+        self.journal.close()
+        if self.index is not None:
+            self.index.write_summary(shard_path(OUTPUT_INDEX, self.shard))
+        if self.tracker is not None:
+            append_to_file(shard_path(OUTPUT_PROPAGATION_SUMMARY, self.shard), self.tracker.summary())
+            self.tracker.write_table(shard_path(OUTPUT_PROPAGATION, self.shard))
+
+
+class DurationWriter(object):
+    """Writes the duration of every connection to OUTPUT_DURATION as soon as the node is done.
+
+    Note:
+        Every line is flushed, so the lines of all finished nodes survive a crash. The lines are in the order
+        the nodes finished. If stderr is a terminal, the number of finished nodes is shown there.
+
+    Args:
+        file_location (str): The path to the duration file, which is created.
+        progress (bool): Indicates if the progress is shown. Default: stderr is a terminal.
+        resume (bool): Indicates if the existing file is continued.
+
+    Attributes:
+        done (int): Number of finished nodes.
+        connected (int): Number of finished nodes we had a handshake with.
+    """
+
+    def __init__(self, file_location=OUTPUT_DURATION, progress=None, resume=False):
+        if not resume:
+            write_to_file(file_location, '', DURATION_HEADER)
+        self.file = open(file_location, 'a')
+        self.progress = sys.stderr.isatty() if progress is None else progress
+        self.done = 0
+        self.connected = 0
+        self.started = time.time()
+        self.last_progress = 0
+
+    def write(self, result):
+        """
+        Args:
+            result (tuple): host, port, duration of the connection, handshake latency (None without handshake).
+        """
+        host, _, duration, handshake_latency = result
+        self.file.write(f'{host},{duration},{"" if handshake_latency is None else handshake_latency}\n')
+        self.file.flush()
+
+        self.done += 1
+        if handshake_latency is not None:
+            self.connected += 1
+        if self.progress and time.time() - self.last_progress >= 1:
+            self.show_progress()
+
+    def show_progress(self):
+        self.last_progress = time.time()
+        rate = self.done / max(self.last_progress - self.started, 1e-9)
+        sys.stderr.write(f'\r{self.done} nodes done, {self.connected} connected, {rate:.1f} nodes/s')
+        sys.stderr.flush()
+
+    def close(self):
+        if self.progress:
+            self.show_progress()
+            sys.stderr.write('\n')
+        self.file.close()
+
+
+class QueueWriter(object):
+    """Hands data from a worker process to the writer process.
+
+    Note:
+        Every call is put on the queue as a tuple, run_writer passes it to the OutputWriter of the writer
+        process. write_profile additionally hands over the profiler values of the worker process.
+
+    Args:
+        output_queue (Queue): Queue which is read by run_writer.
+    """
+
+    def __init__(self, output_queue):
+        self.output_queue = output_queue
+
+    def write(self, kind, peer, current_time, records):
+        """
+        Args:
+            kind (str): The kind of data, 'addr' or 'getaddr'.
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if records:
+            self.output_queue.put((kind, peer, current_time, records))
+
+    def injected(self, peer, current_time):
+        """
+        Args:
+            peer (tuple): host, port of the bitcoin node we sent the addresses of send_addr.csv to.
+            current_time (float): The time we sent the addr message.
+        """
+        self.output_queue.put(('injected', peer, current_time))
+
+    def finish(self, peer, duration_of_connection, handshake_latency):
+        """
+        Args:
+            peer (tuple): host, port of the bitcoin node.
+            duration_of_connection (float): duration of connection
+            handshake_latency (float): Seconds the handshake took. None if there was no handshake.
+        """
+        self.output_queue.put(('done', peer, duration_of_connection, handshake_latency))
+
+    def write_profile(self):
+        """Hand the values of the profiler of this process to the writer process.
+        """
+        if PROFILER.enabled:
+            self.output_queue.put(('profile', PROFILER.pop_stats()))
+
+
+class CallbackWriter(object):
+    """Hands the received addresses to a function instead of writing them to files.
+
+    Note:
+        Can be passed to any engine, e.g. to analyse the addresses in the same process. The records are not
+        kept after the call. A generator works as well with its send method as callback, after it was started
+        with next.
+
+    Args:
+        callback (callable): Called with the tuple (kind, peer, current_time, records) for every non-empty batch
+            of addresses, see OutputWriter.write.
+        on_finish (callable): Called with peer, duration of the connection and handshake latency of every
+            finished node. None ignores finished nodes.
+    """
+
+    def __init__(self, callback, on_finish=None):
+        self.callback = callback
+        self.on_finish = on_finish
+
+    def write(self, kind, peer, current_time, records):
+        """
+        Args:
+            kind (str): The kind of data, 'addr' or 'getaddr'.
+            peer (tuple): host, port of the bitcoin node we received the addresses from.
+            current_time (float): The time we received the addr message.
+            records (AddrBatch): The received addresses.
+        """
+        if records:
+            self.callback((kind, peer, current_time, records))
+
+    def injected(self, peer, current_time):
+        pass
+
+    def finish(self, peer, duration_of_connection, handshake_latency):
+        """
+        Args:
+            peer (tuple): host, port of the bitcoin node.
+            duration_of_connection (float): duration of connection
+            handshake_latency (float): Seconds the handshake took. None if there was no handshake.
+        """
+        if self.on_finish is not None:
+            self.on_finish(peer, duration_of_connection, handshake_latency)
+
+    def close(self):
+        pass
+
+
+def run_writer(output_queue, output_format='csv', deduplicate=False, profile=False, batch_size=1 << 20,
+               flush_interval=5, tracker=None):
+    """Write everything from the queue to the output files until None is received.
+
+    Note:
+        Is the target of the writer process. The workers must have stopped before None is put into the
+        queue, otherwise their last data is lost.
+
+    Args:
+        output_queue (Queue): Contains the arguments of OutputWriter.write, ('done', arguments of
+            OutputWriter.finish), ('injected', arguments of OutputWriter.injected) or ('profile', stats) from
+            QueueWriter.
+        output_format (str): 'csv' or 'binary'.
+        deduplicate (bool): Indicates if only new or changed addresses are written, see AddressIndex.
+        profile (bool): Indicates if the profiler values of all processes are written to OUTPUT_PROFILE.
+        batch_size (int): Number of bytes which are collected before writing.
+        flush_interval (float): Maximum time in seconds data is kept in memory.
+        tracker (PropagationTracker): Tracks the returns of the addresses of send_addr.csv.
+    """
+    PROFILER.enabled = profile
+    writer = OutputWriter(output_format, batch_size, flush_interval, AddressIndex() if deduplicate else None,
+                          tracker)
+    try:
+        while True:
+            try:
+                item = output_queue.get(timeout=flush_interval)
+            except queue.Empty:
+                writer.flush_if_due()
+                continue
+
+            if item is None:
+                break
+            if item[0] == 'profile':
+                PROFILER.merge(item[1])
+            elif item[0] == 'done':
+                writer.finish(*item[1:])
+            elif item[0] == 'injected':
+                writer.injected(*item[1:])
+            else:
+                writer.write(*item)
+    finally:
+        writer.close()
+        if profile:
+            PROFILER.write_report(OUTPUT_PROFILE)